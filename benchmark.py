@@ -0,0 +1,328 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+from minesweeper import comb_and_comp, Board, ArrayBoard, SparseBoard, np
+from simulate import Game, play_game
+
+
+# a row of revealed tiles between two rows of mines. Every tile of the
+# row has several possible mine layouts, so many chains are built.
+WALL_WIDTH = 16
+WALL_HEIGHT = 9
+WALL_MINES = 24
+WALL_ROW = 4
+WALL_LAYOUT = {
+    (0, 5), (1, 3), (2, 5), (4, 3), (5, 3), (7, 5),
+    (8, 3), (10, 5), (11, 3), (13, 5), (14, 3), (15, 5),
+}
+
+# side of the square boards built by board_build
+BUILD_SIZE = 300
+
+
+# number shown by the tile at (x, y) for the given mines
+def tile_number(mines, x, y):
+    return sum((x + i, y + j) in mines
+        for i in (-1, 0, 1) for j in (-1, 0, 1))
+
+
+def wall_reveals():
+    return [((x, WALL_ROW), tile_number(WALL_LAYOUT, x, WALL_ROW))
+        for x in range(WALL_WIDTH)]
+
+
+# average memory held per chain after revealing the wall, including the
+# chain map entries that point at it
+def chain_memory(compact):
+    board = Board(WALL_WIDTH, WALL_HEIGHT, WALL_MINES, compact=compact)
+    tracemalloc.start()
+    start = time.perf_counter()
+    board.reveal_tiles(wall_reveals())
+    elapsed = time.perf_counter() - start
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    num_chains = len(board.chainMap.chains)
+    return {
+        'chains': num_chains,
+        'bytes_per_chain': size / num_chains,
+        'peak_bytes': peak,
+        'seconds': elapsed,
+    }
+
+
+# time and memory to build a board before the first reveal
+def board_build(board_class, size):
+    tracemalloc.start()
+    start = time.perf_counter()
+    board_class(size, size, size * size // 10)
+    elapsed = time.perf_counter() - start
+    used, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'bytes': used,
+        'peak_bytes': peak,
+        'seconds': elapsed,
+    }
+
+
+# chains held by a chain map, including the chains of its components
+def held_chains(chain_map):
+    return len(chain_map.chains) + sum(len(comp.chains)
+        for comp in getattr(chain_map, 'components', ()))
+
+
+# Scenarios are (setup, run) pairs. run gets what setup returns, does the
+# timed work and returns the most chains held while it ran.
+
+def wall_setup():
+    return Board(WALL_WIDTH, WALL_HEIGHT, WALL_MINES)
+
+
+# revealing a long wall that leaves a wide open frontier
+def wall_run(board):
+    board.reveal_tiles(wall_reveals())
+    return held_chains(board.chainMap)
+
+
+def endgame_setup():
+    rng = random.Random(ENDGAME_SEED)
+    game = Game(10, 10, ENDGAME_MINES, (0, 0), rng)
+    safes = [(x, y) for y in range(10) for x in range(10)
+        if (x, y) not in game.mines]
+    hidden = set(rng.sample(safes, ENDGAME_HIDDEN))
+    reveals = [((x, y), game.number(x, y)) for x, y in safes
+        if (x, y) not in hidden]
+    return Board(10, 10, ENDGAME_MINES), reveals
+
+
+# a dense board with only a few safe tiles left hidden among the mines
+def endgame_run(state):
+    board, reveals = state
+    board.reveal_tiles(reveals)
+    return held_chains(board.chainMap)
+
+
+def sparse_setup():
+    rng = random.Random(SPARSE_SEED)
+    size = SPARSE_SIZE
+    mines = {(rng.randrange(size), rng.randrange(size))
+        for _ in range(SPARSE_MINES)}
+    batches = []
+    for _ in range(SPARSE_BATCHES):
+        coords = [(rng.randrange(size), rng.randrange(size))
+            for _ in range(SPARSE_REVEALS)]
+        batches.append([((x, y), tile_number(mines, x, y))
+            for x, y in coords if (x, y) not in mines])
+    board = SparseBoard(size, size, size * size // 6, engine='components')
+    return board, batches
+
+
+# scattered reveals on a huge board, each starting its own component
+def sparse_run(state):
+    board, batches = state
+    peak = 0
+    for batch in batches:
+        board.reveal_tiles(batch)
+        peak = max(peak, held_chains(board.chainMap))
+    return peak
+
+
+# whole intermediate games played one reveal after another
+def long_game_run(_):
+    peak = 0
+    for seed in range(LONG_GAMES):
+        result = play_game(16, 16, 40, seed,
+            options={'chain_budget': LONG_GAME_BUDGET})
+        peak = max(peak, result['peak_chains'])
+    return peak
+
+
+def comb_run(_):
+    for _ in range(COMB_ROUNDS):
+        for _ in comb_and_comp(list(range(16)), 8):
+            pass
+    return 0
+
+
+# every wall chain checked against the last tile of the wall
+def check_tile_setup():
+    board = wall_setup()
+    reveals = wall_reveals()
+    board.reveal_tiles(reveals[:-1])
+    (x, y), num = reveals[-1]
+    tile = board.tiles[y][x]
+    tile.set_num(num)
+    return [chain.copy() for chain in board.chainMap.chains], tile
+
+
+def check_tile_run(state):
+    chains, tile = state
+    for chain in chains:
+        chain.check_tile(tile)
+    return len(chains)
+
+
+def lowest_prob_setup():
+    random.seed(0)
+    board = wall_setup()
+    board.reveal_tiles(wall_reveals())
+    return board
+
+
+def lowest_prob_run(board):
+    for _ in range(LOWEST_PROB_ROUNDS):
+        board.chainMap.get_lowest_prob()
+    return held_chains(board.chainMap)
+
+
+def no_setup():
+    return None
+
+
+ENDGAME_SEED = 2
+ENDGAME_MINES = 35
+ENDGAME_HIDDEN = 30
+SPARSE_SEED = 5
+SPARSE_SIZE = 100000
+SPARSE_MINES = 50000
+SPARSE_BATCHES = 4
+SPARSE_REVEALS = 200
+LONG_GAMES = 5
+LONG_GAME_BUDGET = 2000
+COMB_ROUNDS = 20
+LOWEST_PROB_ROUNDS = 20000
+
+SCENARIOS = {
+    'open_frontier': (wall_setup, wall_run),
+    'dense_endgame': (endgame_setup, endgame_run),
+    'huge_sparse': (sparse_setup, sparse_run),
+    'long_game': (no_setup, long_game_run),
+    'comb_and_comp': (no_setup, comb_run),
+    'check_tile': (check_tile_setup, check_tile_run),
+    'get_lowest_prob': (lowest_prob_setup, lowest_prob_run),
+}
+
+
+# best wall time of a few runs, and peak memory of one more traced run
+def run_scenario(setup, run, repeats):
+    seconds = None
+    for _ in range(repeats):
+        state = setup()
+        start = time.perf_counter()
+        peak_chains = run(state)
+        elapsed = time.perf_counter() - start
+        if seconds is None or elapsed < seconds:
+            seconds = elapsed
+
+    state = setup()
+    tracemalloc.start()
+    run(state)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'seconds': seconds,
+        'peak_chains': peak_chains,
+        'peak_bytes': peak,
+    }
+
+
+# messages for the scenarios that got slower, bigger or held more chains
+# than the baseline. Times get an extra millisecond and memory an extra
+# 64KB of slack for noise.
+def regressions(results, baseline, tolerance):
+    ret = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result['seconds'] > base['seconds'] * (1 + tolerance) + 0.001:
+            ret.append("%s: %.4fs, baseline %.4fs" % (name,
+                result['seconds'], base['seconds']))
+        if result['peak_bytes'] > \
+                base['peak_bytes'] * (1 + tolerance) + 65536:
+            ret.append("%s: %d peak bytes, baseline %d" % (name,
+                result['peak_bytes'], base['peak_bytes']))
+        if result['peak_chains'] > base['peak_chains']:
+            ret.append("%s: %d peak chains, baseline %d" % (name,
+                result['peak_chains'], base['peak_chains']))
+    return ret
+
+
+def chain_report():
+    sets = chain_memory(False)
+    masks = chain_memory(True)
+    print("chains: " + str(sets['chains']))
+    print("set chains: %.0f bytes per chain, %d peak bytes, %.3fs" %
+        (sets['bytes_per_chain'], sets['peak_bytes'], sets['seconds']))
+    print("bitmask chains: %.0f bytes per chain, %d peak bytes, %.3fs" %
+        (masks['bytes_per_chain'], masks['peak_bytes'], masks['seconds']))
+    print("saved: %.0f bytes per chain" %
+        (sets['bytes_per_chain'] - masks['bytes_per_chain']))
+
+    boards = [('tile board', Board)]
+    if np is not None:
+        boards.append(('array board', ArrayBoard))
+    for name, board_class in boards:
+        build = board_build(board_class, BUILD_SIZE)
+        print("%s %dx%d: %d peak bytes, %.3fs" % (name, BUILD_SIZE,
+            BUILD_SIZE, build['peak_bytes'], build['seconds']))
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+    'benchmark_baseline.json')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="time the solver on fixed scenarios")
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS),
+        help="scenarios to run, all by default")
+    parser.add_argument('-o', '--output', default='benchmark_results.json',
+        help="file the results are written to")
+    parser.add_argument('-b', '--baseline', default=BASELINE)
+    parser.add_argument('-t', '--tolerance', type=float, default=0.5,
+        help="allowed slowdown as a fraction of the baseline")
+    parser.add_argument('-r', '--repeats', type=int, default=3)
+    parser.add_argument('--save-baseline', action='store_true',
+        help="write the results to the baseline instead of checking")
+    parser.add_argument('--chains', action='store_true',
+        help="also compare chain modes and board builds")
+    args = parser.parse_args()
+
+    if args.chains:
+        chain_report()
+
+    results = {}
+    for name in args.scenarios:
+        setup, run = SCENARIOS[name]
+        results[name] = run_scenario(setup, run, args.repeats)
+        print("%s: %.4fs, %d peak chains, %d peak bytes" % (name,
+            results[name]['seconds'], results[name]['peak_chains'],
+            results[name]['peak_bytes']))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("no baseline at " + args.baseline)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    failed = regressions(results, baseline, args.tolerance)
+    for message in failed:
+        print("regression: " + message)
+    return 1 if len(failed) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,33 +1,243 @@
+from collections import deque, OrderedDict
+from collections.abc import Set
+from concurrent.futures import wait
+from contextlib import contextmanager
 from sortedcontainers import SortedDict
+import io
+import itertools
+import json
+import math
+import os
+import pickle
 import random
+import time
+import zlib
 
-# generate combinations and complement
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# generate combinations and complement, in the order of the combinations
+# of indices. Walks an array of indices instead of recursing.
 def comb_and_comp(lst, n):
+    size = len(lst)
     # no combinations
-    if len(lst) < n or n < 0:
+    if size < n or n < 0:
+        return
+    indices = list(range(n))
+    while True:
+        comb = []
+        comp = []
+        pos = 0
+        for idx, item in enumerate(lst):
+            if pos < n and indices[pos] == idx:
+                comb.append(item)
+                pos += 1
+            else:
+                comp.append(item)
+        yield comb, comp
+
+        # move the last index that can still move right
+        pos = n - 1
+        while pos >= 0 and indices[pos] == pos + size - n:
+            pos -= 1
+        if pos < 0:
+            return
+        indices[pos] += 1
+        for nxt in range(pos + 1, n):
+            indices[nxt] = indices[nxt - 1] + 1
+
+
+# same as comb_and_comp for a list of single bit masks. Yields the mask of
+# the combination and of its complement.
+def comb_and_comp_masks(bits, n):
+    size = len(bits)
+    if size < n or n < 0:
         return
-    # trivial 'empty' combination
-    if n == 0 or lst == []:
-        yield [], lst
-    else:
-        first, rest = lst[0], lst[1:]
-        # combinations that contain the first element
-        for in_, out in comb_and_comp(rest, n - 1):
-            yield [first] + in_, out
-        # combinations that do not contain the first element
-        for in_, out in comb_and_comp(rest, n):
-            yield in_, [first] + out
+    full = 0
+    for bit in bits:
+        full |= bit
+    indices = list(range(n))
+    # prefix[pos] is the mask of the bits at indices[:pos]
+    prefix = [0] * (n + 1)
+    for pos in range(n):
+        prefix[pos + 1] = prefix[pos] | bits[indices[pos]]
+    while True:
+        yield prefix[n], full ^ prefix[n]
+
+        pos = n - 1
+        while pos >= 0 and indices[pos] == pos + size - n:
+            pos -= 1
+        if pos < 0:
+            return
+        indices[pos] += 1
+        prefix[pos + 1] = prefix[pos] | bits[indices[pos]]
+        for nxt in range(pos + 1, n):
+            indices[nxt] = indices[nxt - 1] + 1
+            prefix[nxt + 1] = prefix[nxt] | bits[indices[nxt]]
+
+
+# find the tiles forced to be mines or safe by a list of constraints. Each
+# constraint is a (hidden tiles, mines among them) pair. Uses single
+# constraints with no mines left or only mines left, then pairs where the
+# tiles of one constraint are a subset of another's. Returns None if the
+# constraints contradict each other.
+def propagate_constraints(constraints):
+    cons = [(set(hidden), num) for hidden, num in constraints]
+    mines = set()
+    safes = set()
+    while True:
+        found_mines = set()
+        found_safes = set()
+        for hidden, num in cons:
+            if num < 0 or num > len(hidden):
+                return None
+            if len(hidden) == 0:
+                continue
+            if num == 0:
+                found_safes |= hidden
+            elif num == len(hidden):
+                found_mines |= hidden
+
+        if len(found_mines) == 0 and len(found_safes) == 0:
+            # only compare constraints that share a tile
+            tile_cons = {}
+            for idx, (hidden, _) in enumerate(cons):
+                for tile in hidden:
+                    tile_cons.setdefault(tile, []).append(idx)
+
+            for idx, (hidden, num) in enumerate(cons):
+                if len(hidden) == 0:
+                    continue
+                for other in tile_cons[next(iter(hidden))]:
+                    other_hidden, other_num = cons[other]
+                    if other == idx or not hidden <= other_hidden:
+                        continue
+                    diff = other_hidden - hidden
+                    diff_num = other_num - num
+                    if diff_num < 0 or diff_num > len(diff):
+                        return None
+                    if diff_num == 0:
+                        found_safes |= diff
+                    elif diff_num == len(diff):
+                        found_mines |= diff
+
+        if len(found_mines) == 0 and len(found_safes) == 0:
+            return mines, safes
+        if found_mines & found_safes:
+            return None
+
+        mines |= found_mines
+        safes |= found_safes
+        # constraints left with no tiles were checked above, so only the
+        # ones touched by the found tiles change
+        found = found_mines | found_safes
+        cons = [(hidden - found, num - len(hidden & found_mines))
+            if not hidden.isdisjoint(found) else (hidden, num)
+            for hidden, num in cons if len(hidden) > 0]
+
+
+# values closer than this to each other are equal after row reduction
+LINEAR_EPS = 1e-9
+
+
+# reduced row echelon form of a float matrix, keeping the last column as
+# the right hand side
+def row_reduce(matrix):
+    matrix = matrix.copy()
+    rows, cols = matrix.shape
+    pivot_row = 0
+    for col in range(cols - 1):
+        if pivot_row == rows:
+            break
+        pivot = pivot_row + int(np.argmax(np.abs(matrix[pivot_row:, col])))
+        if abs(matrix[pivot, col]) < LINEAR_EPS:
+            continue
+        matrix[[pivot_row, pivot]] = matrix[[pivot, pivot_row]]
+        matrix[pivot_row] /= matrix[pivot_row, col]
+        factors = matrix[:, col].copy()
+        factors[pivot_row] = 0
+        matrix -= np.outer(factors, matrix[pivot_row])
+        pivot_row += 1
+    return matrix
+
+
+# same as propagate_constraints, but also reasons on the constraints as 0/1
+# equations. Each row sum(c * x) = b of the row reduced matrix lies between
+# the sums of its negative and positive coefficients, and a row at either
+# bound fixes all of its tiles. Reduced rows do not show everything that
+# comparing pairs of constraints does, so both are run until neither finds
+# more. Needs numpy.
+def linear_forced(constraints):
+    cons = [(set(hidden), num) for hidden, num in constraints]
+    mines = set()
+    safes = set()
+    while True:
+        forced = propagate_constraints(cons)
+        if forced is None:
+            return None
+        found_mines, found_safes = forced
+        cons = [(hidden - found_mines - found_safes,
+            num - len(hidden & found_mines)) for hidden, num in cons]
+        cons = [(hidden, num) for hidden, num in cons if len(hidden) > 0]
+
+        tiles = list({tile for hidden, _ in cons for tile in hidden})
+        index = {tile: idx for idx, tile in enumerate(tiles)}
+        matrix = np.zeros((len(cons), len(tiles) + 1))
+        for row, (hidden, num) in enumerate(cons):
+            for tile in hidden:
+                matrix[row, index[tile]] = 1
+            matrix[row, -1] = num
+
+        for row in row_reduce(matrix):
+            coeffs = row[:-1]
+            pos = np.flatnonzero(coeffs > LINEAR_EPS)
+            neg = np.flatnonzero(coeffs < -LINEAR_EPS)
+            high = coeffs[pos].sum()
+            low = coeffs[neg].sum()
+            if row[-1] > high + LINEAR_EPS or row[-1] < low - LINEAR_EPS:
+                return None
+            if len(pos) + len(neg) == 0:
+                continue
+            if row[-1] > high - LINEAR_EPS:
+                found_mines |= {tiles[idx] for idx in pos.tolist()}
+                found_safes |= {tiles[idx] for idx in neg.tolist()}
+            elif row[-1] < low + LINEAR_EPS:
+                found_mines |= {tiles[idx] for idx in neg.tolist()}
+                found_safes |= {tiles[idx] for idx in pos.tolist()}
+
+        if found_mines & found_safes:
+            return None
+        new_mines = found_mines - mines
+        new_safes = found_safes - safes
+        if len(new_mines) == 0 and len(new_safes) == 0:
+            return mines, safes
+        mines |= found_mines
+        safes |= found_safes
+        cons = [(hidden - found_mines - found_safes,
+            num - len(hidden & found_mines)) for hidden, num in cons]
+
+
+# whether a time.perf_counter() deadline, or None for no deadline, has
+# passed
+def expired(deadline):
+    return deadline is not None and time.perf_counter() >= deadline
 
 
 class Tile:
-    def __init__(self, x, y):
+    def __init__(self, x, y, idx=None):
         self.x = x
         self.y = y
+        # fixed position of the tile in bitmask chains
+        self.idx = idx
         self.num = None
         self.neighs = set()
+        # tiles are hashed in every chain set, so only hash once
+        self.hash = hash((x, y))
 
     def __hash__(self):
-        return hash((self.x, self.y))
+        return self.hash
 
     def __eq__(self, other):
         return (self.x, self.y) == (other.x, other.y)
@@ -43,11 +253,144 @@ class Tile:
         self.num = num
 
 
+# frozen layer of a TileSet, shared between copies
+class TileLayer:
+    __slots__ = ('parent', 'added', 'removed', 'depth', 'no_removed')
+
+    def __init__(self, parent, added, removed):
+        self.parent = parent
+        self.added = added
+        self.removed = removed
+        self.depth = 1 if parent is None else parent.depth + 1
+        # no layer down to the root removes a tile, so the added sets
+        # are disjoint
+        self.no_removed = len(removed) == 0 and \
+            (parent is None or parent.no_removed)
+
+
+# layers a set may have before it is flattened again
+MAX_TILE_LAYERS = 8
+EMPTY_TILES = frozenset()
+
+
+# set of tiles stored as changes on top of frozen layers shared with the
+# sets it was copied from. Copying only freezes the changes made since the
+# last copy, so branching a chain costs the new tiles instead of the whole
+# set.
+class TileSet(Set):
+    __slots__ = ('parent', 'added', 'removed', 'size')
+
+    def __init__(self, tiles=()):
+        self.parent = None
+        # empty changes share one frozenset until they are written to
+        self.added = set(tiles) if tiles else EMPTY_TILES
+        self.removed = EMPTY_TILES
+        self.size = len(self.added)
+
+    def in_layers(self, tile):
+        layer = self.parent
+        while layer is not None:
+            if tile in layer.added:
+                return True
+            if tile in layer.removed:
+                return False
+            layer = layer.parent
+        return False
+
+    def __contains__(self, tile):
+        if tile in self.added:
+            return True
+        if tile in self.removed:
+            return False
+        return self.parent is not None and self.in_layers(tile)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        if self.parent is None:
+            return iter(self.added)
+        return self.iter_layers()
+
+    def iter_layers(self):
+        if len(self.removed) == 0 and self.parent.no_removed:
+            yield from self.added
+            layer = self.parent
+            while layer is not None:
+                yield from layer.added
+                layer = layer.parent
+            return
+
+        seen = set(self.removed)
+        for tile in self.added:
+            seen.add(tile)
+            yield tile
+        layer = self.parent
+        while layer is not None:
+            for tile in layer.added:
+                if tile not in seen:
+                    seen.add(tile)
+                    yield tile
+            seen.update(layer.removed)
+            layer = layer.parent
+
+    def add(self, tile):
+        if tile in self.removed:
+            self.removed.remove(tile)
+            self.size += 1
+        elif tile not in self.added and not self.in_layers(tile):
+            if self.added is EMPTY_TILES:
+                self.added = set()
+            self.added.add(tile)
+            self.size += 1
+
+    def update(self, tiles):
+        for tile in tiles:
+            self.add(tile)
+
+    def remove(self, tile):
+        if tile in self.added:
+            self.added.remove(tile)
+        elif tile not in self.removed and self.in_layers(tile):
+            if self.removed is EMPTY_TILES:
+                self.removed = set()
+            self.removed.add(tile)
+        else:
+            raise KeyError(tile)
+        self.size -= 1
+
+    def __getstate__(self):
+        return self.parent, self.added, self.removed, self.size
+
+    # empty changes share EMPTY_TILES again after a saved state is loaded
+    def __setstate__(self, state):
+        self.parent, added, removed, self.size = state
+        self.added = added if len(added) > 0 else EMPTY_TILES
+        self.removed = removed if len(removed) > 0 else EMPTY_TILES
+
+    def copy(self):
+        if len(self.added) > 0 or len(self.removed) > 0:
+            if self.parent is not None and \
+                    self.parent.depth >= MAX_TILE_LAYERS:
+                self.parent = TileLayer(None, frozenset(self), EMPTY_TILES)
+            else:
+                self.parent = TileLayer(self.parent, frozenset(self.added),
+                    frozenset(self.removed))
+            self.added = EMPTY_TILES
+            self.removed = EMPTY_TILES
+        ret = TileSet()
+        ret.parent = self.parent
+        ret.size = self.size
+        return ret
+
+
 class Chain:
     def __init__(self, num_mines):
         self.num_mines = num_mines
-        self.mines = set()
-        self.safe = set()
+        self.mines = TileSet()
+        self.safe = TileSet()
+        # number of mine configurations this chain stands for
+        self.weight = 1
 
     def __hash__(self):
         return hash(id(self))
@@ -59,6 +402,7 @@ class Chain:
         ret = Chain(self.num_mines)
         ret.mines = self.mines.copy()
         ret.safe = self.safe.copy()
+        ret.weight = self.weight
         return ret
 
     def update(self, new_mines, new_safes):
@@ -103,14 +447,401 @@ class Chain:
     def remove_safe_tile(self, tile):
         self.safe.remove(tile)
 
+    # chain holding the assignments of both chains
+    def merge(self, other):
+        ret = self.copy()
+        ret.update(other.mines, other.safe)
+        ret.weight = self.weight * other.weight
+        return ret
+
+    # chain holding only the assignments of the given tiles
+    def restrict(self, tiles):
+        ret = Chain(self.num_mines)
+        ret.update([tile for tile in tiles if tile in self.mines],
+            [tile for tile in tiles if tile in self.safe])
+        ret.weight = self.weight
+        return ret
+
+    # hashable description of the chain contents
+    def key(self):
+        return frozenset(self.mines), frozenset(self.safe)
+
+    # set tiles known to be mines or safe. Returns the tiles that were not
+    # set before, or None if the chain contradicts them.
+    def force(self, mines, safes):
+        new_mines = []
+        for tile in mines:
+            if tile in self.safe:
+                return None, None
+            if tile not in self.mines:
+                new_mines.append(tile)
+        new_safes = []
+        for tile in safes:
+            if tile in self.mines:
+                return None, None
+            if tile not in self.safe:
+                new_safes.append(tile)
+
+        # too many mines in this chain
+        if len(self.mines) + len(new_mines) > self.num_mines:
+            return None, None
+
+        self.update(new_mines, new_safes)
+        return new_mines, new_safes
+
+    def is_mine(self, tile):
+        return tile in self.mines
+
+    def is_safe(self, tile):
+        return tile in self.safe
+
+    def mine_count(self):
+        return len(self.mines)
+
+    def iter_mines(self):
+        return iter(self.mines)
+
+    def iter_safe(self):
+        return iter(self.safe)
+
+
+# mask with the bits of the given tiles set
+def tiles_mask(tiles):
+    mask = 0
+    for tile in tiles:
+        mask |= 1 << tile.idx
+    return mask
+
+
+# Chain storing mines and safe tiles as bitmasks over the tile indices.
+# tile_index maps an index back to its tile and is shared by all chains of
+# a board.
+class BitChain:
+    def __init__(self, num_mines, tile_index):
+        self.num_mines = num_mines
+        self.tile_index = tile_index
+        self.mines = 0
+        self.safe = 0
+        self.weight = 1
+
+    def __hash__(self):
+        return hash(id(self))
+
+    def __eq__(self, other):
+        return id(self) == id(other)
+
+    def copy(self):
+        ret = BitChain(self.num_mines, self.tile_index)
+        ret.mines = self.mines
+        ret.safe = self.safe
+        ret.weight = self.weight
+        return ret
+
+    def update(self, new_mines, new_safes):
+        self.mines |= tiles_mask(new_mines)
+        self.safe |= tiles_mask(new_safes)
+
+    def check_tile(self, tile):
+        neigh_mines = 0
+
+        hiddens = []
+        for neigh in tile.neighs:
+            bit = 1 << neigh.idx
+            if self.mines & bit:
+                neigh_mines += 1
+            elif not self.safe & bit and neigh.num is None:
+                hiddens.append(bit)
+
+        mines_remain = tile.num - neigh_mines
+
+        # too many mines in this chain
+        if mines_remain + self.mines.bit_count() > self.num_mines:
+            return None, None, []
+
+        combs = comb_and_comp_masks(hiddens, mines_remain)
+
+        upd_mines = None
+        upd_safes = None
+        new_chains = []
+        for idx, (new_mines, new_safes) in enumerate(combs):
+            if idx == 0:
+                upd_mines = new_mines
+                upd_safes = new_safes
+            else:
+                chain = self.copy()
+                chain.mines |= new_mines
+                chain.safe |= new_safes
+                new_chains.append(chain)
+
+        if upd_mines is None or upd_safes is None:
+            return None, None, []
+
+        self.mines |= upd_mines
+        self.safe |= upd_safes
+        return list(self.iter_tiles(upd_mines)), \
+            list(self.iter_tiles(upd_safes)), new_chains
+
+    def remove_safe_tile(self, tile):
+        self.safe &= ~(1 << tile.idx)
+
+    def merge(self, other):
+        ret = self.copy()
+        ret.mines |= other.mines
+        ret.safe |= other.safe
+        ret.weight = self.weight * other.weight
+        return ret
+
+    def restrict(self, tiles):
+        mask = tiles_mask(tiles)
+        ret = BitChain(self.num_mines, self.tile_index)
+        ret.mines = self.mines & mask
+        ret.safe = self.safe & mask
+        ret.weight = self.weight
+        return ret
+
+    def key(self):
+        return self.mines, self.safe
+
+    def force(self, mines, safes):
+        mine_mask = tiles_mask(mines)
+        safe_mask = tiles_mask(safes)
+        if mine_mask & self.safe or safe_mask & self.mines:
+            return None, None
+        new_mines = mine_mask & ~self.mines
+        new_safes = safe_mask & ~self.safe
+        if (self.mines | new_mines).bit_count() > self.num_mines:
+            return None, None
+
+        self.mines |= new_mines
+        self.safe |= new_safes
+        return list(self.iter_tiles(new_mines)), \
+            list(self.iter_tiles(new_safes))
+
+    def is_mine(self, tile):
+        return self.mines >> tile.idx & 1 == 1
+
+    def is_safe(self, tile):
+        return self.safe >> tile.idx & 1 == 1
+
+    def mine_count(self):
+        return self.mines.bit_count()
+
+    def iter_tiles(self, mask):
+        while mask:
+            low = mask & -mask
+            yield self.tile_index[low.bit_length() - 1]
+            mask ^= low
+
+    def iter_mines(self):
+        return self.iter_tiles(self.mines)
+
+    def iter_safe(self):
+        return self.iter_tiles(self.safe)
+
+
+STAT_KEYS = ('tiles', 'chains_created', 'chains_pruned', 'chains_removed',
+    'chains_decided', 'chains_decided_pruned', 'combinations',
+    'update_tile_seconds', 'sorted_counts_seconds', 'lowest_prob_seconds')
+TILE_STAT_KEYS = ('chains_created', 'chains_pruned', 'chains_removed',
+    'chains_decided', 'chains_decided_pruned', 'combinations',
+    'update_tile_seconds')
+
+
+# work done by a ChainMap once its stats are enabled. After every
+# update_tiles call the callback gets the stats of that call, with a record
+# for each tile in per_tile. Chains that already decide every hidden
+# neighbour of a tile are counted in chains_decided, and those of them
+# with the wrong number of mines in chains_decided_pruned, rather than in
+# chains_pruned and combinations.
+class SolverStats:
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.totals = dict.fromkeys(STAT_KEYS, 0)
+        self.peak_chains = 0
+        self.start_call()
+
+    def start_call(self):
+        self.call = dict.fromkeys(STAT_KEYS, 0)
+        self.tiles = {}
+
+    def add(self, **values):
+        for key, value in values.items():
+            self.call[key] += value
+
+    def add_tile(self, tile, **values):
+        record = self.tiles.get(tile)
+        if record is None:
+            record = dict.fromkeys(TILE_STAT_KEYS, 0)
+            record['tile'] = (tile.x, tile.y)
+            self.tiles[tile] = record
+            self.call['tiles'] += 1
+        for key, value in values.items():
+            record[key] += value
+        self.add(**values)
+
+    def chains(self, num_chains):
+        self.peak_chains = max(self.peak_chains, num_chains)
+
+    # end of an update_tiles call
+    def finish(self):
+        for key in STAT_KEYS:
+            self.totals[key] += self.call[key]
+        if self.callback is not None:
+            call = dict(self.call)
+            call['peak_chains'] = self.peak_chains
+            call['per_tile'] = list(self.tiles.values())
+            self.callback(call)
+        self.start_call()
+
+    # totals over every call so far, including the one in progress
+    def snapshot(self):
+        ret = {key: self.totals[key] + self.call[key] for key in STAT_KEYS}
+        ret['peak_chains'] = self.peak_chains
+        return ret
+
+
+# marks an entry that was missing when an UndoLog saved it
+MISSING = object()
+
+# ChainMap containers copied when a transaction starts instead of logged,
+# as they stay small between reveals
+COPIED_KEYS = ('retiring', 'pending', 'updates', 'constraints', 'frontier',
+    'components', 'tile_components', 'changed_components')
+
+
+# changes made to a ChainMap since ChainMap.begin. Chains, components and
+# the counts of tiles are saved the first time they change, and the chain
+# sets of the tiles are logged as inverse operations, so a rollback takes
+# time in the changes made rather than in the size of the board.
+class UndoLog:
+    def __init__(self, chainMap, parent=None):
+        self.parent = parent
+        self.attrs = dict(vars(chainMap))
+        self.copies = {key: getattr(chainMap, key).copy()
+            for key in COPIED_KEYS if hasattr(chainMap, key)}
+        self.ops = []
+        self.tiles = {}
+        self.chains = {}
+        self.comps = {}
+
+    # func(*args) undoes an operation
+    def add(self, func, *args):
+        self.ops.append((func, args))
+
+    def save_tile(self, chainMap, tile):
+        if tile in self.tiles:
+            return
+        prev = chainMap.prev_counts.get(tile, MISSING)
+        self.tiles[tile] = (chainMap.mine_chain_counts.get(tile, MISSING),
+            prev, prev is not MISSING and \
+                tile in chainMap.sorted_counts.get(prev, ()),
+            tile in chainMap.unused_tiles)
+
+    def save_chain(self, chain):
+        if chain in self.chains:
+            return
+        # copies of tile sets only freeze the changes since the last copy
+        if isinstance(chain, BitChain):
+            self.chains[chain] = (chain.mines, chain.safe, chain.weight)
+        else:
+            self.chains[chain] = (chain.mines.copy(), chain.safe.copy(),
+                chain.weight)
+
+    def save_component(self, comp):
+        if comp in self.comps:
+            return
+        self.comps[comp] = (set(comp.chains), set(comp.tiles),
+            set(comp.constraints), comp.counts, comp.tile_counts)
+        for chain in comp.chains:
+            self.save_chain(chain)
+
+    # keep the changes in the enclosing transaction
+    def merge_into(self, parent):
+        parent.ops.extend(self.ops)
+        for saved, parent_saved in ((self.tiles, parent.tiles),
+                (self.chains, parent.chains), (self.comps, parent.comps)):
+            for key, value in saved.items():
+                parent_saved.setdefault(key, value)
+
+    def rollback(self, chainMap):
+        for func, args in reversed(self.ops):
+            func(*args)
+        for chain, (mines, safe, weight) in self.chains.items():
+            chain.mines = mines
+            chain.safe = safe
+            chain.weight = weight
+        for comp, (chains, tiles, constraints, counts, tile_counts) in \
+                self.comps.items():
+            comp.chains = chains
+            comp.tiles = tiles
+            comp.constraints = constraints
+            comp.counts = counts
+            comp.tile_counts = tile_counts
+
+        vars(chainMap).clear()
+        vars(chainMap).update(self.attrs)
+        for key, value in self.copies.items():
+            setattr(chainMap, key, value)
+        for tile, (count, prev, in_sorted, unused) in self.tiles.items():
+            chainMap.restore_tile(tile, count, prev, in_sorted, unused)
+
 
 class ChainMap:
-    def __init__(self, tiles, num_mines):
-        self.num_tiles = sum(len(row) for row in tiles)
+    # past chain_budget chains the probabilities are estimated from
+    # num_samples sampled mine assignments instead. With an executor, such
+    # as a concurrent.futures.ProcessPoolExecutor, at least
+    # parallel_threshold chains are branched in shards on its workers.
+    # Boards that make their tiles on demand pass their own unused_tiles
+    # and no tiles, and call add_tile for each tile they make. With
+    # lookahead, ties for the safest tile are broken by the information
+    # the reveal is expected to give, see most_informative. With linear,
+    # tiles forced by the whole frontier are set in every chain before it
+    # is branched, see propagate_linear, which needs numpy.
+    def __init__(self, tiles, num_mines, compact=False, chain_budget=None,
+            num_samples=1000, unused_tiles=None, executor=None,
+            parallel_threshold=10000, lookahead=None, lookahead_budget=None,
+            linear=False):
+        if linear and np is None:
+            raise ImportError("linear needs numpy")
+        if unused_tiles is None:
+            self.num_tiles = sum(len(row) for row in tiles)
+            self.unused_tiles = TileBucket()
+        else:
+            self.num_tiles = len(unused_tiles)
+            self.unused_tiles = unused_tiles
         self.num_mines = num_mines
         self.tot_mine_cnt = 0
-        self.unused_tiles = set()
-        self.chains = {Chain(num_mines)}
+        # compact chains are bitmasks over the tile indices
+        self.tile_index = None
+        if compact:
+            self.tile_index = [None] * self.num_tiles
+            self.empty_chain = BitChain(num_mines, self.tile_index)
+        else:
+            self.empty_chain = Chain(num_mines)
+        self.chains = {self.empty_chain.copy()}
+        self.chain_weight = 1
+        self.chain_budget = chain_budget
+        self.num_samples = num_samples
+        self.sampling = False
+        self.sample_frontier = 0
+        self.estimate = None
+        self.constraints = set()
+        self.frontier = set()
+        # revealed tiles the chains have not been taken off or branched on
+        # yet, left over when a deadline passes
+        self.retiring = deque()
+        self.pending = deque()
+        self.exact = True
+        self.executor = executor
+        self.parallel_threshold = parallel_threshold
+        self.lookahead = lookahead
+        self.lookahead_budget = lookahead_budget
+        self.linear = linear
+        # (number probabilities, expected certain tiles) of the candidates
+        # scored for the last guess
+        self.lookahead_scores = {}
+        self.stats = None
+        self.undo = None
         self.mine_tiles = {}
         self.safe_tiles = {}
         self.updates = set()
@@ -120,53 +851,137 @@ class ChainMap:
         self.init_tiles_counts(tiles)
 
 
+    # keep SolverStats from now on. The chains engine counts chains and
+    # times each tile, the others only time the counts and the reveals.
+    # Chains branched on an executor are not counted.
+    def enable_stats(self, callback=None):
+        self.stats = SolverStats(callback)
+        return self.stats
+
+    def disable_stats(self):
+        self.stats = None
+
+    # start a transaction. Changes from here on are undone by rollback or
+    # kept by commit, and transactions may be nested.
+    def begin(self):
+        self.undo = UndoLog(self, self.undo)
+
+    def commit(self):
+        if self.undo is None:
+            raise RuntimeError("no transaction to commit")
+        undo = self.undo
+        self.undo = undo.parent
+        if undo.parent is not None:
+            undo.merge_into(undo.parent)
+
+    def rollback(self):
+        if self.undo is None:
+            raise RuntimeError("no transaction to roll back")
+        self.undo.rollback(self)
+
+    # keep the counts of a tile for a rollback
+    def save_tile(self, tile):
+        if self.undo is not None:
+            self.undo.save_tile(self, tile)
+
+    # put back the counts of a tile saved by UndoLog.save_tile
+    def restore_tile(self, tile, count, prev, in_sorted, unused):
+        cur = self.prev_counts.get(tile, MISSING)
+        if cur is not MISSING and tile in self.sorted_counts.get(cur, ()):
+            self.remove_count_tile(tile)
+        if prev is MISSING:
+            self.prev_counts.pop(tile, None)
+        else:
+            self.prev_counts[tile] = prev
+            if in_sorted:
+                self.sorted_counts.setdefault(prev, TileBucket()).add(tile)
+        if count is MISSING:
+            self.mine_chain_counts.pop(tile, None)
+        else:
+            self.mine_chain_counts[tile] = count
+        if unused and tile not in self.unused_tiles:
+            self.unused_tiles.add(tile)
+        elif not unused and tile in self.unused_tiles:
+            self.unused_tiles.remove(tile)
+
+    # empty a set of chains of a tile, keeping the old one for a rollback
+    def clear_tile_chains(self, tile_chains, tile):
+        if self.undo is not None:
+            self.undo.add(tile_chains.__setitem__, tile, tile_chains[tile])
+            tile_chains[tile] = set()
+        else:
+            tile_chains[tile].clear()
+
     def init_tiles_counts(self, tiles):
         for row in tiles:
             for tile in row:
-                self.mine_tiles[tile] = set()
-                self.safe_tiles[tile] = set()
-                self.mine_chain_counts[tile] = 0
-                self.unused_tiles.add(tile)
+                self.add_tile(tile)
+
+    def add_tile(self, tile):
+        self.mine_tiles[tile] = set()
+        self.safe_tiles[tile] = set()
+        self.mine_chain_counts[tile] = 0
+        if self.tile_index is not None:
+            self.tile_index[tile.idx] = tile
+        self.unused_tiles.add(tile)
 
     def add_mine_tile_chain(self, tile, chain):
+        if self.undo is not None:
+            self.undo.save_tile(self, tile)
+            self.undo.add(self.mine_tiles[tile].discard, chain)
         self.mine_tiles[tile].add(chain)
-        self.mine_chain_counts[tile] += 1
+        # revealed tiles no longer have a count
         if tile in self.mine_chain_counts:
+            self.mine_chain_counts[tile] += chain.weight
             self.updates.add(tile)
 
     def add_safe_tile_chain(self, tile, chain):
+        if self.undo is not None:
+            self.undo.add(self.safe_tiles[tile].discard, chain)
         self.safe_tiles[tile].add(chain)
         if tile in self.mine_chain_counts:
             self.updates.add(tile)
 
     def remove_mine_tile_chain(self, tile, chain):
+        if self.undo is not None:
+            self.undo.save_tile(self, tile)
+            self.undo.add(self.mine_tiles[tile].add, chain)
         self.mine_tiles[tile].remove(chain)
-        self.mine_chain_counts[tile] -= 1
+        # revealed tiles no longer have a count
         if tile in self.mine_chain_counts:
+            self.mine_chain_counts[tile] -= chain.weight
             self.updates.add(tile)
 
     def remove_safe_tile_chain(self, tile, chain):
+        if self.undo is not None:
+            self.undo.add(self.safe_tiles[tile].add, chain)
         self.safe_tiles[tile].remove(chain)
 
     def remove_chain(self, chain):
+        if self.undo is not None:
+            self.undo.add(self.chains.add, chain)
         self.chains.remove(chain)
-        self.tot_mine_cnt -= len(chain.mines)
-        for mine_tile in chain.mines:
+        self.chain_weight -= chain.weight
+        self.tot_mine_cnt -= chain.weight * chain.mine_count()
+        for mine_tile in chain.iter_mines():
             self.remove_mine_tile_chain(mine_tile, chain)
             
-        for safe_tile in chain.safe:
+        for safe_tile in chain.iter_safe():
             self.remove_safe_tile_chain(safe_tile, chain)
 
     def add_new_chain(self, chain):
+        if self.undo is not None:
+            self.undo.add(self.chains.discard, chain)
         self.chains.add(chain)
-        self.tot_mine_cnt += len(chain.mines)
-        for mine_tile in chain.mines:
+        self.chain_weight += chain.weight
+        self.tot_mine_cnt += chain.weight * chain.mine_count()
+        for mine_tile in chain.iter_mines():
             self.add_mine_tile_chain(mine_tile, chain)
-        for safe_tile in chain.safe:
+        for safe_tile in chain.iter_safe():
             self.add_safe_tile_chain(safe_tile, chain)
 
     def update_chain(self, chain, upd_mines, upd_safes):
-        self.tot_mine_cnt += len(upd_mines)
+        self.tot_mine_cnt += chain.weight * len(upd_mines)
         for mine_tile in upd_mines:
             self.add_mine_tile_chain(mine_tile, chain)
         
@@ -182,6 +997,7 @@ class ChainMap:
 
     def used_tile(self, tile):
         if tile in self.unused_tiles:
+            self.save_tile(tile)
             self.unused_tiles.remove(tile)
 
     def update_used_tiles(self, upd_mines, upd_safe):
@@ -191,22 +1007,138 @@ class ChainMap:
             self.used_tile(tile)
 
     def update_tile(self, tile):
+        self.reveal_tile(tile)
+        self.branch_pending()
+
+    # take a revealed tile out of the counts, queue it to be taken out of
+    # the chains and to be branched on if branch is set
+    def reveal_tile(self, tile, branch=True):
+        self.retire_tile(tile)
+        self.retiring.append(tile)
+        if self.chain_budget is not None:
+            self.add_constraint(tile)
+        if branch and not self.sampling:
+            self.pending.append(tile)
+
+    # revealed tiles every chain already agrees with, as each of their
+    # hidden neighbours is decided the same way in all chains with the
+    # right number of mines, e.g. zeros whose neighbours were forced safe.
+    # They need no branching.
+    def settled_tiles(self, tiles):
+        hiddens = {tile: [neigh for neigh in tile.neighs if neigh.num is None]
+            for tile in tiles}
+        known_mines, known_safes = self.known_tiles({neigh
+            for tile_hiddens in hiddens.values() for neigh in tile_hiddens})
+        return {tile for tile, tile_hiddens in hiddens.items()
+            if all(neigh in known_mines or neigh in known_safes
+                for neigh in tile_hiddens)
+            and sum(neigh in known_mines
+                for neigh in tile_hiddens) == tile.num}
+
+    # take the revealed tiles out of the chains, then branch on the queued
+    # tiles, until the deadline, a time.perf_counter() value, passes. The
+    # deadline is checked after each chain taken out and after each tile
+    # branched on, so every call does at least one step of the work. A tile
+    # is branched on in full, and a batch on the executor is waited for, so
+    # one step may run past the deadline.
+    def branch_pending(self, deadline=None):
+        while len(self.retiring) > 0:
+            if not self.retire_chains(self.retiring[0], deadline):
+                return
+            self.retiring.popleft()
+
+        while len(self.pending) > 0:
+            if self.executor is not None and \
+                    len(self.chains) >= self.parallel_threshold:
+                tiles = list(self.pending)
+                self.pending.clear()
+                self.branch_parallel(tiles)
+            else:
+                self.branch_tile(self.pending.popleft())
+            if self.stats is not None:
+                self.stats.chains(len(self.chains))
+            if self.chain_budget is not None and \
+                    len(self.chains) > self.chain_budget:
+                self.start_sampling()
+            if expired(deadline):
+                return
+
+    # take a revealed tile out of the counts. Its chains are left to
+    # retire_chains.
+    def retire_tile(self, tile):
+        self.save_tile(tile)
         self.used_tile(tile)
-
-        remove_chains = self.mine_tiles[tile].copy()
-
-        # update chains with tile we are removing
-        for safe_chain in self.safe_tiles[tile]:
-            safe_chain.remove_safe_tile(tile)
-
-        # remove tile from chain counts and sorted counts
         del self.mine_chain_counts[tile]
         self.remove_count_tile(tile)
         if tile in self.updates:
             self.updates.remove(tile)
 
+    # take a revealed tile out of the chains. Returns False if the deadline
+    # passed first, leaving the rest for the next call.
+    def retire_chains(self, tile, deadline=None):
+        if self.stats is not None:
+            start = time.perf_counter()
+        done = True
+        # chains with the tile as a mine are impossible. Remove them before
+        # they are branched on.
+        removed = 0
+        for mine_chain in list(self.mine_tiles[tile]):
+            self.remove_chain(mine_chain)
+            removed += 1
+            if expired(deadline):
+                done = False
+                break
+
+        # update chains with tile we are removing
+        if done:
+            for safe_chain in list(self.safe_tiles[tile]):
+                if self.undo is not None:
+                    self.undo.save_chain(safe_chain)
+                safe_chain.remove_safe_tile(tile)
+                self.remove_safe_tile_chain(tile, safe_chain)
+                if expired(deadline):
+                    done = False
+                    break
+
+        if self.stats is not None:
+            self.stats.add_tile(tile, chains_removed=removed,
+                update_tile_seconds=time.perf_counter() - start)
+        return done
+
+    # number of mines each chain has among the given tiles, if every chain
+    # decides all of them, or {} otherwise. Branching puts a tile in all
+    # chains or in none, so a tile is checked in constant time by whether
+    # its mine and safe chains add up to all of them.
+    def deciding_chains(self, tiles):
+        num_chains = len(self.chains)
+        if len(tiles) == 0 or any(len(self.mine_tiles[tile]) +
+                len(self.safe_tiles[tile]) != num_chains for tile in tiles):
+            return {}
+        mines = dict.fromkeys(self.chains, 0)
+        for tile in tiles:
+            for chain in self.mine_tiles[tile]:
+                mines[chain] += 1
+        return mines
+
+    # branch every chain on the number of the revealed tile. Chains that
+    # decide all of its hidden neighbours only need their mines counted.
+    def branch_tile(self, tile):
+        if self.stats is not None:
+            start = time.perf_counter()
+            checked = len(self.chains)
+        hiddens = [neigh for neigh in tile.neighs if neigh.num is None]
+        decided = self.deciding_chains(hiddens)
+        remove_chains = set()
+        decided_pruned = 0
         tot_new_chains = []
         for chain in self.chains:
+            if chain in decided:
+                if decided[chain] != tile.num:
+                    remove_chains.add(chain)
+                    decided_pruned += 1
+                continue
+            if self.undo is not None:
+                self.undo.save_chain(chain)
             upd_mines, upd_safes, new_chains = chain.check_tile(tile)
 
             # impossible chain
@@ -222,57 +1154,475 @@ class ChainMap:
         for new_chain in tot_new_chains:
             self.add_new_chain(new_chain)
 
-        # remove safe tiles
-        self.safe_tiles[tile].clear()
-
         # remove chains
         for remove in remove_chains:
             self.remove_chain(remove)
 
+        # each surviving chain that was not decided came from one
+        # combination, as did each new chain
+        if self.stats is not None:
+            pruned = len(remove_chains) - decided_pruned
+            self.stats.add_tile(tile, chains_created=len(tot_new_chains),
+                chains_pruned=pruned, chains_decided=len(decided),
+                chains_decided_pruned=decided_pruned,
+                combinations=checked - len(decided) - pruned + \
+                    len(tot_new_chains),
+                update_tile_seconds=time.perf_counter() - start)
+
+    # branch every chain on a batch of revealed tiles on the executor. The
+    # chains are sent as bitmasks over the positions of the tiles they
+    # touch, and rebuilt from the masks that come back.
+    def branch_parallel(self, tiles):
+        masks = TileMasks()
+        batch = [(tile.num, masks.mask(neigh for neigh in tile.neighs
+            if neigh.num is None)) for tile in tiles]
+        encoded = masks.chains(self.chains)
+        local = masks.tiles
+
+        num_shards = os.cpu_count() or 1
+        shard_size = -(-len(encoded) // num_shards)
+        futures = [self.executor.submit(branch_masks,
+            encoded[start:start + shard_size], batch, self.num_mines)
+            for start in range(0, len(encoded), shard_size)]
+
+        self.clear_chains(local)
+        used = 0
+        for future in futures:
+            for mines, safe, weight in future.result():
+                chain = self.empty_chain.copy()
+                chain.update(mask_tiles(local, mines), mask_tiles(local, safe))
+                chain.weight = weight
+                self.add_new_chain(chain)
+                used |= mines | safe
+        self.update_used_tiles(mask_tiles(local, used), [])
+
+    # drop every chain, given all the tiles they hold
+    def clear_chains(self, tiles):
+        for tile in tiles:
+            self.clear_tile_chains(self.mine_tiles, tile)
+            self.clear_tile_chains(self.safe_tiles, tile)
+            self.save_tile(tile)
+            if tile in self.mine_chain_counts:
+                self.mine_chain_counts[tile] = 0
+                self.updates.add(tile)
+        self.chains = set()
+        self.chain_weight = 0
+        self.tot_mine_cnt = 0
+
+    # keep the revealed tiles that still have hidden neighbours, so the
+    # chains can be dropped and rebuilt from them
+    def add_constraint(self, tile):
+        self.frontier.discard(tile)
+        hiddens = [neigh for neigh in tile.neighs if neigh.num is None]
+        if len(hiddens) > 0:
+            self.constraints.add(tile)
+            self.frontier.update(hiddens)
+            self.update_used_tiles(hiddens, [])
+
+    # drop the chains and estimate the counts by sampling instead
+    def start_sampling(self):
+        for chain in list(self.chains):
+            self.remove_chain(chain)
+        self.pending.clear()
+        self.sampling = True
+
+    # queue the constraints to enumerate the chains again. Branching on
+    # them goes back to sampling if they do not fit in the budget.
+    def rebuild_chains(self):
+        self.constraints = {tile for tile in self.constraints
+            if any(neigh.num is None for neigh in tile.neighs)}
+        for tile in self.frontier:
+            self.save_tile(tile)
+            self.mine_chain_counts[tile] = 0
+            self.updates.add(tile)
+        self.chains = {self.empty_chain.copy()}
+        self.chain_weight = 1
+        self.tot_mine_cnt = 0
+        self.sampling = False
+        self.estimate = None
+        self.pending.extend(sorted(self.constraints,
+            key=lambda tile: (tile.y, tile.x)))
+
+    # estimate the counts of each frontier component from sampled mine
+    # assignments and combine them like exact counts. Tiles forced by the
+    # constraints keep exact counts, the others are kept off 0 and 1 since
+    # samples cannot prove them.
+    def sample(self):
+        self.constraints = {tile for tile in self.constraints
+            if any(neigh.num is None for neigh in tile.neighs)}
+        constraints = [({neigh for neigh in tile.neighs if neigh.num is None},
+            tile.num) for tile in self.constraints]
+        forced = propagate_constraints(constraints)
+        forced_mines, forced_safes = forced if forced else (set(), set())
+
+        all_counts = []
+        unsampled = []
+        self.sample_ess = {}
+        for tiles, group in frontier_groups(self.frontier, self.constraints):
+            counts, tile_counts, ess = sample_solutions(tiles, group,
+                self.num_mines, self.num_samples)
+            if len(counts) == 0:
+                unsampled += tiles
+                continue
+            all_counts.append((counts, tile_counts))
+            for tile in tiles:
+                self.sample_ess[tile] = ess
+
+        total, tot_mine_cnt, tile_counts = combine_counts(all_counts,
+            self.num_mines, lambda k: 1)
+        if total == 0:
+            total = 1
+        self.sample_probs = {}
+        for tile in unsampled:
+            self.sample_probs[tile] = 0.5
+            self.sample_ess[tile] = 0
+        for tile, count in tile_counts.items():
+            self.sample_probs[tile] = count / total
+
+        for tile, prob in self.sample_probs.items():
+            if tile in forced_mines:
+                prob = 1
+            elif tile in forced_safes:
+                prob = 0
+            else:
+                floor = 1 / (2 * (self.sample_ess[tile] + 1))
+                prob = min(max(prob, floor), 1 - floor)
+            self.sample_probs[tile] = prob
+            self.save_tile(tile)
+            self.mine_chain_counts[tile] = prob
+            self.updates.add(tile)
+
+        self.chain_weight = 1
+        self.tot_mine_cnt = sum(self.sample_probs.values())
+        self.sample_count = self.num_samples * (len(all_counts) + \
+            (len(unsampled) > 0))
+
+    # sample count and 95% confidence interval for the mine probability of
+    # the tiles to reveal
+    def sample_estimate(self, reveals):
+        if len(reveals) == 0:
+            return None
+        tile = reveals[0]
+        if tile in self.sample_probs:
+            prob = self.sample_probs[tile]
+            if prob == 0 or prob == 1:
+                low, high = prob, prob
+            else:
+                low, high = wilson_interval(prob, self.sample_ess[tile])
+        # a random unused tile, bounded by the frontier estimates
+        else:
+            unused = len(self.unused_tiles)
+            prob = (self.num_mines - self.tot_mine_cnt) / unused
+            lows = highs = 0
+            for frontier_tile, tile_prob in self.sample_probs.items():
+                tile_low, tile_high = wilson_interval(tile_prob,
+                    self.sample_ess[frontier_tile])
+                lows += tile_low
+                highs += tile_high
+            low = max((self.num_mines - highs) / unused, 0)
+            high = min((self.num_mines - lows) / unused, 1)
+        return {
+            'samples': self.sample_count,
+            'effective_samples': min(self.sample_ess.values(), default=0),
+            'prob': prob,
+            'low': low,
+            'high': high,
+        }
+
+    # number of mine configurations the counts are taken over
+    def num_chains(self):
+        return self.chain_weight
+
+    # probability that a tile no chain holds is a mine
+    def unused_prob(self):
+        if len(self.unused_tiles) == 0:
+            return 1
+        num_chains = self.num_chains()
+        if num_chains == 0:
+            used_mines = 0
+        else:
+            used_mines = self.tot_mine_cnt / num_chains
+        return (self.num_mines - used_mines) / len(self.unused_tiles)
+
+    # probability that a tile is a mine, from the counts of the last
+    # update_tiles call. Revealed tiles are never mines. A tile that a
+    # timed out update_tiles call has not counted yet falls back to its
+    # current count.
+    def tile_prob(self, tile):
+        if tile.num is not None:
+            return 0
+        if tile in self.unused_tiles:
+            return self.unused_prob()
+        count = self.prev_counts.get(tile)
+        if count is None:
+            count = self.mine_chain_counts.get(tile, 0)
+        return count / self.num_chains()
+
+    # probabilities of the tiles the chains hold. Every other hidden tile
+    # has the unused_prob.
+    def probabilities(self):
+        num_chains = self.num_chains()
+        return {tile: mine_cnt / num_chains
+            for mine_cnt, tiles in self.sorted_counts.items()
+            for tile in tiles}
+
+    # the k tiles least likely to be mines as ((x, y), probability) pairs,
+    # safest first
+    def safest(self, k):
+        return list(itertools.islice(self.iter_safest(), k))
+
+    # ((x, y), probability) pairs of the hidden tiles, safest first. The
+    # unused tiles share one probability and go before the first count
+    # above it. Tiles are only visited as they are asked for, and unused
+    # tiles of boards that make their tiles on demand are not made.
+    def iter_safest(self):
+        num_chains = self.num_chains()
+        unused_prob = self.unused_prob()
+        unused_done = False
+        for mine_cnt, tiles in self.sorted_counts.items():
+            prob = mine_cnt / num_chains
+            if not unused_done and prob > unused_prob:
+                yield from ((coord, unused_prob)
+                    for coord in self.unused_coords())
+                unused_done = True
+            yield from (((tile.x, tile.y), prob) for tile in tiles)
+        if not unused_done:
+            yield from ((coord, unused_prob)
+                for coord in self.unused_coords())
+
+    # (x, y) of each unused tile
+    def unused_coords(self):
+        if isinstance(self.unused_tiles, UnusedTiles):
+            return self.unused_tiles.coords()
+        return ((tile.x, tile.y) for tile in self.unused_tiles)
+
     def get_lowest_prob(self):
         if len(self.sorted_counts) == 0:
             return []
         
         mine_cnt, tiles = self.sorted_counts.peekitem(index=0)
+        num_chains = self.num_chains()
         if mine_cnt == 0:
             return list(tiles)
         else:
             # calculate probability of random tile versus lowest
-            if len(self.chains) == 0:
-                used_mines = 0
-            else:
-                used_mines = self.tot_mine_cnt / len(self.chains)
-            unused_mines = self.num_mines - used_mines
+            unused_prob = self.unused_prob()
 
             # reveal all unused tiles if we know there are no mines
-            if unused_mines == 0 and len(self.unused_tiles) > 0:
+            if unused_prob == 0:
                 return list(self.unused_tiles)
 
-            if len(self.unused_tiles) == 0:
-                unused_prob = 1
-            else:
-                unused_prob = unused_mines / len(self.unused_tiles)
-
             # no mines left
-            if mine_cnt == len(self.chains) and unused_prob == 1:
+            if mine_cnt == num_chains and unused_prob == 1:
                 return []
 
             # lowest probability in the chain
-            low_prob = mine_cnt / len(self.chains)
+            low_prob = mine_cnt / num_chains
 
             # probability of lowest is smaller than a random choice
-            if low_prob <= unused_prob:                
-                return [random.choice(list(tiles))]
+            if low_prob <= unused_prob:
+                if self.lookahead is not None and not self.sampling:
+                    return [self.most_informative(tiles)]
+                return [tiles.choice()]
             # random choice is less likely
             else:
-                return [random.choice(list(self.unused_tiles))]
-
-    def update_tiles(self, tiles):
+                return [self.random_unused()]
+
+    # the tile expected to make the most tiles certain once revealed, out
+    # of at most lookahead of the given tiles. Candidates are scored on the
+    # executor if there is one, and those not scored within
+    # lookahead_budget seconds are left out. Boards that make their tiles
+    # on demand only count the neighbours they have made.
+    def most_informative(self, tiles):
+        candidates = list(tiles)
+        if len(candidates) > self.lookahead:
+            candidates = random.sample(candidates, self.lookahead)
+        self.lookahead_scores = {}
+        if len(candidates) == 1:
+            return candidates[0]
+
+        masks = TileMasks()
+        chains = masks.chains(self.chains)
+        args = []
+        for tile in candidates:
+            hiddens = [neigh for neigh in tile.neighs if neigh.num is None]
+            outside = [neigh for neigh in hiddens
+                if neigh in self.unused_tiles]
+            args.append((chains, masks.mask([tile]), masks.mask(neigh
+                for neigh in hiddens if neigh not in self.unused_tiles),
+                len(outside), self.num_mines, len(self.unused_tiles)))
+
+        deadline = None
+        if self.lookahead_budget is not None:
+            deadline = time.perf_counter() + self.lookahead_budget
+        if self.executor is not None:
+            futures = {self.executor.submit(reveal_outcomes, *arg): tile
+                for tile, arg in zip(candidates, args)}
+            done, not_done = wait(futures, timeout=self.lookahead_budget)
+            for future in not_done:
+                future.cancel()
+            for future in done:
+                self.lookahead_scores[futures[future]] = future.result()
+        else:
+            for tile, arg in zip(candidates, args):
+                if deadline is not None and len(self.lookahead_scores) > 0 \
+                        and time.perf_counter() >= deadline:
+                    break
+                self.lookahead_scores[tile] = reveal_outcomes(*arg)
+
+        if len(self.lookahead_scores) == 0:
+            return random.choice(candidates)
+        best = max(expected for _, expected in self.lookahead_scores.values())
+        return random.choice([tile for tile, (_, expected)
+            in self.lookahead_scores.items() if expected == best])
+
+    def random_unused(self):
+        return self.unused_tiles.choice()
+
+    # tiles that every chain decides the same way
+    def known_tiles(self, tiles):
+        mines = set()
+        safes = set()
+        num_chains = len(self.chains)
+        if num_chains == 0:
+            return mines, safes
         for tile in tiles:
-            self.update_tile(tile)
-
+            if len(self.mine_tiles[tile]) == num_chains:
+                mines.add(tile)
+            elif len(self.safe_tiles[tile]) == num_chains:
+                safes.add(tile)
+        return mines, safes
+
+    # mines and safe tiles forced by the revealed tiles on their own
+    def propagate(self, tiles):
+        hiddens = {neigh for tile in tiles for neigh in tile.neighs
+            if neigh.num is None}
+        known_mines, known_safes = self.known_tiles(hiddens)
+        constraints = [self.unknown_constraint(tile, known_mines, known_safes)
+            for tile in tiles]
+
+        # contradictions are left for the branching to find
+        forced = propagate_constraints(constraints)
+        if forced is None:
+            return set(), set()
+        return forced
+
+    # hidden neighbours of a revealed tile that are not known, and the
+    # number of mines among them
+    def unknown_constraint(self, tile, known_mines, known_safes):
+        hidden = set()
+        num = tile.num
+        for neigh in tile.neighs:
+            if neigh.num is not None or neigh in known_safes:
+                continue
+            if neigh in known_mines:
+                num -= 1
+            else:
+                hidden.add(neigh)
+        return hidden, num
+
+    # mines and safe tiles forced by all the constraints of the frontier
+    # groups the revealed tiles are in, see linear_forced
+    def propagate_linear(self, tiles):
+        self.constraints.update(tiles)
+        self.constraints = {tile for tile in self.constraints
+            if any(neigh.num is None for neigh in tile.neighs)}
+        hiddens = {neigh for tile in self.constraints for neigh in tile.neighs
+            if neigh.num is None}
+        known_mines, known_safes = self.known_tiles(hiddens)
+
+        batch = set(tiles)
+        mines = set()
+        safes = set()
+        for _, group in frontier_groups(hiddens, self.constraints):
+            if batch.isdisjoint(group):
+                continue
+            forced = linear_forced([self.unknown_constraint(tile,
+                known_mines, known_safes) for tile in group])
+            if forced is not None:
+                mines |= forced[0]
+                safes |= forced[1]
+        return mines, safes
+
+    # set forced tiles in every chain, removing the chains they contradict
+    def apply_forced(self, mines, safes):
+        if len(mines) == 0 and len(safes) == 0:
+            return
+        remove_chains = []
+        for chain in self.chains:
+            if self.undo is not None:
+                self.undo.save_chain(chain)
+            new_mines, new_safes = chain.force(mines, safes)
+            if new_mines is None or new_safes is None:
+                remove_chains.append(chain)
+            else:
+                self.update_chain(chain, new_mines, new_safes)
+        for remove in remove_chains:
+            self.remove_chain(remove)
+        self.update_used_tiles(mines, safes)
+        if self.stats is not None:
+            self.stats.add(chains_pruned=len(remove_chains))
+
+    # past the deadline the counts leave out the work still queued, and
+    # exact is False until a later call has done it. The work is stopped as
+    # told in branch_pending. Forcing what the revealed tiles imply always
+    # runs, as one pass over the chains that keeps them from growing, and
+    # so do sampling and sorting the counts of the tiles that changed. The
+    # linear pass is skipped once the deadline has passed.
+    def update_tiles(self, tiles, deadline=None):
+        # settle what the revealed tiles force before branching on the rest
+        was_sampling = self.sampling
+        settled = set()
+        if not self.sampling:
+            # zeros inside a flood filled region carry no constraint
+            settled = {tile for tile in tiles if tile.num == 0 and
+                all(neigh.num is not None for neigh in tile.neighs)}
+            frontier = [tile for tile in tiles if tile not in settled]
+            self.apply_forced(*self.propagate(frontier))
+            if self.linear and not expired(deadline):
+                self.apply_forced(*self.propagate_linear(frontier))
+            settled |= self.settled_tiles(frontier)
+        for tile in tiles:
+            self.reveal_tile(tile, tile not in settled)
+
+        # go back to exact chains once the frontier is smaller than the
+        # last one they outgrew the budget on
+        if was_sampling and len(self.frontier) < self.sample_frontier:
+            self.rebuild_chains()
+        self.branch_pending(deadline)
+        self.exact = len(self.retiring) == 0 and len(self.pending) == 0 \
+            and not self.sampling
+
+        if self.sampling:
+            self.sample_frontier = len(self.frontier)
+            self.sample()
+
+        reveals = self.sorted_reveals()
+        if self.sampling:
+            self.estimate = self.sample_estimate(reveals)
+        if self.stats is not None:
+            self.stats.finish()
+        return reveals
+
+    # update the sorted counts and pick the tiles to reveal, timing both
+    # when stats are enabled
+    def sorted_reveals(self):
+        if self.stats is None:
+            self.update_sorted_counts()
+            return self.get_lowest_prob()
+
+        start = time.perf_counter()
+        self.update_sorted_counts()
+        counted = time.perf_counter()
+        reveals = self.get_lowest_prob()
+        self.stats.add(sorted_counts_seconds=counted - start,
+            lowest_prob_seconds=time.perf_counter() - counted)
+        return reveals
+
+    def update_sorted_counts(self):
         # update the ordered dict
         for tile in self.updates:
+            self.save_tile(tile)
             # remove previous count
             self.remove_count_tile(tile)
 
@@ -280,14 +1630,1047 @@ class ChainMap:
 
             # add new count
             if count not in self.sorted_counts:
-                self.sorted_counts[count] = set()
+                self.sorted_counts[count] = TileBucket()
             self.sorted_counts[count].add(tile)
 
             self.prev_counts[tile] = count
         
         self.updates.clear()
 
-        return self.get_lowest_prob()
+
+# bitmasks over the positions of the tiles they hold, for sending chains to
+# worker processes. tiles lists the tile at each position.
+class TileMasks:
+    def __init__(self):
+        self.tiles = []
+        self.positions = {}
+
+    def mask(self, tiles):
+        mask = 0
+        for tile in tiles:
+            if tile not in self.positions:
+                self.positions[tile] = len(self.tiles)
+                self.tiles.append(tile)
+            mask |= 1 << self.positions[tile]
+        return mask
+
+    # chains as (mines, safe, weight) masks
+    def chains(self, chains):
+        return [(self.mask(chain.iter_mines()), self.mask(chain.iter_safe()),
+            chain.weight) for chain in chains]
+
+
+# tiles at the set bits of a mask over positions in local
+def mask_tiles(local, mask):
+    ret = []
+    while mask:
+        low = mask & -mask
+        ret.append(local[low.bit_length() - 1])
+        mask ^= low
+    return ret
+
+
+# branch chains given as (mines, safe, weight) bitmasks on a batch of
+# (number, hidden neighbours mask) pairs, the same way as
+# Chain.check_tile. Returns the chains that agree with every number. Kept
+# at module level so worker processes can run it.
+def branch_masks(chains, batch, num_mines):
+    for num, neigh_mask in batch:
+        new_chains = []
+        for mines, safe, weight in chains:
+            remain = num - (mines & neigh_mask).bit_count()
+            # too many mines in this chain
+            if remain + mines.bit_count() > num_mines:
+                continue
+            hidden = neigh_mask & ~mines & ~safe
+            bits = []
+            while hidden:
+                low = hidden & -hidden
+                bits.append(low)
+                hidden ^= low
+            for new_mines, new_safes in comb_and_comp_masks(bits, remain):
+                new_chains.append((mines | new_mines, safe | new_safes,
+                    weight))
+        chains = new_chains
+    return chains
+
+
+# what revealing a tile would show, from chains given as (mines, safe,
+# weight) masks like branch_masks. tile and neighs are the masks of the
+# tile and of its hidden neighbours in the chains. Its num_outside other
+# hidden neighbours are in no chain, and are mines at the density of the
+# mines each chain leaves to the num_unused unused tiles. Returns the
+# probability of each number given that the tile is safe, and the
+# expected number of tiles that number would make certain.
+def reveal_outcomes(chains, tile, neighs, num_outside, num_mines,
+        num_unused):
+    known_mines = known_safe = -1
+    for mines, safe, _ in chains:
+        known_mines &= mines
+        known_safe &= safe
+    known = known_mines | known_safe | tile
+
+    weights = {}
+    # mines and safe tiles every chain showing a number agrees on, and
+    # whether the tiles outside are all safe or all mines in each of them
+    agree = {}
+    for mines, safe, weight in chains:
+        if mines & tile:
+            continue
+        found = (mines & neighs).bit_count()
+        density = 0
+        if num_unused > 0:
+            density = min(max((num_mines - mines.bit_count()) / num_unused,
+                0), 1)
+        for outside in range(num_outside + 1):
+            prob = math.comb(num_outside, outside) * density ** outside * \
+                (1 - density) ** (num_outside - outside)
+            if prob == 0:
+                continue
+            num = found + outside
+            weights[num] = weights.get(num, 0) + weight * prob
+            all_safe = outside == 0
+            all_mines = outside == num_outside
+            if num in agree:
+                agree_mines, agree_safe, was_safe, were_mines = agree[num]
+                agree[num] = (agree_mines & mines, agree_safe & safe,
+                    was_safe and all_safe, were_mines and all_mines)
+            else:
+                agree[num] = (mines, safe, all_safe, all_mines)
+
+    total = sum(weights.values())
+    probs = {}
+    expected = 0
+    for num, weight in weights.items():
+        agree_mines, agree_safe, all_safe, all_mines = agree[num]
+        certain = ((agree_mines | agree_safe) & ~known).bit_count()
+        if all_safe or all_mines:
+            certain += num_outside
+        probs[num] = weight / total
+        expected += probs[num] * certain
+    return probs, expected
+
+
+# mine counts of a list of components combined by the number of mines
+# they use, truncated at max_mines
+def convolve_counts(counts_list, max_mines):
+    ret = {0: 1}
+    for counts in counts_list:
+        new = {}
+        for k1, c1 in ret.items():
+            for k2, c2 in counts.items():
+                if k1 + k2 <= max_mines:
+                    new[k1 + k2] = new.get(k1 + k2, 0) + c1 * c2
+        ret = new
+    return ret
+
+
+# counts divided by the largest of them, with the log of that factor, so
+# counts too big for a float can still be weighted
+def relative_counts(counts):
+    top = max(counts.values(), default=0) or 1
+    return {k: cnt / top for k, cnt in counts.items()}, math.log(top)
+
+
+# convolve_counts of (counts, log factor) pairs from relative_counts,
+# rescaled after each convolution so that any number of components can be
+# combined. Returns the combined pair. exact leaves the counts as they are,
+# with a log factor of 0.
+def convolve_relative(relative_list, max_mines, exact=False):
+    ret, log = {0: 1}, 0
+    for counts, count_log in relative_list:
+        ret = convolve_counts([ret, counts], max_mines)
+        log += count_log
+        if not exact:
+            ret, scale_log = relative_counts(ret)
+            log += scale_log
+    return ret, log
+
+
+# combine the counts of independent components. all_counts holds
+# (counts, tile_counts) pairs keyed by the number of mines, and weight(k)
+# weights a configuration of all components using k mines. Returns the
+# total weight, the weighted number of mines and the weight of each tile
+# being a mine, all up to a common factor. Counts are kept relative, see
+# relative_counts, since their products overflow floats on large boards,
+# unless exact is set for integer counts with integer weights.
+def combine_counts(all_counts, max_mines, weight, exact=False):
+    relative = []
+    for counts, tile_counts in all_counts:
+        if exact:
+            relative.append((counts, tile_counts, 0))
+            continue
+        top = max(counts.values(), default=0) or 1
+        relative.append(({k: cnt / top for k, cnt in counts.items()},
+            {tile: {k: cnt / top for k, cnt in tile_cnt.items()}
+                for tile, tile_cnt in tile_counts.items()},
+            math.log(top)))
+
+    # prefix[i] combines relative[:i], suffix[i] combines relative[i:]
+    prefix = [({0: 1}, 0)]
+    for counts, _, log in relative:
+        prefix.append(convolve_relative([prefix[-1], (counts, log)],
+            max_mines, exact))
+    suffix = [({0: 1}, 0)]
+    for counts, _, log in reversed(relative):
+        suffix.append(convolve_relative([suffix[-1], (counts, log)],
+            max_mines, exact))
+    suffix.reverse()
+
+    combined, tot_log = prefix[-1]
+    total = 0
+    for k, cnt in combined.items():
+        total += cnt * weight(k)
+
+    tot_mine_cnt = 0
+    ret = {}
+    for idx, (counts, tile_counts, log) in enumerate(relative):
+        others, others_log = convolve_relative([prefix[idx],
+            suffix[idx + 1]], max_mines, exact)
+
+        # weight of the other components given k mines in this one
+        other_weights = {}
+        for k in counts:
+            other_weights[k] = 0
+            for j, cnt in others.items():
+                if k + j <= max_mines:
+                    other_weights[k] += cnt * weight(k + j)
+        # brings this component and the others to the scale of the total
+        if not exact:
+            scale = math.exp(log + others_log - tot_log)
+            for k in other_weights:
+                other_weights[k] *= scale
+
+        for k, cnt in counts.items():
+            tot_mine_cnt += k * cnt * other_weights[k]
+
+        for tile, tile_cnt in tile_counts.items():
+            count = 0
+            for k, cnt in tile_cnt.items():
+                count += cnt * other_weights[k]
+            ret[tile] = count
+
+    return total, tot_mine_cnt, ret
+
+
+# groups of hidden tiles connected through the revealed tiles next to
+# them. Returns a list of (tiles, constraints) pairs. Revealed tiles with no
+# hidden neighbour left are dropped.
+def frontier_groups(tiles, constraints):
+    parent = {tile: tile for tile in tiles}
+
+    def find(tile):
+        while parent[tile] != tile:
+            parent[tile] = parent[parent[tile]]
+            tile = parent[tile]
+        return tile
+
+    tile_constraints = []
+    for constraint in constraints:
+        hiddens = [neigh for neigh in constraint.neighs if neigh in parent]
+        if len(hiddens) == 0:
+            continue
+        root = find(hiddens[0])
+        for neigh in hiddens[1:]:
+            parent[find(neigh)] = root
+        tile_constraints.append((hiddens[0], constraint))
+
+    groups = {}
+    for tile in tiles:
+        groups.setdefault(find(tile), (set(), set()))[0].add(tile)
+    for tile, constraint in tile_constraints:
+        groups[find(tile)][1].add(constraint)
+    return list(groups.values())
+
+
+# set of chains over tiles that share no constraint with other components
+class Component:
+    def __init__(self, empty_chain, chains=None):
+        self.empty_chain = empty_chain
+        if chains is None:
+            chains = [empty_chain.copy()]
+        self.chains = set(chains)
+        self.tiles = set()
+        self.constraints = set()
+        self.counts = None
+        self.tile_counts = None
+
+    def __repr__(self):
+        return "Component " + str(len(self.tiles)) + " tiles: " + \
+            str(len(self.chains)) + " chains"
+
+    # forget cached counts after the chains change
+    def changed(self):
+        self.counts = None
+        self.tile_counts = None
+
+    # drop a tile that has been revealed as safe
+    def remove_tile(self, tile):
+        self.tiles.discard(tile)
+        remove_chains = []
+        for chain in self.chains:
+            if chain.is_mine(tile):
+                remove_chains.append(chain)
+            elif chain.is_safe(tile):
+                chain.remove_safe_tile(tile)
+        for chain in remove_chains:
+            self.chains.remove(chain)
+        self.changed()
+
+    def check_tile(self, tile):
+        self.constraints.add(tile)
+        new_tiles = set()
+        remove_chains = []
+        tot_new_chains = []
+        for chain in self.chains:
+            upd_mines, upd_safes, new_chains = chain.check_tile(tile)
+            if upd_mines is None or upd_safes is None:
+                remove_chains.append(chain)
+            else:
+                new_tiles.update(upd_mines)
+                new_tiles.update(upd_safes)
+                tot_new_chains += new_chains
+
+        for chain in remove_chains:
+            self.chains.remove(chain)
+        self.chains.update(tot_new_chains)
+        self.tiles.update(new_tiles)
+        self.changed()
+        return new_tiles
+
+    def apply_forced(self, mines, safes):
+        remove_chains = []
+        for chain in self.chains:
+            new_mines, new_safes = chain.force(mines, safes)
+            if new_mines is None or new_safes is None:
+                remove_chains.append(chain)
+        for chain in remove_chains:
+            self.chains.remove(chain)
+        self.tiles.update(mines)
+        self.tiles.update(safes)
+        self.changed()
+
+    # number of chains and per tile mine chains keyed by the mine count
+    def get_counts(self):
+        if self.counts is None:
+            self.counts = {}
+            self.tile_counts = {tile: {} for tile in self.tiles}
+            for chain in self.chains:
+                k = chain.mine_count()
+                self.counts[k] = self.counts.get(k, 0) + chain.weight
+                for tile in chain.iter_mines():
+                    tile_cnt = self.tile_counts[tile]
+                    tile_cnt[k] = tile_cnt.get(k, 0) + chain.weight
+        return self.counts, self.tile_counts
+
+    # split into independent components. Returns [self] if the chains
+    # do not factor over the groups of tiles.
+    def split(self):
+        groups = frontier_groups(self.tiles, self.constraints)
+        if len(groups) <= 1 or len(self.chains) == 0:
+            return [self]
+
+        total = sum(chain.weight for chain in self.chains)
+        chain_keys = {chain: [] for chain in self.chains}
+        projections = []
+        size = 1
+        for group, _ in groups:
+            projected = {}
+            for chain in self.chains:
+                restricted = chain.restrict(group)
+                key = restricted.key()
+                chain_keys[chain].append(key)
+                if key in projected:
+                    projected[key].weight += chain.weight
+                else:
+                    projected[key] = restricted
+            projections.append(projected)
+            size *= len(projected)
+
+        # the global mine limit can couple otherwise separate groups
+        if size != len(self.chains):
+            return [self]
+        for chain, keys in chain_keys.items():
+            weight = 1
+            for projected, key in zip(projections, keys):
+                weight *= projected[key].weight
+            if chain.weight * total ** (len(groups) - 1) != weight:
+                return [self]
+
+        ret = []
+        for (group, constraints), projected in zip(groups, projections):
+            # only the ratios of the weights in a component matter
+            divisor = math.gcd(*(chain.weight for chain in projected.values()))
+            for chain in projected.values():
+                chain.weight //= divisor
+            comp = Component(self.empty_chain, projected.values())
+            comp.tiles = group
+            comp.constraints = constraints
+            ret.append(comp)
+        return ret
+
+
+# merge components into one by taking the product of their chains
+def merge_components(comps, empty_chain):
+    num_mines = empty_chain.num_mines
+    ret = Component(empty_chain)
+    for comp in comps:
+        chains = set()
+        for chain in ret.chains:
+            for other in comp.chains:
+                if chain.mine_count() + other.mine_count() <= num_mines:
+                    chains.add(chain.merge(other))
+        ret.chains = chains
+        ret.tiles.update(comp.tiles)
+        ret.constraints.update(comp.constraints)
+    return ret
+
+
+# ChainMap keeping a separate set of chains for each independent part of
+# the frontier. Counts are combined across components by mine totals.
+class ComponentChainMap(ChainMap):
+    def __init__(self, tiles, num_mines, compact=False, unused_tiles=None):
+        super().__init__(tiles, num_mines, compact,
+            unused_tiles=unused_tiles)
+        self.chains = set()
+        self.components = set()
+        self.tile_components = {}
+        self.changed_components = set()
+        self.tot_chains = 1
+
+    def num_chains(self):
+        return self.tot_chains
+
+    def add_component(self, comp):
+        self.components.add(comp)
+        for tile in comp.tiles:
+            self.tile_components[tile] = comp
+        self.changed_components.add(comp)
+
+    def remove_component(self, comp):
+        self.components.remove(comp)
+        self.changed_components.discard(comp)
+
+    # keep a component and its chains for a rollback
+    def save_component(self, comp):
+        if self.undo is not None:
+            self.undo.save_component(comp)
+
+    def update_tile(self, tile):
+        self.save_tile(tile)
+        self.used_tile(tile)
+
+        # tile is no longer part of the frontier
+        comp = self.tile_components.pop(tile, None)
+        if comp is not None:
+            self.save_component(comp)
+            comp.remove_tile(tile)
+            self.changed_components.add(comp)
+
+        del self.mine_chain_counts[tile]
+        self.remove_count_tile(tile)
+        if tile in self.prev_counts:
+            del self.prev_counts[tile]
+        if tile in self.updates:
+            self.updates.remove(tile)
+
+        hiddens = [neigh for neigh in tile.neighs if neigh.num is None]
+        if len(hiddens) == 0:
+            return
+
+        # the tile connects every component next to it
+        touched = {self.tile_components[neigh] for neigh in hiddens
+            if neigh in self.tile_components}
+        if len(touched) == 1:
+            merged = touched.pop()
+            self.save_component(merged)
+        else:
+            for touched_comp in touched:
+                self.remove_component(touched_comp)
+            merged = merge_components(touched, self.empty_chain)
+            self.add_component(merged)
+
+        new_tiles = merged.check_tile(tile)
+        self.update_used_tiles(new_tiles, [])
+        for new_tile in new_tiles:
+            self.tile_components[new_tile] = merged
+        self.changed_components.add(merged)
+
+    def known_tiles(self, tiles):
+        mines = set()
+        for tile in tiles:
+            comp = self.tile_components.get(tile)
+            if comp is None or len(comp.chains) == 0:
+                continue
+            # counts are weighted, so they are compared with the total
+            # weight rather than the number of chains
+            counts, tile_counts = comp.get_counts()
+            if sum(tile_counts[tile].values()) == sum(counts.values()):
+                mines.add(tile)
+        return mines, set()
+
+    def apply_forced(self, mines, safes):
+        comp_tiles = {}
+        for tile in mines:
+            comp = self.tile_components.get(tile)
+            comp_tiles.setdefault(comp, ([], []))[0].append(tile)
+        for tile in safes:
+            comp = self.tile_components.get(tile)
+            comp_tiles.setdefault(comp, ([], []))[1].append(tile)
+
+        for comp, (comp_mines, comp_safes) in comp_tiles.items():
+            # tiles outside the frontier start a component of their own
+            if comp is None:
+                comp = Component(self.empty_chain)
+                comp.apply_forced(comp_mines, comp_safes)
+                self.add_component(comp)
+                self.update_used_tiles(comp_mines, comp_safes)
+            else:
+                self.save_component(comp)
+                comp.apply_forced(comp_mines, comp_safes)
+                self.changed_components.add(comp)
+
+    def split_components(self):
+        for comp in self.changed_components.copy():
+            if comp not in self.components:
+                continue
+            self.save_component(comp)
+            parts = comp.split()
+            if len(parts) > 1:
+                self.remove_component(comp)
+                for part in parts:
+                    self.add_component(part)
+        self.changed_components.clear()
+
+    # combine per component counts without taking the product of chains
+    def recount(self):
+        all_counts = [comp.get_counts() for comp in self.components]
+        self.tot_chains, self.tot_mine_cnt, tile_counts = combine_counts(
+            all_counts, self.num_mines, lambda k: 1, exact=True)
+        for tile, count in tile_counts.items():
+            self.save_tile(tile)
+            self.mine_chain_counts[tile] = count
+            self.updates.add(tile)
+
+    # components are always solved in full, so the deadline is not used
+    def update_tiles(self, tiles, deadline=None):
+        self.apply_forced(*self.propagate(tiles))
+        for tile in tiles:
+            self.update_tile(tile)
+
+        self.split_components()
+        self.recount()
+        reveals = self.sorted_reveals()
+        if self.stats is not None:
+            self.stats.finish()
+        return reveals
+
+
+# order tiles so that constraints are completed as early as possible.
+# Returns the order, the remaining mines and unassigned tiles of each
+# constraint and the constraints of each tile by position in the order.
+def order_constraints(tiles, constraints):
+    order = []
+    seen = set()
+    for constraint in constraints:
+        for neigh in constraint.neighs:
+            if neigh in tiles and neigh not in seen:
+                seen.add(neigh)
+                order.append(neigh)
+    for tile in tiles:
+        if tile not in seen:
+            seen.add(tile)
+            order.append(tile)
+    index = {tile: idx for idx, tile in enumerate(order)}
+
+    remain = []
+    unassigned = []
+    tile_constraints = [[] for _ in order]
+    for c_idx, constraint in enumerate(constraints):
+        hiddens = [index[neigh] for neigh in constraint.neighs
+            if neigh in index]
+        remain.append(constraint.num)
+        unassigned.append(len(hiddens))
+        for idx in hiddens:
+            tile_constraints[idx].append(c_idx)
+    return order, remain, unassigned, tile_constraints
+
+
+# count the mine assignments of the tiles that agree with the revealed
+# constraints, grouped by the number of mines. Only counts are kept, the
+# assignments themselves are never stored.
+def count_solutions(tiles, constraints, max_mines):
+    order, remain, unassigned, tile_constraints = order_constraints(tiles,
+        constraints)
+
+    counts = {}
+    tile_counts = [{} for _ in order]
+    mine_stack = []
+
+    # depth first over the tiles with an explicit stack, since long walls
+    # go deeper than the recursion limit. Each entry is a tile index and
+    # the step to take next: 0 on entering the tile, 1 after trying it as
+    # safe, 2 after trying it as a mine.
+    stack = [(0, 0)]
+    while len(stack) > 0:
+        idx, step = stack.pop()
+        mines = len(mine_stack)
+        if idx == len(order):
+            counts[mines] = counts.get(mines, 0) + 1
+            for mine_idx in mine_stack:
+                tile_cnt = tile_counts[mine_idx]
+                tile_cnt[mines] = tile_cnt.get(mines, 0) + 1
+            continue
+
+        cons = tile_constraints[idx]
+        if step == 0:
+            for c_idx in cons:
+                unassigned[c_idx] -= 1
+            stack.append((idx, 1))
+            # tile is safe
+            if all(remain[c_idx] <= unassigned[c_idx] for c_idx in cons):
+                stack.append((idx + 1, 0))
+        elif step == 1:
+            # tile is a mine
+            if mines < max_mines and \
+                    all(0 < remain[c_idx] <= unassigned[c_idx] + 1
+                        for c_idx in cons):
+                for c_idx in cons:
+                    remain[c_idx] -= 1
+                mine_stack.append(idx)
+                stack.append((idx, 2))
+                stack.append((idx + 1, 0))
+            else:
+                for c_idx in cons:
+                    unassigned[c_idx] += 1
+        else:
+            mine_stack.pop()
+            for c_idx in cons:
+                remain[c_idx] += 1
+                unassigned[c_idx] += 1
+
+    return counts, {tile: tile_counts[idx] for idx, tile in enumerate(order)}
+
+
+# constraints ordered along a sweep of the frontier, breadth first from a
+# constraint at one end, so the constraints started but not finished at
+# any point stay few even on long walls
+def sweep_order(constraints):
+    hiddens = {constraint: {neigh for neigh in constraint.neighs
+        if neigh.num is None} for constraint in constraints}
+    tile_constraints = {}
+    for constraint, hidden in hiddens.items():
+        for tile in hidden:
+            tile_constraints.setdefault(tile, []).append(constraint)
+
+    def breadth_first(start):
+        order = [start]
+        seen = {start}
+        for constraint in order:
+            for tile in hiddens[constraint]:
+                for other in tile_constraints[tile]:
+                    if other not in seen:
+                        seen.add(other)
+                        order.append(other)
+        return order
+
+    # the last constraint reached from any start is at an end
+    order = []
+    seen = set()
+    for constraint in sorted(constraints, key=lambda tile: (tile.x, tile.y)):
+        if constraint not in seen:
+            part = breadth_first(breadth_first(constraint)[-1])
+            seen.update(part)
+            order += part
+    return order
+
+
+# same as count_solutions, but by dynamic programming over the tiles in
+# sweep order. The state after each tile is the number of mines still
+# needed by each constraint that has tiles on both sides of it, so the
+# work grows with the number of such states rather than the number of
+# solutions. Counts of each state by mine total are swept forward, and the
+# ways of finishing from each state backward, to count each tile.
+def sweep_solutions(tiles, constraints, max_mines):
+    order, remain, unassigned, tile_constraints = order_constraints(tiles,
+        sweep_order(constraints))
+    num_tiles = len(order)
+    # constraints of each tile with the tiles they have left after it
+    tile_left = [[] for _ in order]
+    for idx, cons in enumerate(tile_constraints):
+        for c_idx in cons:
+            unassigned[c_idx] -= 1
+            tile_left[idx].append((c_idx, unassigned[c_idx]))
+    # constraints started but not finished after each tile
+    started = set()
+    active = []
+    for idx in range(num_tiles):
+        started.update(tile_constraints[idx])
+        active.append(tuple(sorted(c_idx for c_idx in started
+            if any(c_idx in cons for cons in tile_constraints[idx + 1:]))))
+        started.intersection_update(active[-1])
+
+    # states after tile idx - 1 going to states after tile idx
+    def step(idx, state):
+        needed = dict(zip(active[idx - 1], state)) if idx > 0 else {}
+        for c_idx, _ in tile_left[idx]:
+            needed.setdefault(c_idx, remain[c_idx])
+        for mine in (0, 1):
+            new = dict(needed)
+            for c_idx, left in tile_left[idx]:
+                new[c_idx] -= mine
+                if new[c_idx] < 0 or new[c_idx] > left:
+                    break
+            else:
+                yield mine, tuple(new[c_idx] for c_idx in active[idx])
+
+    def add_counts(ret, counts, shift):
+        for k, cnt in counts.items():
+            if k + shift <= max_mines:
+                ret[k + shift] = ret.get(k + shift, 0) + cnt
+
+    # forward[idx] maps the states after idx tiles to counts by mine total
+    forward = [{(): {0: 1}}]
+    for idx in range(num_tiles):
+        states = {}
+        for state, counts in forward[-1].items():
+            for mine, new_state in step(idx, state):
+                add_counts(states.setdefault(new_state, {}), counts, mine)
+        forward.append(states)
+
+    # backward[idx] maps the same states to the ways of finishing
+    backward = [None] * num_tiles + [{(): {0: 1}}]
+    for idx in range(num_tiles - 1, -1, -1):
+        states = {}
+        for state in forward[idx]:
+            finish = states[state] = {}
+            for mine, new_state in step(idx, state):
+                if new_state in backward[idx + 1]:
+                    add_counts(finish, backward[idx + 1][new_state], mine)
+        backward[idx] = states
+
+    tile_counts = {}
+    for idx, tile in enumerate(order):
+        tile_cnt = tile_counts[tile] = {}
+        for state, counts in forward[idx].items():
+            for mine, new_state in step(idx, state):
+                if mine == 0 or new_state not in backward[idx + 1]:
+                    continue
+                for k, cnt in counts.items():
+                    shifted = {j: cnt * finish for j, finish
+                        in backward[idx + 1][new_state].items()}
+                    add_counts(tile_cnt, shifted, k + 1)
+    counts = forward[-1].get((), {})
+    return counts, tile_counts
+
+
+# estimate count_solutions by sampling mine assignments of the tiles that
+# agree with the revealed constraints. Each tile is made a mine with the
+# share of mines its constraints still need, if they allow both values, and
+# the assignment is weighted by the inverse of its probability, so the
+# summed weights estimate the number of solutions up to a common factor.
+# Also returns the effective number of samples.
+def sample_solutions(tiles, constraints, max_mines, num_samples):
+    order, remain, unassigned, tile_constraints = order_constraints(tiles,
+        constraints)
+
+    # constraints without hidden tiles must already be met
+    if any(num != 0 and cnt == 0 for num, cnt in zip(remain, unassigned)):
+        num_samples = 0
+
+    samples = []
+    for _ in range(num_samples):
+        left = list(remain)
+        free = list(unassigned)
+        log_weight = 0
+        mine_idxs = []
+        for idx, cons in enumerate(tile_constraints):
+            for c_idx in cons:
+                free[c_idx] -= 1
+            can_safe = all(left[c_idx] <= free[c_idx] for c_idx in cons)
+            can_mine = len(mine_idxs) < max_mines and \
+                all(0 < left[c_idx] <= free[c_idx] + 1 for c_idx in cons)
+
+            if can_safe and can_mine:
+                if len(cons) == 0:
+                    mine_prob = 0.5
+                else:
+                    mine_prob = sum(left[c_idx] / (free[c_idx] + 1)
+                        for c_idx in cons) / len(cons)
+                is_mine = random.random() < mine_prob
+                if is_mine:
+                    log_weight -= math.log(mine_prob)
+                else:
+                    log_weight -= math.log(1 - mine_prob)
+            elif can_safe or can_mine:
+                is_mine = can_mine
+            # dead end, the sample is rejected
+            else:
+                log_weight = None
+                break
+
+            if is_mine:
+                for c_idx in cons:
+                    left[c_idx] -= 1
+                mine_idxs.append(idx)
+
+        if log_weight is not None:
+            samples.append((log_weight, mine_idxs))
+
+    counts = {}
+    tile_counts = [{} for _ in order]
+    if len(samples) == 0:
+        return counts, {tile: {} for tile in order}, 0
+
+    # weights relative to the largest one
+    max_log = max(log_weight for log_weight, _ in samples)
+    tot_weight = 0
+    sq_weight = 0
+    for log_weight, mine_idxs in samples:
+        weight = math.exp(log_weight - max_log)
+        mines = len(mine_idxs)
+        counts[mines] = counts.get(mines, 0) + weight
+        for idx in mine_idxs:
+            tile_cnt = tile_counts[idx]
+            tile_cnt[mines] = tile_cnt.get(mines, 0) + weight
+        tot_weight += weight
+        sq_weight += weight ** 2
+
+    return counts, \
+        {tile: tile_counts[idx] for idx, tile in enumerate(order)}, \
+        tot_weight ** 2 / sq_weight
+
+
+# 95% Wilson score interval of a probability estimated from num samples
+def wilson_interval(prob, num):
+    if num <= 0:
+        return 0, 1
+    z2 = 1.96 ** 2
+    center = (prob + z2 / (2 * num)) / (1 + z2 / num)
+    error = math.sqrt(prob * (1 - prob) / num + z2 / (4 * num ** 2)) * \
+        math.sqrt(z2) / (1 + z2 / num)
+    return max(center - error, 0), min(center + error, 1)
+
+
+# the 8 rotations and reflections of the grid
+SYMMETRIES = [
+    lambda x, y: (x, y), lambda x, y: (-y, x),
+    lambda x, y: (-x, -y), lambda x, y: (y, -x),
+    lambda x, y: (-x, y), lambda x, y: (y, x),
+    lambda x, y: (x, -y), lambda x, y: (-y, -x),
+]
+
+
+# key of a frontier component that is the same for every rotation,
+# reflection and position of it on a board. Each cell is (x, y, number),
+# with -1 for the hidden tiles. Returns the key and the position of each
+# tile in the layout the key was taken from.
+def pattern_key(tiles, constraints, max_mines):
+    cells = [(tile, -1) for tile in tiles] + \
+        [(constraint, constraint.num) for constraint in constraints]
+    best = None
+    for symmetry in SYMMETRIES:
+        moved = [(symmetry(tile.x, tile.y), num) for tile, num in cells]
+        min_x = min(x for (x, _), _ in moved)
+        min_y = min(y for (_, y), _ in moved)
+        moved = [((x - min_x, y - min_y), num) for (x, y), num in moved]
+        key = tuple(sorted((x, y, num) for (x, y), num in moved))
+        if best is None or key < best[0]:
+            best = key, moved
+    key, moved = best
+    positions = {tile: pos for (tile, _), (pos, _) in zip(cells, moved)
+        if tile in tiles}
+    # mines past the number of tiles never limit the count
+    return (min(max_mines, len(tiles)), key), positions
+
+
+# bounded LRU cache of count_solutions results keyed by pattern_key, so
+# frontier shapes seen before, in this game or another, are not counted
+# again. One cache can be shared by the boards of a process.
+class PatternCache:
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    # same as count_solutions, with solve counting the patterns not cached
+    def count_solutions(self, tiles, constraints, max_mines,
+            solve=count_solutions):
+        key, positions = pattern_key(tiles, constraints, max_mines)
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            counts, pos_counts = self.entries[key]
+        else:
+            self.misses += 1
+            counts, tile_counts = solve(tiles, constraints, max_mines)
+            pos_counts = {positions[tile]: tile_cnt
+                for tile, tile_cnt in tile_counts.items()}
+            self.put(key, (counts, pos_counts))
+        return counts, {tile: pos_counts[positions[tile]] for tile in tiles}
+
+    def save(self, path):
+        entries = [[[key[0], [list(cell) for cell in key[1]]],
+            list(counts.items()),
+            [[list(pos), list(tile_cnt.items())]
+                for pos, tile_cnt in pos_counts.items()]]
+            for key, (counts, pos_counts) in self.entries.items()]
+        with open(path, 'w') as f:
+            json.dump(entries, f)
+
+    # add the entries saved at path, as the least recently used
+    def load(self, path):
+        with open(path) as f:
+            entries = json.load(f)
+        loaded = OrderedDict()
+        for (max_mines, cells), counts, pos_counts in entries:
+            key = (max_mines, tuple(tuple(cell) for cell in cells))
+            loaded[key] = (dict(counts), {tuple(pos): dict(tile_cnt)
+                for pos, tile_cnt in pos_counts})
+        loaded.update(self.entries)
+        self.entries = loaded
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+# engine that only keeps the number of solutions of each frontier component
+# by mine total. Solutions are weighted by the ways of placing the remaining
+# mines in the unused tiles, so the total number of mines is exact. The
+# weights are kept relative to each other as floats, since the number of
+# ways itself is too big to work with on large boards.
+class CountingChainMap(ChainMap):
+    # counts the solutions of a component, see count_solutions
+    solve = staticmethod(count_solutions)
+
+    # no chains are built, so compact has no effect. Components are looked
+    # up in pattern_cache, if given, before they are counted.
+    def __init__(self, tiles, num_mines, compact=False, unused_tiles=None,
+            pattern_cache=None):
+        super().__init__(tiles, num_mines, unused_tiles=unused_tiles)
+        self.chains = set()
+        self.constraints = set()
+        self.frontier = set()
+        self.solved = {}
+        self.pattern_cache = pattern_cache
+        # weight of each number of frontier mines, see unused_weights
+        self.weights = {}
+        self.tot_chains = 1
+
+    def num_chains(self):
+        return self.tot_chains
+
+    def update_tile(self, tile):
+        self.save_tile(tile)
+        self.used_tile(tile)
+        self.frontier.discard(tile)
+
+        del self.mine_chain_counts[tile]
+        self.remove_count_tile(tile)
+        if tile in self.prev_counts:
+            del self.prev_counts[tile]
+        if tile in self.updates:
+            self.updates.remove(tile)
+
+        hiddens = [neigh for neigh in tile.neighs if neigh.num is None]
+        if len(hiddens) > 0:
+            self.constraints.add(tile)
+            self.frontier.update(hiddens)
+            self.update_used_tiles(hiddens, [])
+
+    # ways of placing the mines not on the frontier in the unused tiles,
+    # relative to the other numbers of frontier mines
+    def unused_weight(self, frontier_mines):
+        return self.weights.get(frontier_mines, 0)
+
+    # weights of the frontier mine totals with a count in totals, scaled so
+    # the heaviest total weighs 1. Each weight is C(unused, mines - k) up to
+    # a common factor, found in log space from the ratio of each binomial
+    # to the one before it.
+    def unused_weights(self, totals):
+        unused = len(self.unused_tiles)
+        log_weights = {}
+        log_weight = 0
+        for k in range(max(self.num_mines - unused, 0),
+                min(max(totals, default=0), self.num_mines) + 1):
+            log_weights[k] = log_weight
+            if k < self.num_mines:
+                log_weight += math.log((self.num_mines - k) /
+                    (unused - self.num_mines + k + 1))
+
+        logs = {k: math.log(cnt) + log_weights[k]
+            for k, cnt in totals.items() if k in log_weights and cnt > 0}
+        base = max(logs.values(), default=0)
+        return {k: math.exp(log_weights[k] - base) for k in logs}
+
+    def recount(self):
+        groups = frontier_groups(self.frontier, self.constraints)
+        self.constraints = set()
+
+        # components that did not change keep their counts
+        solved = {}
+        all_counts = []
+        for tiles, constraints in groups:
+            self.constraints.update(constraints)
+            key = (frozenset(tiles), frozenset(constraints))
+            if key in self.solved:
+                solved[key] = self.solved[key]
+            elif self.pattern_cache is not None:
+                solved[key] = self.pattern_cache.count_solutions(tiles,
+                    constraints, self.num_mines, self.solve)
+            else:
+                solved[key] = self.solve(tiles, constraints, self.num_mines)
+            all_counts.append(solved[key])
+        self.solved = solved
+
+        totals, _ = convolve_relative([relative_counts(counts)
+            for counts, _ in all_counts], self.num_mines)
+        self.weights = self.unused_weights(totals)
+        self.tot_chains, self.tot_mine_cnt, tile_counts = combine_counts(
+            all_counts, self.num_mines, self.unused_weight)
+        for tile, count in tile_counts.items():
+            self.save_tile(tile)
+            self.mine_chain_counts[tile] = count
+            self.updates.add(tile)
+
+    # counting always finishes, so the deadline is not used
+    def update_tiles(self, tiles, deadline=None):
+        for tile in tiles:
+            self.update_tile(tile)
+
+        self.recount()
+        reveals = self.sorted_reveals()
+        if self.stats is not None:
+            self.stats.finish()
+        return reveals
+
+
+# counting engine that sweeps each component instead of searching it, so
+# long walls with few solutions per column stay cheap however many
+# solutions they have in all
+class SweepChainMap(CountingChainMap):
+    solve = staticmethod(sweep_solutions)
+
+
+ENGINES = {
+    'chains': ChainMap,
+    'components': ComponentChainMap,
+    'counting': CountingChainMap,
+    'sweep': SweepChainMap,
+}
 
 
 NEIGHS = [
@@ -297,12 +2680,17 @@ NEIGHS = [
 ]
 
 class Board:
-    def __init__(self, width, height, num_mines):
+    # options are passed on to the engine, e.g. compact or chain_budget
+    def __init__(self, width, height, num_mines, engine='chains',
+            **options):
+        if engine not in ENGINES:
+            raise ValueError("unknown engine: " + str(engine))
         self.width = width
         self.height = height
         self.num_mines = num_mines
+        self.engine = engine
         self.tiles = self.gen_tiles()
-        self.chainMap = ChainMap(self.tiles, num_mines)
+        self.chainMap = ENGINES[engine](self.tiles, num_mines, **options)
 
     def in_board(self, x, y):
         return x >= 0 and x < self.width and \
@@ -323,7 +2711,7 @@ class Board:
         # create tile objects
         for x in range(self.width):
             for y in range(self.height):
-                tiles[y][x] = Tile(x, y)
+                tiles[y][x] = Tile(x, y, y * self.width + x)
         
         # add Neighbors
         for x in range(self.width):
@@ -334,13 +2722,534 @@ class Board:
 
         return tiles
 
-    # pairs of form list of ([(x, y), number])
-    def reveal_tiles(self, pairs):
+    def get_tile(self, idx):
+        return self.tiles[idx // self.width][idx % self.width]
+
+    # revealed numbers by flat index
+    def revealed_nums(self):
+        return {tile.idx: tile.num for row in self.tiles for tile in row
+            if tile.num is not None}
+
+    def restore_nums(self, nums):
+        for idx, num in nums.items():
+            self.get_tile(idx).set_num(num)
+
+    # see ChainMap.enable_stats
+    def enable_stats(self, callback=None):
+        return self.chainMap.enable_stats(callback)
+
+    # probability of each tile being a mine as rows of the board, None for
+    # revealed tiles, e.g. for an overlay drawn after every move
+    def probabilities(self):
+        unused_prob = self.chainMap.unused_prob()
+        ret = [[unused_prob] * self.width for _ in range(self.height)]
+        for idx in self.revealed_nums():
+            ret[idx // self.width][idx % self.width] = None
+        for tile, prob in self.chainMap.probabilities().items():
+            ret[tile.y][tile.x] = prob
+        return ret
+
+    # transactions over the reveals, see ChainMap.begin
+    def begin(self):
+        self.chainMap.begin()
+
+    def commit(self):
+        self.chainMap.commit()
+
+    def rollback(self):
+        self.chainMap.rollback()
+
+    # what if the pairs were revealed. Yields the reveals the board would
+    # suggest next and rolls the pairs back when the block ends, e.g.
+    #   with board.hypothetical([((x, y), num)]) as reveals:
+    def hypothetical(self, pairs, time_budget=None):
+        return hypothetical(self, pairs, time_budget)
+
+    # the revealed numbers and the solver state as compressed bytes, so
+    # the game can be carried on in another process without branching on
+    # the reveals again
+    def save_state(self):
+        return save_board_state(self, None)
+
+    # board of a state from save_state. options only give what is left out
+    # of the state, the executor and pattern_cache; the other engine
+    # options are saved with it.
+    @classmethod
+    def load_state(cls, data, **options):
+        return load_board_state(cls, data, options)
+
+    # pairs of form list of ([(x, y), number]). With a time_budget in
+    # seconds the best reveals found in that time are returned, and
+    # chainMap.exact says whether they were solved in full. The rest of
+    # the work is picked up by the next call, which may have no pairs. The
+    # budget is checked between steps of the work, so a call may run over
+    # it by one step, see ChainMap.branch_pending, and every call does at
+    # least one step.
+    def reveal_tiles(self, pairs, time_budget=None):
+        deadline = None
+        if time_budget is not None:
+            deadline = time.perf_counter() + time_budget
+        undo = self.chainMap.undo
         tiles = []
         for (x, y), num in pairs:
             tile = self.tiles[y][x]
+            if undo is not None:
+                undo.add(tile.set_num, tile.num)
             tile.set_num(num)
             tiles.append(tile)
 
-        next_reveals = self.chainMap.update_tiles(tiles)
+        next_reveals = self.chainMap.update_tiles(tiles, deadline)
         return next_reveals
+
+
+# set of tiles that picks a random tile in constant time, by keeping the
+# tiles in a list along with the position of each. Holds the tiles of each
+# count in sorted_counts and the unused tiles of boards that make all their
+# tiles up front.
+class TileBucket(Set):
+    def __init__(self, tiles=()):
+        self.tiles = []
+        self.positions = {}
+        for tile in tiles:
+            self.add(tile)
+
+    def __contains__(self, tile):
+        return tile in self.positions
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def __iter__(self):
+        return iter(self.tiles)
+
+    def add(self, tile):
+        if tile not in self.positions:
+            self.positions[tile] = len(self.tiles)
+            self.tiles.append(tile)
+
+    # the last tile takes the place of the removed one
+    def remove(self, tile):
+        pos = self.positions.pop(tile)
+        last = self.tiles.pop()
+        if pos < len(self.tiles):
+            self.tiles[pos] = last
+            self.positions[last] = pos
+
+    def discard(self, tile):
+        if tile in self.positions:
+            self.remove(tile)
+
+    def copy(self):
+        return TileBucket(self.tiles)
+
+    def choice(self):
+        if len(self.tiles) == 0:
+            raise IndexError("no tiles to choose from")
+        return self.tiles[random.randrange(len(self.tiles))]
+
+
+# unused tiles of a board that makes its tiles on demand. Only the indices
+# of used tiles are kept, and make_tile(idx) gives the tile of an index on
+# a board width tiles wide.
+class UnusedTiles(Set):
+    def __init__(self, num_tiles, make_tile, width):
+        self.num_tiles = num_tiles
+        self.make_tile = make_tile
+        self.width = width
+        self.used = set()
+
+    def __contains__(self, tile):
+        return tile.idx not in self.used
+
+    def __len__(self):
+        return self.num_tiles - len(self.used)
+
+    def __iter__(self):
+        for idx in range(self.num_tiles):
+            if idx not in self.used:
+                yield self.make_tile(idx)
+
+    # (x, y) of the unused tiles, without making them
+    def coords(self):
+        for idx in range(self.num_tiles):
+            if idx not in self.used:
+                yield idx % self.width, idx // self.width
+
+    def add(self, tile):
+        self.used.discard(tile.idx)
+
+    def remove(self, tile):
+        if tile.idx in self.used:
+            raise KeyError(tile)
+        self.used.add(tile.idx)
+
+    # mark a tile used without making it
+    def use_index(self, idx):
+        self.used.add(idx)
+
+    # random unused tile, drawing indices until one is unused
+    def choice(self):
+        if len(self) == 0:
+            raise IndexError("no unused tiles")
+        if len(self.used) > self.num_tiles // 2:
+            return random.choice(list(self))
+        while True:
+            idx = random.randrange(self.num_tiles)
+            if idx not in self.used:
+                return self.make_tile(idx)
+
+
+# version of the layout written by save_board_state
+STATE_VERSION = 2
+# ChainMap attributes that belong to the process rather than the game
+TRANSIENT_KEYS = ('executor', 'stats', 'pattern_cache', 'undo')
+# classes of this module a saved state may hold
+STATE_CLASSES = {'Chain', 'BitChain', 'TileSet', 'TileLayer', 'Component',
+    'TileBucket'}
+STATE_GLOBALS = {
+    ('collections', 'deque'),
+    ('sortedcontainers.sorteddict', 'SortedDict'),
+}
+
+
+# pickles tiles by flat index, so the tiles and their neighbours are
+# rebuilt by the board instead of saved. The UnusedTiles of a board that
+# makes its tiles on demand is saved by its used indices.
+class StatePickler(pickle.Pickler):
+    def __init__(self, file, unused_tiles):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.unused_tiles = unused_tiles
+
+    def persistent_id(self, obj):
+        if isinstance(obj, Tile):
+            return obj.idx
+        if isinstance(obj, UnusedTiles) and obj is self.unused_tiles:
+            return 'unused'
+        return None
+
+
+# loads a state saved by StatePickler with the tiles of board. Only the
+# classes a state is made of are loaded.
+class StateUnpickler(pickle.Unpickler):
+    def __init__(self, file, board):
+        super().__init__(file)
+        self.board = board
+
+    def persistent_load(self, pid):
+        if self.board is None:
+            raise pickle.UnpicklingError("tile outside of the solver state")
+        if pid == 'unused':
+            return self.board.unused_tiles
+        return self.board.get_tile(pid)
+
+    def find_class(self, module, name):
+        if (module == __name__ and name in STATE_CLASSES) or \
+                (module, name) in STATE_GLOBALS:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError("unexpected class in state: " +
+            module + "." + name)
+
+
+# see Board.save_state. made lists the indices of the tiles made so far on
+# boards that make them on demand, or is None.
+def save_board_state(board, made):
+    chainMap = board.chainMap
+    used = None
+    if isinstance(chainMap.unused_tiles, UnusedTiles):
+        used = sorted(chainMap.unused_tiles.used)
+    header = (STATE_VERSION, type(board).__name__, board.engine,
+        board.width, board.height, board.num_mines, board.revealed_nums(),
+        made, used)
+    state = {key: value for key, value in vars(chainMap).items()
+        if key not in TRANSIENT_KEYS}
+
+    buf = io.BytesIO()
+    StatePickler(buf, chainMap.unused_tiles).dump(header)
+    StatePickler(buf, chainMap.unused_tiles).dump(state)
+    return zlib.compress(buf.getvalue())
+
+
+# see Board.load_state
+def load_board_state(cls, data, options):
+    buf = io.BytesIO(zlib.decompress(data))
+    version, name, engine, width, height, num_mines, nums, made, used = \
+        StateUnpickler(buf, None).load()
+    if version != STATE_VERSION:
+        raise ValueError("unsupported state version: " + str(version))
+    if name != cls.__name__:
+        raise ValueError("state of a " + name + " cannot be loaded into a " +
+            cls.__name__)
+
+    board = cls(width, height, num_mines, engine, **options)
+    board.restore_nums(nums)
+    for idx in made or ():
+        board.get_tile(idx)
+    if used is not None:
+        board.unused_tiles.used = set(used)
+
+    # the fresh engine only keeps what the state leaves out
+    state = StateUnpickler(buf, board).load()
+    vars(board.chainMap).update(state)
+    return board
+
+
+# see Board.hypothetical
+@contextmanager
+def hypothetical(board, pairs, time_budget=None):
+    board.begin()
+    try:
+        yield board.reveal_tiles(pairs, time_budget)
+    finally:
+        board.rollback()
+
+
+HIDDEN = -1
+
+
+# Board keeping the numbers in a NumPy array and the neighbours in a table
+# of flat indices. Tile objects are only made for the revealed tiles on the
+# frontier and the hidden tiles next to them. Needs numpy.
+class ArrayBoard:
+    def __init__(self, width, height, num_mines, engine='chains',
+            **options):
+        if np is None:
+            raise ImportError("ArrayBoard needs numpy")
+        if engine not in ENGINES:
+            raise ValueError("unknown engine: " + str(engine))
+        # bit chains index the whole board, so every mask would be as wide
+        # as the board
+        if options.get('compact'):
+            raise ValueError("compact chains are not supported on an "
+                "array board")
+        self.width = width
+        self.height = height
+        self.num_mines = num_mines
+        self.engine = engine
+        self.nums = np.full(width * height, HIDDEN, dtype=np.int8)
+        self.neighs = self.gen_neighs()
+        # tiles made so far by flat index
+        self.tiles = {}
+        self.unused_tiles = UnusedTiles(width * height, self.get_tile, width)
+        self.chainMap = ENGINES[engine]([], num_mines,
+            unused_tiles=self.unused_tiles, **options)
+
+    # flat indices of the neighbours of every tile, HIDDEN past the edges
+    def gen_neighs(self):
+        xs = np.tile(np.arange(self.width), self.height)
+        ys = np.repeat(np.arange(self.height), self.width)
+        dtype = np.int32 if self.width * self.height < 2 ** 31 else np.int64
+        ret = np.empty((self.width * self.height, len(NEIGHS)), dtype=dtype)
+        for col, (dx, dy) in enumerate(NEIGHS):
+            new_x = xs + dx
+            new_y = ys + dy
+            inside = (new_x >= 0) & (new_x < self.width) & \
+                (new_y >= 0) & (new_y < self.height)
+            ret[:, col] = np.where(inside, new_y * self.width + new_x, HIDDEN)
+        return ret
+
+    # tile of a flat index, made and linked to the tiles around it on first
+    # use
+    def get_tile(self, idx):
+        tile = self.tiles.get(idx)
+        if tile is not None:
+            return tile
+
+        tile = Tile(idx % self.width, idx // self.width, idx)
+        if self.nums[idx] != HIDDEN:
+            tile.set_num(int(self.nums[idx]))
+        for neigh_idx in self.neighs[idx].tolist():
+            neigh = self.tiles.get(neigh_idx)
+            if neigh is not None:
+                tile.neighs.add(neigh)
+                neigh.neighs.add(tile)
+        self.tiles[idx] = tile
+        self.chainMap.add_tile(tile)
+        return tile
+
+    def get_tile_at(self, x, y):
+        return self.get_tile(y * self.width + x)
+
+    def revealed_nums(self):
+        idxs = np.flatnonzero(self.nums != HIDDEN)
+        return dict(zip(idxs.tolist(), self.nums[idxs].tolist()))
+
+    def restore_nums(self, nums):
+        self.nums[list(nums)] = list(nums.values())
+
+    def enable_stats(self, callback=None):
+        return self.chainMap.enable_stats(callback)
+
+    # same as Board.probabilities as a height by width array, with nan for
+    # revealed tiles
+    def probabilities(self):
+        ret = np.full(self.width * self.height, self.chainMap.unused_prob(),
+            dtype=float)
+        ret[self.nums != HIDDEN] = np.nan
+        probs = self.chainMap.probabilities()
+        ret[[tile.idx for tile in probs]] = list(probs.values())
+        return ret.reshape(self.height, self.width)
+
+    # same as the transactions of Board
+    def begin(self):
+        self.chainMap.begin()
+
+    def commit(self):
+        self.chainMap.commit()
+
+    def rollback(self):
+        self.chainMap.rollback()
+
+    def hypothetical(self, pairs, time_budget=None):
+        return hypothetical(self, pairs, time_budget)
+
+    # same as Board.save_state and Board.load_state
+    def save_state(self):
+        return save_board_state(self, list(self.tiles))
+
+    @classmethod
+    def load_state(cls, data, **options):
+        return load_board_state(cls, data, options)
+
+    # same as Board.reveal_tiles
+    def reveal_tiles(self, pairs, time_budget=None):
+        deadline = None
+        if time_budget is not None:
+            deadline = time.perf_counter() + time_budget
+        if len(pairs) == 0:
+            return self.chainMap.update_tiles([], deadline)
+
+        idxs = np.array([y * self.width + x for (x, y), _ in pairs],
+            dtype=self.neighs.dtype)
+        undo = self.chainMap.undo
+        if undo is not None:
+            old_nums = self.nums[idxs]
+            undo.add(self.nums.__setitem__, idxs, old_nums)
+            old_nums = dict(zip(idxs.tolist(), old_nums.tolist()))
+        self.nums[idxs] = [num for _, num in pairs]
+
+        # hidden neighbours of the whole batch at once
+        neighs = self.neighs[idxs]
+        hidden = (neighs != HIDDEN) & (self.nums[neighs] == HIDDEN)
+        on_frontier = hidden.any(axis=1).tolist()
+        for idx in np.unique(neighs[hidden]).tolist():
+            self.get_tile(idx)
+
+        tiles = []
+        for idx, frontier in zip(idxs.tolist(), on_frontier):
+            # revealed tiles never next to a hidden one have no part in
+            # the chains
+            if idx not in self.tiles and not frontier:
+                if undo is not None and idx not in self.unused_tiles.used:
+                    undo.add(self.unused_tiles.used.discard, idx)
+                self.unused_tiles.use_index(idx)
+                continue
+            tile = self.get_tile(idx)
+            if undo is not None:
+                old_num = old_nums[idx]
+                undo.add(tile.set_num, None if old_num == HIDDEN else old_num)
+            tile.set_num(int(self.nums[idx]))
+            tiles.append(tile)
+
+        return self.chainMap.update_tiles(tiles, deadline)
+
+
+# Board that only makes the tiles next to revealed ones, keyed by flat
+# index, so huge boards start without touching every tile. Compact chains
+# would need bitmasks as wide as the board, so they are not supported.
+class SparseBoard(Board):
+    def __init__(self, width, height, num_mines, engine='chains',
+            **options):
+        if engine not in ENGINES:
+            raise ValueError("unknown engine: " + str(engine))
+        if options.get('compact'):
+            raise ValueError("compact chains are not supported on a "
+                "sparse board")
+        self.width = width
+        self.height = height
+        self.num_mines = num_mines
+        self.engine = engine
+        # revealed numbers and tiles made so far by flat index
+        self.nums = {}
+        self.tiles = {}
+        self.unused_tiles = UnusedTiles(width * height, self.get_tile, width)
+        self.chainMap = ENGINES[engine]([], num_mines,
+            unused_tiles=self.unused_tiles, **options)
+
+    def get_tile(self, idx):
+        tile = self.tiles.get(idx)
+        if tile is not None:
+            return tile
+
+        x = idx % self.width
+        y = idx // self.width
+        tile = Tile(x, y, idx)
+        if idx in self.nums:
+            tile.set_num(self.nums[idx])
+        for neigh_x, neigh_y in self.get_neighs(x, y):
+            neigh = self.tiles.get(neigh_y * self.width + neigh_x)
+            if neigh is not None:
+                tile.neighs.add(neigh)
+                neigh.neighs.add(tile)
+        self.tiles[idx] = tile
+        self.chainMap.add_tile(tile)
+        return tile
+
+    def get_tile_at(self, x, y):
+        return self.get_tile(y * self.width + x)
+
+    def revealed_nums(self):
+        return dict(self.nums)
+
+    def restore_nums(self, nums):
+        self.nums = dict(nums)
+
+    # probabilities of the tiles the chains hold by (x, y), and the
+    # probability of every other hidden tile, since an overlay like that
+    # of Board would take a cell for every tile of the board
+    def probabilities(self):
+        return {(tile.x, tile.y): prob
+            for tile, prob in self.chainMap.probabilities().items()}, \
+            self.chainMap.unused_prob()
+
+    def save_state(self):
+        return save_board_state(self, list(self.tiles))
+
+    # same as Board.reveal_tiles
+    def reveal_tiles(self, pairs, time_budget=None):
+        deadline = None
+        if time_budget is not None:
+            deadline = time.perf_counter() + time_budget
+        undo = self.chainMap.undo
+        if undo is not None:
+            old_nums = {}
+            for (x, y), _ in pairs:
+                idx = y * self.width + x
+                old_nums[idx] = self.nums.get(idx)
+                if idx in self.nums:
+                    undo.add(self.nums.__setitem__, idx, self.nums[idx])
+                else:
+                    undo.add(self.nums.pop, idx, None)
+        for (x, y), num in pairs:
+            self.nums[y * self.width + x] = num
+
+        tiles = []
+        for (x, y), num in pairs:
+            idx = y * self.width + x
+            hiddens = [j * self.width + i for i, j in self.get_neighs(x, y)
+                if j * self.width + i not in self.nums]
+            # revealed tiles never next to a hidden one have no part in
+            # the chains
+            if idx not in self.tiles and len(hiddens) == 0:
+                if undo is not None and idx not in self.unused_tiles.used:
+                    undo.add(self.unused_tiles.used.discard, idx)
+                self.unused_tiles.use_index(idx)
+                continue
+            for hidden in hiddens:
+                self.get_tile(hidden)
+            tile = self.get_tile(idx)
+            if undo is not None:
+                undo.add(tile.set_num, old_nums[idx])
+            tile.set_num(num)
+            tiles.append(tile)
+
+        return self.chainMap.update_tiles(tiles, deadline)
@@ -0,0 +1,443 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from minesweeper import Board, ArrayBoard, SparseBoard, ENGINES, HIDDEN, \
+    NEIGHS
+from simulate import percentile
+
+
+# board classes a session can be backed by
+BOARDS = {
+    'board': Board,
+    'array': ArrayBoard,
+    'sparse': SparseBoard,
+}
+
+# bytes held by a made tile and by a chain with its chain map entries, as
+# measured with tracemalloc on the benchmark boards. Used to estimate the
+# memory of a session.
+TILE_BYTES = 1500
+CHAIN_BYTES = 3000
+
+# reveal latencies kept per session for its metrics
+LATENCY_WINDOW = 1000
+
+# most tiles a safest request may ask for
+MAX_SAFEST = 1000
+
+
+class ServiceError(Exception):
+    pass
+
+
+# estimated bytes held by a board, from the tiles it made and the chains
+# its engine holds
+def board_size(board):
+    if isinstance(board.tiles, list):
+        made = board.width * board.height
+    else:
+        made = len(board.tiles)
+    chain_map = board.chainMap
+    chains = len(chain_map.chains) + sum(len(comp.chains)
+        for comp in getattr(chain_map, 'components', ()))
+    size = TILE_BYTES * made + CHAIN_BYTES * chains
+    if isinstance(board, ArrayBoard):
+        size += board.nums.nbytes + board.neighs.nbytes
+    return size
+
+
+# estimated bytes of a board of board_class before anything is revealed,
+# so that boards too big for the memory cap are never built
+def new_board_size(board_class, width, height):
+    num_tiles = width * height
+    if issubclass(board_class, SparseBoard):
+        return 0
+    if issubclass(board_class, ArrayBoard):
+        index_bytes = 4 if num_tiles < 2 ** 31 else 8
+        return num_tiles * (1 + index_bytes * len(NEIGHS))
+    return TILE_BYTES * num_tiles
+
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+# whether the tile at x, y of a board is revealed
+def is_revealed(board, x, y):
+    idx = y * board.width + x
+    if isinstance(board, ArrayBoard):
+        return board.nums[idx] != HIDDEN
+    if isinstance(board, SparseBoard):
+        return idx in board.nums
+    return board.tiles[y][x].num is not None
+
+
+# raise a ServiceError unless the pairs are integer coordinates of
+# different hidden tiles on the board, each with a number from 0 to 8.
+# Checked before any of them is revealed, so a bad pair leaves the board
+# as it was.
+def check_pairs(board, pairs):
+    seen = set()
+    for (x, y), num in pairs:
+        if not is_int(x) or not is_int(y):
+            raise ServiceError("coordinates must be integers: " +
+                str([x, y]))
+        if not (0 <= x < board.width and 0 <= y < board.height):
+            raise ServiceError("tile outside the board: " + str([x, y]))
+        if not is_int(num) or not 0 <= num <= 8:
+            raise ServiceError("number must be an integer from 0 to 8: " +
+                str(num))
+        if (x, y) in seen or is_revealed(board, x, y):
+            raise ServiceError("tile already revealed: " + str([x, y]))
+        seen.add((x, y))
+
+
+# a game being solved. board is None while the session is spilled to the
+# file at spill_path. counted says whether size is in the memory of the
+# service, which it stops being as soon as an eviction starts.
+class Session:
+    def __init__(self, session_id, board_class, board):
+        self.id = session_id
+        self.board_class = board_class
+        self.engine = board.engine
+        self.board = board
+        self.spill_path = None
+        self.size = board_size(board)
+        self.counted = True
+        self.closed = False
+        # requests running or waiting for the lock
+        self.pending = 0
+        self.lock = asyncio.Lock()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.reveals = 0
+
+    def metrics(self):
+        latencies = list(self.latencies)
+        return {
+            'reveals': self.reveals,
+            'p50_ms': 1000 * percentile(latencies, 50),
+            'p99_ms': 1000 * percentile(latencies, 99),
+            'max_ms': 1000 * max(latencies, default=0),
+            'size_bytes': self.size,
+            'spilled': self.board is None,
+        }
+
+
+# many Board sessions behind one event loop. Reveals run on executor, a
+# thread pool by default, so one expensive reveal does not hold up the
+# others, and at most max_pending requests may wait on a session at once.
+# The threads take turns under the GIL, so the reveals of different
+# sessions keep the loop answering but share one core; the boards live in
+# this process and cannot be handed to a process pool.
+# Past memory_cap estimated bytes the least recently used idle sessions are
+# evicted, spilled to spill_dir with Board.save_state if it is given and
+# dropped otherwise. branch_executor, e.g. a ProcessPoolExecutor, is handed
+# to the chains engine to branch large chain sets on.
+class SolverService:
+    def __init__(self, memory_cap=1 << 30, spill_dir=None, executor=None,
+            max_pending=4, time_budget=None, branch_executor=None):
+        self.memory_cap = memory_cap
+        self.spill_dir = spill_dir
+        self.executor = executor
+        self.max_pending = max_pending
+        self.time_budget = time_budget
+        self.branch_executor = branch_executor
+        # least recently used first
+        self.sessions = OrderedDict()
+        self.ids = itertools.count(1)
+        self.memory = 0
+        self.evictions = 0
+        self.spills = 0
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def run(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, func,
+            *args)
+
+    def options(self, engine):
+        # only the chains engine branches on an executor
+        if engine == 'chains' and self.branch_executor is not None:
+            return {'executor': self.branch_executor}
+        return {}
+
+    async def create(self, width, height, mines, board='board',
+            engine='chains', options=None):
+        if board not in BOARDS:
+            raise ServiceError("unknown board: " + str(board))
+        if engine not in ENGINES:
+            raise ServiceError("unknown engine: " + str(engine))
+        if not all(is_int(value) for value in (width, height, mines)):
+            raise ServiceError("width, height and mines must be integers")
+        if width < 1 or height < 1 or not 0 <= mines <= width * height:
+            raise ServiceError("invalid board: %d by %d with %d mines" % (
+                width, height, mines))
+        board_class = BOARDS[board]
+        size = new_board_size(board_class, width, height)
+        if size > self.memory_cap:
+            raise ServiceError("board too big: about %d bytes over a cap of "
+                "%d" % (size, self.memory_cap))
+        options = dict(options or {}, **self.options(engine))
+        new_board = await self.run(lambda: board_class(width, height, mines,
+            engine, **options))
+        session = Session(str(next(self.ids)), board_class, new_board)
+        self.sessions[session.id] = session
+        self.memory += session.size
+        await self.evict()
+        return session.id
+
+    # run func(board) on a session's board, with the session loaded and
+    # counted as pending
+    async def use(self, session_id, func):
+        session = self.sessions.get(session_id)
+        if session is None:
+            raise ServiceError("unknown session: " + str(session_id))
+        if session.pending >= self.max_pending:
+            raise ServiceError("session busy: " + session_id)
+        session.pending += 1
+        try:
+            async with session.lock:
+                # closed or dropped while the request waited for the lock
+                if session.closed:
+                    raise ServiceError("unknown session: " + session_id)
+                self.sessions.move_to_end(session_id)
+                if session.board is None:
+                    await self.unspill(session)
+                ret = await self.run(func, session.board)
+                size = board_size(session.board)
+                if session.counted:
+                    self.memory += size - session.size
+                session.size = size
+        finally:
+            session.pending -= 1
+        await self.evict()
+        return ret
+
+    async def reveal(self, session_id, pairs, time_budget=None):
+        if time_budget is None:
+            time_budget = self.time_budget
+        pairs = [((x, y), num) for (x, y), num in pairs]
+        session = self.sessions.get(session_id)
+
+        def reveal(board):
+            check_pairs(board, pairs)
+            start = time.perf_counter()
+            reveals = board.reveal_tiles(pairs, time_budget)
+            session.latencies.append(time.perf_counter() - start)
+            session.reveals += 1
+            return {'reveals': [[tile.x, tile.y] for tile in reveals],
+                'exact': board.chainMap.exact}
+        return await self.use(session_id, reveal)
+
+    async def safest(self, session_id, k):
+        if not is_int(k) or k < 0:
+            raise ServiceError("k must be a non-negative integer: " + str(k))
+        k = min(k, MAX_SAFEST)
+        return await self.use(session_id, lambda board: [[x, y, prob]
+            for (x, y), prob in board.chainMap.safest(k)])
+
+    # a session being evicted is not counted any more, and its spill file
+    # is removed by evict once written
+    async def close(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            raise ServiceError("unknown session: " + str(session_id))
+        session.closed = True
+        if session.counted:
+            self.memory -= session.size
+            session.counted = False
+        if session.spill_path is not None:
+            os.remove(session.spill_path)
+            session.spill_path = None
+
+    def metrics(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is None:
+            raise ServiceError("unknown session: " + str(session_id))
+        return session.metrics()
+
+    def stats(self):
+        return {
+            'sessions': len(self.sessions),
+            'resident': sum(session.board is not None
+                for session in self.sessions.values()),
+            'memory_bytes': self.memory,
+            'evictions': self.evictions,
+            'spills': self.spills,
+        }
+
+    # evict idle sessions, least recently used first, until the estimated
+    # memory fits under the cap. The most recently used session stays.
+    async def evict(self):
+        for session in list(self.sessions.values())[:-1]:
+            if self.memory <= self.memory_cap:
+                return
+            if not session.counted or session.pending > 0 or \
+                    session.closed:
+                continue
+            self.memory -= session.size
+            session.counted = False
+            self.evictions += 1
+            if self.spill_dir is None:
+                del self.sessions[session.id]
+                session.closed = True
+                continue
+            # requests for the session wait until it is on disk
+            async with session.lock:
+                path = os.path.join(self.spill_dir, session.id + '.state')
+                data = await self.run(session.board.save_state)
+                await self.run(write_file, path, data)
+                # closed while it was being written
+                if session.closed:
+                    os.remove(path)
+                    continue
+                session.board = None
+                session.spill_path = path
+            self.spills += 1
+
+    async def unspill(self, session):
+        data = await self.run(read_file, session.spill_path)
+        options = self.options(session.engine)
+        session.board = await self.run(lambda: session.board_class.load_state(
+            data, **options))
+        os.remove(session.spill_path)
+        session.spill_path = None
+        session.size = board_size(session.board)
+        self.memory += session.size
+        session.counted = True
+
+    # response to a request, see main for the protocol
+    async def handle(self, request):
+        def field(name):
+            if name not in request:
+                raise ServiceError("missing field: " + name)
+            return request[name]
+
+        try:
+            op = request.get('op')
+            if op == 'new':
+                return {'session': await self.create(field('width'),
+                    field('height'), field('mines'),
+                    request.get('board', 'board'),
+                    request.get('engine', 'chains'),
+                    request.get('options'))}
+            if op == 'reveal':
+                return await self.reveal(field('session'), field('pairs'),
+                    request.get('time_budget'))
+            if op == 'safest':
+                return {'safest': await self.safest(field('session'),
+                    request.get('k', 1))}
+            if op == 'metrics':
+                return self.metrics(field('session'))
+            if op == 'stats':
+                return self.stats()
+            if op == 'close':
+                await self.close(field('session'))
+                return {}
+            raise ServiceError("unknown op: " + str(op))
+        except (ServiceError, TypeError, ValueError) as e:
+            return {'error': str(e)}
+        # e.g. numbers that contradict each other, which leave no solutions
+        except ArithmeticError as e:
+            return {'error': type(e).__name__ + ": " + str(e)}
+        # a bug in one request should not drop the connection
+        except Exception as e:
+            return {'error': "internal error: " + type(e).__name__ + ": " +
+                str(e)}
+
+    # answer the requests of one connection in order
+    async def serve_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if len(line) == 0:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    response = {'error': "invalid json"}
+                else:
+                    response = await self.handle(request)
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=0):
+        return await asyncio.start_server(self.serve_client, host, port)
+
+
+def write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+# newline delimited JSON over TCP, one response line per request line:
+#   {"op": "new", "width": 9, "height": 9, "mines": 10} -> {"session": "1"}
+#   {"op": "reveal", "session": "1", "pairs": [[[4, 4], 0], ...]}
+#       -> {"reveals": [[x, y], ...], "exact": true}
+#   {"op": "safest", "session": "1", "k": 5} -> {"safest": [[x, y, p], ...]}
+#       with at most MAX_SAFEST tiles
+#   {"op": "metrics", "session": "1"}, {"op": "stats"},
+#   {"op": "close", "session": "1"}
+# new also takes "board" (board, array or sparse), "engine" and engine
+# "options". Failed requests get {"error": message}.
+def main():
+    parser = argparse.ArgumentParser(
+        description="serve many minesweeper solver sessions over TCP")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=8765)
+    parser.add_argument('-w', '--workers', type=int, default=None,
+        help="threads running reveals, sharing one core under the GIL")
+    parser.add_argument('--processes', type=int, default=0,
+        help="processes the chains engine branches large chain sets on")
+    parser.add_argument('--memory-cap', type=int, default=1024,
+        help="estimated megabytes of sessions kept in memory")
+    parser.add_argument('--spill-dir', default=None,
+        help="directory evicted sessions are saved to instead of dropped")
+    parser.add_argument('--max-pending', type=int, default=4,
+        help="requests that may wait on one session")
+    parser.add_argument('--time-budget', type=float, default=None,
+        help="seconds each reveal may take")
+    args = parser.parse_args()
+
+    async def serve():
+        branch_executor = None
+        if args.processes > 0:
+            branch_executor = ProcessPoolExecutor(args.processes)
+        with ThreadPoolExecutor(args.workers) as executor:
+            service = SolverService(args.memory_cap << 20, args.spill_dir,
+                executor, args.max_pending, args.time_budget,
+                branch_executor)
+            server = await service.start(args.host, args.port)
+            print("serving on %s:%d" % server.sockets[0].getsockname()[:2])
+            try:
+                async with server:
+                    await server.serve_forever()
+            finally:
+                if branch_executor is not None:
+                    branch_executor.shutdown()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,202 @@
+import argparse
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from minesweeper import Board, NEIGHS
+
+
+# width, height and number of mines of the standard boards
+PRESETS = {
+    'beginner': (9, 9, 10),
+    'intermediate': (16, 16, 40),
+    'expert': (30, 16, 99),
+}
+
+
+# a game with its mines placed, revealing tiles the way the real game does
+class Game:
+    # first is the (x, y) of the first click, which is never a mine
+    def __init__(self, width, height, num_mines, first, rng):
+        self.width = width
+        self.height = height
+        self.num_mines = num_mines
+        coords = [(x, y) for y in range(height) for x in range(width)
+            if (x, y) != first]
+        self.mines = set(rng.sample(coords, num_mines))
+        self.revealed = set()
+
+    def neighs(self, x, y):
+        for dx, dy in NEIGHS:
+            new_x = x + dx
+            new_y = y + dy
+            if 0 <= new_x < self.width and 0 <= new_y < self.height:
+                yield new_x, new_y
+
+    def number(self, x, y):
+        return sum(neigh in self.mines for neigh in self.neighs(x, y))
+
+    # reveal a tile and flood fill from zeros. Returns the newly revealed
+    # ((x, y), number) pairs, or None if the tile is a mine.
+    def reveal(self, x, y):
+        if (x, y) in self.mines:
+            return None
+        pairs = []
+        stack = [(x, y)]
+        while len(stack) > 0:
+            coord = stack.pop()
+            if coord in self.revealed:
+                continue
+            self.revealed.add(coord)
+            num = self.number(*coord)
+            pairs.append((coord, num))
+            if num == 0:
+                stack.extend(neigh for neigh in self.neighs(*coord)
+                    if neigh not in self.revealed)
+        return pairs
+
+    def won(self):
+        return len(self.revealed) == \
+            self.width * self.height - self.num_mines
+
+
+# play a game following the board's reveals. options are passed on to the
+# board and time_budget to each reveal_tiles call. A call that runs out of
+# time before suggesting a tile is followed by calls with no pairs until
+# one does. Returns whether it was won, the seconds each reveal_tiles call
+# took, the number of guesses and the most chains the board held.
+def play_game(width, height, num_mines, seed, engine='chains', options=None,
+        time_budget=None):
+    rng = random.Random(seed)
+    # the solver breaks ties with the random module
+    random.seed(seed)
+    first = (rng.randrange(width), rng.randrange(height))
+    game = Game(width, height, num_mines, first, rng)
+    board = Board(width, height, num_mines, engine=engine, **(options or {}))
+
+    latencies = []
+    guesses = 0
+    peak_chains = 0
+    clicks = [first]
+    while True:
+        pairs = []
+        for x, y in clicks:
+            revealed = game.reveal(x, y)
+            if revealed is None:
+                break
+            pairs += revealed
+        if revealed is None or game.won():
+            return {'won': revealed is not None, 'latencies': latencies,
+                'guesses': guesses, 'peak_chains': peak_chains}
+
+        while True:
+            start = time.perf_counter()
+            reveals = board.reveal_tiles(pairs, time_budget)
+            latencies.append(time.perf_counter() - start)
+            peak_chains = max(peak_chains, len(board.chainMap.chains))
+            clicks = [(tile.x, tile.y) for tile in reveals
+                if (tile.x, tile.y) not in game.revealed]
+            # past the time budget with nothing to suggest yet, so carry on
+            # with the work left over instead of guessing
+            if len(clicks) > 0 or board.chainMap.exact:
+                break
+            pairs = []
+
+        # nothing left to suggest, so pick any hidden tile
+        if len(clicks) == 0:
+            hidden = [(x, y) for y in range(height) for x in range(width)
+                if (x, y) not in game.revealed]
+            clicks = [rng.choice(hidden)]
+        if len(clicks) == 1:
+            tile = board.tiles[clicks[0][1]][clicks[0][0]]
+            if board.chainMap.prev_counts.get(tile, 1) != 0:
+                guesses += 1
+
+
+def play_game_args(args):
+    return play_game(*args)
+
+
+# nearest rank percentile of a list of values
+def percentile(values, pct):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    rank = max(int(round(pct / 100 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+# play num_games seeded games of a board on a pool of workers
+def simulate(width, height, num_mines, num_games, seed=0, workers=None,
+        engine='chains', options=None, time_budget=None):
+    games = [(width, height, num_mines, seed + idx, engine, options,
+        time_budget) for idx in range(num_games)]
+    start = time.perf_counter()
+    with ProcessPoolExecutor(workers) as executor:
+        results = list(executor.map(play_game_args, games,
+            chunksize=max(num_games // 64, 1)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for result in results
+        for latency in result['latencies']]
+    wins = sum(result['won'] for result in results)
+    return {
+        'games': num_games,
+        'games_per_sec': num_games / elapsed,
+        'win_rate': wins / num_games,
+        'guesses_per_game': sum(result['guesses'] for result in results) /
+            num_games,
+        'p50_latency': percentile(latencies, 50),
+        'p99_latency': percentile(latencies, 99),
+    }
+
+
+# preset name or a custom WIDTHxHEIGHTxMINES board
+def parse_board(name):
+    if name in PRESETS:
+        return PRESETS[name]
+    try:
+        width, height, num_mines = (int(part) for part in name.split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("unknown board: " + name)
+    return width, height, num_mines
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="play seeded games and report win rate and latency")
+    parser.add_argument('boards', nargs='*',
+        default=['beginner', 'intermediate', 'expert'],
+        help="presets or custom WIDTHxHEIGHTxMINES boards")
+    parser.add_argument('-n', '--games', type=int, default=100)
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-w', '--workers', type=int, default=None)
+    parser.add_argument('-e', '--engine', default='chains')
+    parser.add_argument('--chain-budget', type=int, default=None,
+        help="sample probabilities past this many chains")
+    parser.add_argument('--time-budget', type=float, default=None,
+        help="seconds each reveal may take")
+    parser.add_argument('--lookahead', type=int, default=None,
+        help="break ties between this many of the safest tiles by the "
+            "information their reveal gives")
+    args = parser.parse_args()
+
+    options = {}
+    if args.chain_budget is not None:
+        options['chain_budget'] = args.chain_budget
+    if args.lookahead is not None:
+        options['lookahead'] = args.lookahead
+    for name in args.boards:
+        width, height, num_mines = parse_board(name)
+        report = simulate(width, height, num_mines, args.games, args.seed,
+            args.workers, args.engine, options, args.time_budget)
+        print("%s: %.1f games/s, %.1f%% won, %.2f guesses/game, "
+            "p50 %.2fms, p99 %.2fms" % (name, report['games_per_sec'],
+            100 * report['win_rate'], report['guesses_per_game'],
+            1000 * report['p50_latency'], 1000 * report['p99_latency']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
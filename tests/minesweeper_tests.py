@@ -1,12 +1,33 @@
 import unittest
 
+import asyncio
+import itertools
+import json
 import math
+import pickle
+import tempfile
+import threading
+import zlib
+import random
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
 
 import os, sys
 currentdir = os.path.dirname(os.path.realpath(__file__))
 parentdir = os.path.dirname(currentdir)
 sys.path.append(parentdir)
-from minesweeper import Chain, ChainMap, Board
+import minesweeper
+from minesweeper import comb_and_comp, comb_and_comp_masks, \
+    propagate_constraints, linear_forced, branch_masks, reveal_outcomes, \
+    TileSet, MAX_TILE_LAYERS, Chain, BitChain, \
+    ChainMap, ComponentChainMap, CountingChainMap, \
+    Component, Board, frontier_groups, count_solutions, sweep_solutions, \
+    TileBucket, Tile, \
+    ArrayBoard, SparseBoard, UnusedTiles, PatternCache, pattern_key, np
+from simulate import Game, play_game, percentile, parse_board
+from benchmark import regressions, tile_number, wall_reveals, WALL_LAYOUT
+from server import SolverService, ServiceError, new_board_size, \
+    MAX_SAFEST
 
 
 def gen_tiles(width, height, num_mines, reveals):
@@ -52,6 +73,225 @@ test_unused = [
     ((1, 1), 1)
 ]
 
+test_separate = [
+    ((1, 1), 1),
+    ((7, 1), 2),
+]
+
+test_split = [
+    ((1, 0), 1),
+    ((3, 0), 1),
+]
+
+split_reveal = [
+    ((2, 0), 0),
+]
+
+test_limited = [
+    ((1, 0), 1),
+    ((2, 0), 1),
+    ((6, 0), 1),
+    ((7, 0), 1),
+]
+
+test_weighted = [
+    ((1, 0), 1),
+    ((3, 0), 1),
+]
+
+test_exact = [
+    ((1, 0), 1),
+    ((1, 1), 1),
+    ((1, 2), 2),
+]
+
+# mines at (0, 0), (0, 3) and (2, 3) shown by the tiles next to test_exact
+exact_reveal = [
+    ((2, 0), 0),
+    ((2, 1), 0),
+    ((0, 1), 1),
+    ((0, 2), 1),
+    ((2, 2), 1),
+]
+
+test_wall = [
+    ((0, 1), 1),
+    ((1, 1), 1),
+    ((2, 1), 2),
+    ((3, 1), 1),
+    ((4, 1), 1),
+]
+
+# a row across a 16 by 9 board with mines above and below it, which
+# branches into many chains
+test_many_chains = [((x, 4), 3 if x in (1, 14) else 2) for x in range(16)]
+
+# probability of each hidden tile being a mine over all mine layouts
+def brute_force_probs(width, height, num_mines, reveals):
+    revealed = dict(reveals)
+    hidden = [(x, y) for x in range(width) for y in range(height)
+        if (x, y) not in revealed]
+    counts = {coord: 0 for coord in hidden}
+    total = 0
+    for mines in itertools.combinations(hidden, num_mines):
+        mine_set = set(mines)
+        valid = all(num == sum((x + i, y + j) in mine_set
+            for i in (-1, 0, 1) for j in (-1, 0, 1))
+            for (x, y), num in revealed.items())
+        if valid:
+            total += 1
+            for mine in mines:
+                counts[mine] += 1
+    return {coord: cnt / total for coord, cnt in counts.items()}
+
+# map of coordinates to mine count over number of chains
+def get_probs(chainMap):
+    ret = {}
+    for cnt, ts in chainMap.sorted_counts.items():
+        for t in ts:
+            ret[(t.x, t.y)] = cnt / chainMap.num_chains()
+    return ret
+
+class CombTests(unittest.TestCase):
+
+    def test_comb_and_comp_order(self):
+        lst = ['a', 'b', 'c', 'd', 'e']
+        for n in range(len(lst) + 1):
+            combs = list(comb_and_comp(lst, n))
+            expected = [list(c) for c in itertools.combinations(lst, n)]
+            self.assertEqual([comb for comb, _ in combs], expected)
+            for comb, comp in combs:
+                self.assertEqual(comp, [t for t in lst if t not in comb])
+
+    def test_comb_and_comp_empty(self):
+        self.assertEqual(list(comb_and_comp([], 0)), [([], [])])
+        self.assertEqual(list(comb_and_comp([1, 2], 3)), [])
+        self.assertEqual(list(comb_and_comp([1, 2], -1)), [])
+
+    def test_comb_and_comp_masks(self):
+        lst = [0, 1, 2, 3, 4]
+        bits = [1 << i for i in lst]
+        for n in range(-1, len(lst) + 2):
+            expected = [(sum(1 << i for i in comb), sum(1 << i for i in comp))
+                for comb, comp in comb_and_comp(lst, n)]
+            self.assertEqual(list(comb_and_comp_masks(bits, n)), expected)
+
+
+class PropagateTests(unittest.TestCase):
+
+    def test_single_constraints(self):
+        forced = propagate_constraints([({'a', 'b'}, 0), ({'c', 'd'}, 2)])
+        self.assertEqual(forced, ({'c', 'd'}, {'a', 'b'}))
+
+    def test_subset(self):
+        # 'c' is safe because 'a' or 'b' already holds the mine
+        forced = propagate_constraints([({'a', 'b'}, 1),
+            ({'a', 'b', 'c'}, 1)])
+        self.assertEqual(forced, (set(), {'c'}))
+
+        # 'd' and 'e' are mines after 'a' or 'b' holds one mine
+        forced = propagate_constraints([({'a', 'b'}, 1),
+            ({'a', 'b', 'd', 'e'}, 3)])
+        self.assertEqual(forced, ({'d', 'e'}, set()))
+
+    def test_chained(self):
+        forced = propagate_constraints([({'a', 'b'}, 1), ({'b'}, 0),
+            ({'a', 'c'}, 1)])
+        self.assertEqual(forced, ({'a'}, {'b', 'c'}))
+
+    def test_contradiction(self):
+        self.assertIsNone(propagate_constraints([({'a'}, 2)]))
+        self.assertIsNone(propagate_constraints([({'a', 'b'}, 1),
+            ({'a', 'b'}, 2)]))
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class LinearTests(unittest.TestCase):
+
+    def test_difference(self):
+        # neither constraint holds the other, but their difference is
+        # 5 - 0 = 1
+        constraints = [({1, 4, 5}, 2), ({0, 1, 4}, 1)]
+        self.assertEqual(propagate_constraints(constraints), (set(), set()))
+        self.assertEqual(linear_forced(constraints), ({5}, {0}))
+
+    def test_pairs(self):
+        # the pairs found by propagate_constraints are kept
+        constraints = [({0, 3, 4}, 2), ({1, 4}, 1), ({0, 1, 2, 4}, 3)]
+        mines, safes = propagate_constraints(constraints)
+        linear_mines, linear_safes = linear_forced(constraints)
+        self.assertTrue(mines <= linear_mines and safes <= linear_safes)
+
+    def test_contradiction(self):
+        self.assertIsNone(linear_forced([({0, 1}, 2), ({0, 1, 2}, 1)]))
+
+    def test_same_probabilities(self):
+        for reveals in [test_exact, exact_reveal]:
+            board = Board(4, 4, 3)
+            board.reveal_tiles(reveals)
+            linear = Board(4, 4, 3, linear=True)
+            linear.reveal_tiles(reveals)
+            self.assertEqual(get_probs(linear.chainMap),
+                get_probs(board.chainMap))
+
+    def test_fewer_chains(self):
+        # a wall revealed at once, with mines above and below it
+        mines = {(0, 0), (0, 2), (1, 0), (2, 0), (2, 2), (3, 0), (4, 0),
+            (5, 2)}
+        reveals = [((x, 1), sum((x + i, 1 + j) in mines
+            for i in (-1, 0, 1) for j in (-1, 0, 1))) for x in range(8)]
+        peaks = []
+        for linear in [False, True]:
+            board = Board(8, 3, len(mines), linear=linear)
+            stats = board.enable_stats()
+            board.reveal_tiles(reveals)
+            peaks.append(stats.snapshot()['peak_chains'])
+            self.assertEqual(len(board.chainMap.chains), 16)
+        self.assertEqual(peaks, [20, 16])
+
+
+class TileSetTests(unittest.TestCase):
+
+    def test_copy_shares_layers(self):
+        tiles = TileSet([1, 2, 3])
+        copy = tiles.copy()
+        self.assertIs(tiles.parent, copy.parent)
+
+        copy.add(4)
+        tiles.remove(1)
+        self.assertEqual(copy, {1, 2, 3, 4})
+        self.assertEqual(tiles, {2, 3})
+        self.assertEqual(len(copy), 4)
+        self.assertEqual(len(tiles), 2)
+
+        # the shared layer is not changed by either copy
+        self.assertEqual(tiles.parent.added, frozenset([1, 2, 3]))
+
+    def test_add_remove_through_layers(self):
+        tiles = TileSet([1, 2])
+        copy = tiles.copy()
+        copy.remove(1)
+        with self.assertRaises(KeyError):
+            copy.remove(1)
+        copy.add(1)
+        self.assertEqual(copy, {1, 2})
+
+        # a removed tile stays removed in later copies
+        copy.remove(2)
+        later = copy.copy()
+        later.add(3)
+        self.assertNotIn(2, later)
+        self.assertEqual(sorted(later), [1, 3])
+
+    def test_flatten(self):
+        tiles = TileSet()
+        for tile in range(3 * MAX_TILE_LAYERS):
+            tiles.add(tile)
+            tiles = tiles.copy()
+        self.assertLessEqual(tiles.parent.depth, MAX_TILE_LAYERS)
+        self.assertEqual(tiles, set(range(3 * MAX_TILE_LAYERS)))
+
+
 class ChainTests(unittest.TestCase):
 
     def test_check_tile_simple(self):
@@ -159,6 +399,18 @@ class ChainTests(unittest.TestCase):
                 self.assertNotEqual(c1.safe, c2.safe)
 
         
+    def test_branches_share_sets(self):
+        revealed_five_by_five = gen_tiles(5, 5, 10, test_reveals)
+        chain = Chain(10)
+        (x, y), _ = test_reveals[0]
+        upd_mines, _, next_chains = chain.check_tile(
+            revealed_five_by_five[y][x])
+
+        # every branch only holds its own tiles on top of the shared ones
+        for next in next_chains:
+            self.assertLessEqual(len(next.mines.added), len(upd_mines))
+            self.assertIs(next.mines.parent, next_chains[0].mines.parent)
+
     def test_check_impossible(self):
         revealed_five_by_five = gen_tiles(5, 5, 10, test_reveals)
         chain = Chain(10)
@@ -210,6 +462,62 @@ class ChainTests(unittest.TestCase):
         self.assertEqual(len(tot_final_chains), 2)
 
         
+class BitChainTests(unittest.TestCase):
+
+    def test_check_tile_same_as_chain(self):
+        revealed = gen_tiles(5, 5, 10, test_reveals)
+        tile_index = [t for row in revealed for t in row]
+        chain = Chain(10)
+        bit_chain = BitChain(10, tile_index)
+        (x, y), _ = test_reveals[0]
+        tile = revealed[y][x]
+
+        upd_mines, upd_safe, next_chains = chain.check_tile(tile)
+        bit_mines, bit_safe, bit_next = bit_chain.check_tile(tile)
+
+        self.assertEqual(set(upd_mines), set(bit_mines))
+        self.assertEqual(set(upd_safe), set(bit_safe))
+        self.assertEqual([c.key() for c in [chain] + next_chains],
+            [(frozenset(c.iter_mines()), frozenset(c.iter_safe()))
+                for c in [bit_chain] + bit_next])
+
+        for t in tile_index:
+            self.assertEqual(chain.is_mine(t), bit_chain.is_mine(t))
+            self.assertEqual(chain.is_safe(t), bit_chain.is_safe(t))
+        self.assertEqual(bit_chain.mine_count(), len(chain.mines))
+
+    def test_remove_safe_tile(self):
+        revealed = gen_tiles(2, 2, 3, test_reveals_simple)
+        tile_index = [t for row in revealed for t in row]
+        chain = BitChain(3, tile_index)
+        chain.update([revealed[0][1]], [revealed[1][0], revealed[1][1]])
+        copy = chain.copy()
+
+        chain.remove_safe_tile(revealed[1][0])
+        self.assertFalse(chain.is_safe(revealed[1][0]))
+        self.assertEqual(set(chain.iter_safe()), {revealed[1][1]})
+
+        # the copy keeps its own masks
+        self.assertTrue(copy.is_safe(revealed[1][0]))
+
+    def test_compact_chain_map(self):
+        revealed = gen_tiles(5, 5, 10, test_reveals)
+        chainMap = ChainMap(revealed, 10, compact=True)
+        update = chainMap.update_tiles(get_tiles(revealed, test_reveals))
+
+        base_revealed = gen_tiles(5, 5, 10, test_reveals)
+        baseMap = ChainMap(base_revealed, 10)
+        base_update = baseMap.update_tiles(
+            get_tiles(base_revealed, test_reveals))
+
+        self.assertEqual(len(chainMap.chains), 16)
+        self.assertEqual(dict(chainMap.sorted_counts),
+            dict(baseMap.sorted_counts))
+        self.assertEqual(set(update), set(base_update))
+        for t, chains in chainMap.mine_tiles.items():
+            self.assertEqual(len(chains), len(baseMap.mine_tiles[t]))
+
+
 class ChainMapTests(unittest.TestCase):
 
     def test_simple_update_single(self):
@@ -404,6 +712,796 @@ class ChainMapTests(unittest.TestCase):
             1 / 8)
 
 
+    def test_propagate_wall(self):
+        revealed = gen_tiles(5, 2, 2, test_wall)
+        chainMap = ChainMap(revealed, 2)
+        tiles = get_tiles(revealed, test_wall)
+
+        mines, safes = chainMap.propagate(tiles)
+        self.assertEqual(mines, {revealed[0][1], revealed[0][3]})
+        self.assertEqual(safes, {revealed[0][0], revealed[0][2],
+            revealed[0][4]})
+
+        upd = chainMap.update_tiles(tiles)
+        self.assertEqual(len(chainMap.chains), 1)
+        self.assertEqual(set(upd), safes)
+
+    # propagating first gives the same chains as branching on every tile
+    def test_propagate_same_counts(self):
+        revealed = gen_tiles(5, 5, 10, test_reveals)
+        chainMap = ChainMap(revealed, 10)
+        chainMap.update_tiles(get_tiles(revealed, test_reveals))
+
+        base_revealed = gen_tiles(5, 5, 10, test_reveals)
+        baseMap = ChainMap(base_revealed, 10)
+        for t in get_tiles(base_revealed, test_reveals):
+            baseMap.update_tile(t)
+        baseMap.update_sorted_counts()
+
+        self.assertEqual(len(chainMap.chains), len(baseMap.chains))
+        self.assertEqual(dict(chainMap.sorted_counts),
+            dict(baseMap.sorted_counts))
+
+    def test_decided_neighbourhood(self):
+        # every chain of the wall decides both hidden neighbours of (1, 0)
+        wall = [((x, 1), 2) for x in range(5)]
+        reveals = wall + [((1, 0), 1)]
+        revealed = gen_tiles(5, 3, 4, reveals)
+        chainMap = ChainMap(revealed, 4)
+        chainMap.update_tiles(get_tiles(revealed, wall))
+        with mock.patch.object(Chain, 'check_tile') as check_tile:
+            chainMap.update_tiles([revealed[0][1]])
+        check_tile.assert_not_called()
+
+        expected = brute_force_probs(5, 3, 4, reveals)
+        for coord, prob in get_probs(chainMap).items():
+            self.assertAlmostEqual(prob, expected[coord])
+
+    def test_flood_fill_batch(self):
+        rng = random.Random(11)
+        pairs = Game(9, 9, 10, (0, 0), rng).reveal(0, 0)
+        board = Board(9, 9, 10)
+        with mock.patch.object(ChainMap, 'branch_tile', autospec=True,
+                side_effect=ChainMap.branch_tile) as branch_tile:
+            board.reveal_tiles(pairs)
+
+        # only tiles next to hidden ones that are not zeros are branched on
+        branched = [call.args[1] for call in branch_tile.call_args_list]
+        self.assertLess(len(branched), len(pairs) / 2)
+        for tile in branched:
+            self.assertNotEqual(tile.num, 0)
+            self.assertTrue(any(neigh.num is None for neigh in tile.neighs))
+
+        counting = Board(9, 9, 10, engine='counting')
+        counting.reveal_tiles(pairs)
+        self.assertEqual(get_probs(board.chainMap),
+            get_probs(counting.chainMap))
+
+    def test_sampling_budget(self):
+        random.seed(0)
+        num_mines = 3
+        revealed = gen_tiles(4, 4, num_mines, test_exact)
+        chainMap = ChainMap(revealed, num_mines, chain_budget=3,
+            num_samples=2000)
+        upd = chainMap.update_tiles(get_tiles(revealed, test_exact))
+
+        # 4 chains do not fit, so the probabilities are sampled
+        self.assertTrue(chainMap.sampling)
+        self.assertEqual(len(chainMap.chains), 0)
+        self.assertEqual(set(upd), {revealed[2][0], revealed[2][2]})
+
+        base_revealed = gen_tiles(4, 4, num_mines, test_exact)
+        baseMap = ChainMap(base_revealed, num_mines)
+        baseMap.update_tiles(get_tiles(base_revealed, test_exact))
+        base_probs = get_probs(baseMap)
+        for coord, prob in get_probs(chainMap).items():
+            self.assertAlmostEqual(prob, base_probs[coord], delta=0.05)
+
+        # forced safe tiles are exact
+        estimate = chainMap.estimate
+        self.assertEqual(estimate['samples'], 2000)
+        self.assertEqual((estimate['prob'], estimate['low'],
+            estimate['high']), (0, 0, 0))
+
+    def test_sampling_interval(self):
+        random.seed(0)
+        board = Board(16, 9, 24, chain_budget=50)
+        board.reveal_tiles(test_many_chains)
+        estimate = board.chainMap.estimate
+        self.assertTrue(board.chainMap.sampling)
+        self.assertGreater(estimate['effective_samples'], 0)
+        self.assertLessEqual(estimate['low'], estimate['prob'])
+        self.assertLessEqual(estimate['prob'], estimate['high'])
+        self.assertLess(estimate['low'], estimate['high'])
+
+    def test_sampling_back_to_chains(self):
+        num_mines = 3
+        revealed = gen_tiles(4, 4, num_mines, test_exact)
+        chainMap = ChainMap(revealed, num_mines, chain_budget=3)
+        chainMap.update_tiles(get_tiles(revealed, test_exact))
+        self.assertTrue(chainMap.sampling)
+
+        # the smaller frontier fits in the budget again
+        update_tiles(revealed, exact_reveal)
+        chainMap.update_tiles(get_tiles(revealed, exact_reveal))
+        self.assertFalse(chainMap.sampling)
+        self.assertIsNone(chainMap.estimate)
+        self.assertEqual(len(chainMap.chains), 1)
+        self.assertEqual(get_probs(chainMap)[(0, 0)], 1)
+        self.assertEqual(get_probs(chainMap)[(1, 3)], 0)
+
+    def test_sampling_many_groups(self):
+        random.seed(0)
+        size = 100000
+        board = SparseBoard(size, size, size * size // 6, chain_budget=2000,
+            num_samples=20)
+        # the sample weights of 210 groups multiply past a float
+        for row in [10, 30, 50]:
+            board.reveal_tiles([((10 * x, row), 4) for x in range(1, 106)])
+        chainMap = board.chainMap
+        self.assertTrue(chainMap.sampling)
+        for prob in chainMap.probabilities().values():
+            self.assertTrue(0 <= prob <= 1)
+        self.assertAlmostEqual(chainMap.unused_prob(), 1 / 6, places=5)
+        self.assertTrue(math.isfinite(chainMap.estimate['prob']))
+
+    def test_deadline_resumes(self):
+        revealed = gen_tiles(5, 5, 10, test_reveals)
+        chainMap = ChainMap(revealed, 10)
+        tiles = get_tiles(revealed, test_reveals)
+
+        # a deadline that has passed branches on one tile, leaving the
+        # rest pending but the zero, whose neighbours are forced safe
+        # before branching
+        upd = chainMap.update_tiles(tiles, deadline=0)
+        self.assertFalse(chainMap.exact)
+        self.assertEqual(list(chainMap.pending),
+            [tile for tile in tiles[1:] if tile.num != 0])
+        for t in upd:
+            self.assertIsNone(t.num)
+
+        upd = chainMap.update_tiles([])
+        self.assertTrue(chainMap.exact)
+        self.assertEqual(len(chainMap.pending), 0)
+
+        base_revealed = gen_tiles(5, 5, 10, test_reveals)
+        baseMap = ChainMap(base_revealed, 10)
+        base_upd = baseMap.update_tiles(get_tiles(base_revealed, test_reveals))
+        self.assertEqual(get_probs(chainMap), get_probs(baseMap))
+        self.assertEqual(set(upd), set(base_upd))
+
+    def test_deadline_retires_in_steps(self):
+        reveals = [((x, y), tile_number(WALL_LAYOUT, x, y))
+            for y in (3, 5) for x in range(2) if (x, y) not in WALL_LAYOUT]
+        base = Board(16, 9, 24)
+        base.reveal_tiles(wall_reveals()[:8])
+        base.reveal_tiles(reveals)
+
+        board = Board(16, 9, 24)
+        board.reveal_tiles(wall_reveals()[:8])
+        num_chains = len(board.chainMap.chains)
+        board.reveal_tiles(reveals, time_budget=0)
+        self.assertFalse(board.chainMap.exact)
+        # one chain was taken out before the deadline stopped the work
+        self.assertEqual(len(board.chainMap.chains), num_chains - 1)
+        for _ in range(num_chains * (len(reveals) + 1)):
+            if board.chainMap.exact:
+                break
+            board.reveal_tiles([], time_budget=0)
+        self.assertTrue(board.chainMap.exact)
+        self.assertEqual(get_probs(board.chainMap), get_probs(base.chainMap))
+
+    def test_tile_prob_uncounted(self):
+        board = Board(16, 9, 30, chain_budget=100)
+        board.reveal_tiles(wall_reveals()[:8], time_budget=0)
+        chainMap = board.chainMap
+        self.assertFalse(chainMap.exact)
+        uncounted = [tile for tile in chainMap.mine_tiles
+            if tile.num is None and tile not in chainMap.prev_counts]
+        self.assertGreater(len(uncounted), 0)
+        for tile in uncounted:
+            self.assertTrue(0 <= chainMap.tile_prob(tile) <= 1)
+
+    def test_parallel_same_as_serial(self):
+        with ProcessPoolExecutor(2) as executor:
+            for compact in [False, True]:
+                board = Board(16, 9, 24, compact=compact)
+                board.reveal_tiles(test_many_chains)
+                parallel = Board(16, 9, 24, compact=compact,
+                    executor=executor, parallel_threshold=1)
+                parallel.reveal_tiles(test_many_chains)
+
+                self.assertEqual(len(parallel.chainMap.chains),
+                    len(board.chainMap.chains))
+                self.assertEqual(get_probs(parallel.chainMap),
+                    get_probs(board.chainMap))
+                self.assertEqual(parallel.chainMap.unused_tiles,
+                    board.chainMap.unused_tiles)
+
+    def test_parallel_threshold(self):
+        # below the threshold the executor is never used
+        class NoExecutor:
+            def submit(self, *args):
+                raise AssertionError("submitted below the threshold")
+
+        board = Board(5, 5, 10, executor=NoExecutor())
+        updates = board.reveal_tiles(test_reveals)
+        self.assertEqual(len(updates), 2)
+
+    def test_branch_masks(self):
+        # a 1 over three hidden tiles, then a 0 over the first of them
+        chains = branch_masks([(0, 0, 1)], [(1, 0b111)], 2)
+        self.assertEqual(chains, [(0b001, 0b110, 1), (0b010, 0b101, 1),
+            (0b100, 0b011, 1)])
+        chains = branch_masks(chains, [(0, 0b001)], 2)
+        self.assertEqual([mines for mines, _, _ in chains], [0b010, 0b100])
+
+
+class LookaheadTests(unittest.TestCase):
+
+    def test_reveal_outcomes(self):
+        # the tile at bit 0 next to a tile that is a mine in one chain
+        probs, expected = reveal_outcomes([(0b10, 0b01, 1), (0b00, 0b11, 1)],
+            0b01, 0b10, 0, 1, 4)
+        self.assertEqual(probs, {0: 0.5, 1: 0.5})
+        self.assertEqual(expected, 1)
+
+        # chains with the tile as a mine are left out, so the neighbour is
+        # certain once the tile is safe
+        probs, expected = reveal_outcomes([(0b01, 0b10, 3), (0b10, 0b01, 1)],
+            0b01, 0b10, 0, 1, 4)
+        self.assertEqual(probs, {1: 1})
+        self.assertEqual(expected, 1)
+
+    def test_reveal_outcomes_outside(self):
+        # one mine left for two unused tiles, one of them next to the tile
+        probs, expected = reveal_outcomes([(0, 0b1, 1)], 0b1, 0, 1, 1, 2)
+        self.assertEqual(probs, {0: 0.5, 1: 0.5})
+        self.assertEqual(expected, 1)
+
+    def test_most_informative(self):
+        board = Board(4, 4, 3, lookahead=8)
+        reveals = board.reveal_tiles(test_unused)
+        scores = board.chainMap.lookahead_scores
+        self.assertEqual(len(scores), 8)
+        # a 1 on the corner leaves two of the seven neighbours of the 1
+        probs, _ = scores[board.tiles[0][0]]
+        self.assertAlmostEqual(probs[1], 2 / 7)
+        best = max(expected for _, expected in scores.values())
+        self.assertEqual(len(reveals), 1)
+        self.assertEqual(scores[reveals[0]][1], best)
+
+    def test_lookahead_limit(self):
+        board = Board(4, 4, 3, lookahead=3)
+        board.reveal_tiles(test_unused)
+        self.assertEqual(len(board.chainMap.lookahead_scores), 3)
+
+    def test_budget(self):
+        # past the budget only the first candidate is scored
+        board = Board(4, 4, 3, lookahead=8, lookahead_budget=0)
+        reveals = board.reveal_tiles(test_unused)
+        self.assertEqual(list(board.chainMap.lookahead_scores), reveals)
+
+    def test_parallel(self):
+        board = Board(4, 4, 3, lookahead=8)
+        board.reveal_tiles(test_unused)
+        with ProcessPoolExecutor(2) as executor:
+            parallel = Board(4, 4, 3, lookahead=8, executor=executor)
+            parallel.reveal_tiles(test_unused)
+        scores = parallel.chainMap.lookahead_scores
+        self.assertEqual(len(scores), 8)
+        for tile, (probs, expected) in board.chainMap.lookahead_scores.items():
+            parallel_probs, parallel_expected = \
+                scores[parallel.tiles[tile.y][tile.x]]
+            self.assertAlmostEqual(parallel_expected, expected)
+            for num, prob in probs.items():
+                self.assertAlmostEqual(parallel_probs[num], prob)
+
+
+class StatsTests(unittest.TestCase):
+
+    def test_disabled(self):
+        board = Board(5, 5, 10)
+        board.reveal_tiles(test_reveals)
+        self.assertIsNone(board.chainMap.stats)
+
+    def test_counts(self):
+        yielded = []
+
+        def counted_comb_and_comp(lst, n):
+            for comb in comb_and_comp(lst, n):
+                yielded.append(comb)
+                yield comb
+
+        calls = []
+        board = Board(5, 5, 10)
+        board.enable_stats(calls.append)
+        with mock.patch.object(minesweeper, 'comb_and_comp',
+                counted_comb_and_comp):
+            board.reveal_tiles(test_reveals)
+
+        self.assertEqual(len(calls), 1)
+        call = calls[0]
+        self.assertEqual(call['tiles'], 9)
+        self.assertEqual(len(call['per_tile']), 9)
+        self.assertEqual(call['combinations'], len(yielded))
+        self.assertEqual(call['chains_created'], sum(record['chains_created']
+            for record in call['per_tile']))
+        self.assertGreater(call['chains_pruned'], 0)
+        self.assertGreaterEqual(call['peak_chains'],
+            len(board.chainMap.chains))
+        self.assertGreater(call['update_tile_seconds'], 0)
+        self.assertGreater(call['sorted_counts_seconds'], 0)
+
+    def test_decided(self):
+        calls = []
+        board = Board(3, 2, 2)
+        board.enable_stats(calls.append)
+        board.reveal_tiles([((0, 0), 1), ((2, 0), 1)])
+        # every chain decides the hidden neighbours of (1, 0). The chain
+        # with mines at (0, 1) and (2, 1) has one too many.
+        board.reveal_tiles([((1, 0), 1)])
+
+        record = calls[1]['per_tile'][0]
+        self.assertEqual(record['chains_removed'], 1)
+        self.assertEqual(record['chains_decided'], 2)
+        self.assertEqual(record['chains_decided_pruned'], 1)
+        self.assertEqual(record['chains_pruned'], 0)
+        self.assertEqual(record['combinations'], 0)
+        self.assertEqual(len(board.chainMap.chains), 1)
+
+    def test_removed_and_totals(self):
+        num_mines = 1
+        revealed = gen_tiles(4, 2, num_mines, test_too_many)
+        chainMap = ChainMap(revealed, num_mines)
+        stats = chainMap.enable_stats()
+        chainMap.update_tiles(get_tiles(revealed, test_too_many))
+
+        # revealing (1, 1) removes the chain with its mine
+        update_tiles(revealed, [((1, 1), 1)])
+        chainMap.update_tile(revealed[1][1])
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['tiles'], 3)
+        self.assertEqual(snapshot['chains_removed'], 1)
+        # (1, 0) alone has 4 places for its mine
+        self.assertEqual(snapshot['peak_chains'], 4)
+
+    def test_other_engines(self):
+        board = Board(5, 5, 8, engine='counting')
+        stats = board.enable_stats()
+        board.reveal_tiles(test_reveals)
+        self.assertGreater(stats.snapshot()['lowest_prob_seconds'], 0)
+
+
+class ComponentChainMapTests(unittest.TestCase):
+
+    def test_separate_components(self):
+        revealed = gen_tiles(9, 3, 10, test_separate)
+        chainMap = ComponentChainMap(revealed, 10)
+        tiles = get_tiles(revealed, test_separate)
+        chainMap.update_tiles(tiles)
+
+        # 8 and 28 chains are kept apart instead of 224 together
+        self.assertEqual(len(chainMap.components), 2)
+        self.assertEqual(sorted(len(c.chains) for c in chainMap.components),
+            [8, 28])
+        self.assertEqual(chainMap.num_chains(), 8 * 28)
+
+        base_revealed = gen_tiles(9, 3, 10, test_separate)
+        baseMap = ChainMap(base_revealed, 10)
+        baseMap.update_tiles(get_tiles(base_revealed, test_separate))
+        self.assertEqual(len(baseMap.chains), 8 * 28)
+        self.assertEqual(get_probs(chainMap), get_probs(baseMap))
+
+    def test_mine_limit(self):
+        # only 2 mines, so each side must use exactly one of them
+        revealed = gen_tiles(9, 2, 2, test_limited)
+        chainMap = ComponentChainMap(revealed, 2)
+        chainMap.update_tiles(get_tiles(revealed, test_limited))
+
+        base_revealed = gen_tiles(9, 2, 2, test_limited)
+        baseMap = ChainMap(base_revealed, 2)
+        baseMap.update_tiles(get_tiles(base_revealed, test_limited))
+
+        self.assertEqual(len(chainMap.components), 2)
+        self.assertEqual(chainMap.num_chains(), 4)
+        self.assertEqual(chainMap.num_chains(), len(baseMap.chains))
+        self.assertEqual(get_probs(chainMap), get_probs(baseMap))
+
+    def test_split(self):
+        revealed = gen_tiles(5, 1, 2, test_split)
+        chainMap = ComponentChainMap(revealed, 2)
+        chainMap.update_tiles(get_tiles(revealed, test_split))
+
+        # (2, 0) joins both revealed tiles
+        self.assertEqual(len(chainMap.components), 1)
+        self.assertEqual(chainMap.num_chains(), 2)
+
+        update_tiles(revealed, split_reveal)
+        upd = chainMap.update_tiles(get_tiles(revealed, split_reveal))
+
+        # both ends are now mines in their own component
+        self.assertEqual(len(chainMap.components), 2)
+        self.assertEqual(chainMap.num_chains(), 1)
+        self.assertEqual(get_probs(chainMap), {(0, 0): 1, (4, 0): 1})
+        self.assertEqual(len(upd), 0)
+
+    def test_weighted_split(self):
+        revealed = gen_tiles(7, 1, 2, test_weighted + [((5, 0), 1)])
+        chainMap = ComponentChainMap(revealed, 2)
+        left = [revealed[0][0], revealed[0][2]]
+        right = [revealed[0][4], revealed[0][6]]
+        left_weights = {left[0]: 2, left[1]: 1}
+        right_weights = {right[0]: 3, right[1]: 1}
+
+        # chains of both ends with weights that factor over them
+        chains = []
+        for left_mine in left:
+            for right_mine in right:
+                chain = chainMap.empty_chain.copy()
+                chain.force([left_mine, right_mine], [])
+                chain.weight = left_weights[left_mine] * \
+                    right_weights[right_mine]
+                chains.append(chain)
+        comp = Component(chainMap.empty_chain, chains)
+        comp.tiles = set(left + right)
+        comp.constraints = {revealed[0][1], revealed[0][5]}
+
+        parts = comp.split()
+        self.assertEqual(len(parts), 2)
+        for part in parts:
+            weights = {next(iter(chain.iter_mines())): chain.weight
+                for chain in part.chains}
+            self.assertIn(weights, [left_weights, right_weights])
+
+        # weights that do not factor keep the component together
+        chains[0].weight += 1
+        self.assertEqual(comp.split(), [comp])
+
+    def test_known_tiles_weighted(self):
+        revealed = gen_tiles(7, 1, 2, test_weighted)
+        chainMap = ComponentChainMap(revealed, 2)
+        mine, other = revealed[0][0], revealed[0][2]
+
+        # the mine is on one of two chains, carrying 2 of the 3 weight
+        chains = []
+        for chain_mine, weight in [(mine, 2), (other, 1)]:
+            chain = chainMap.empty_chain.copy()
+            chain.force([chain_mine], [tile for tile in [mine, other]
+                if tile is not chain_mine])
+            chain.weight = weight
+            chains.append(chain)
+        comp = Component(chainMap.empty_chain, chains)
+        comp.tiles = {mine, other}
+        chainMap.add_component(comp)
+        self.assertEqual(chainMap.known_tiles([mine, other]), (set(), set()))
+
+    def test_fives_same_as_chain_map(self):
+        revealed = gen_tiles(5, 5, 10, test_reveals)
+        chainMap = ComponentChainMap(revealed, 10)
+        update = chainMap.update_tiles(get_tiles(revealed, test_reveals))
+
+        base_revealed = gen_tiles(5, 5, 10, test_reveals)
+        baseMap = ChainMap(base_revealed, 10)
+        base_update = baseMap.update_tiles(
+            get_tiles(base_revealed, test_reveals))
+
+        self.assertEqual(chainMap.num_chains(), 16)
+        self.assertEqual(dict(chainMap.sorted_counts),
+            dict(baseMap.sorted_counts))
+        self.assertEqual(set(update), set(base_update))
+
+
+class CountingChainMapTests(unittest.TestCase):
+
+    def test_weighted_by_unused(self):
+        revealed = gen_tiles(7, 1, 2, test_weighted)
+        chainMap = CountingChainMap(revealed, 2)
+        chainMap.update_tiles(get_tiles(revealed, test_weighted))
+
+        # one mine at (2, 0) leaves 2 ways to place the other mine in
+        # the unused tiles. Two mines on (0, 0) and (4, 0) leave 1.
+        self.assertEqual(chainMap.weights, {1: 1, 2: 1 / 2})
+        self.assertAlmostEqual(chainMap.tot_mine_cnt / chainMap.num_chains(),
+            (1 * 2 + 2 * 1) / 3)
+        for coord, prob in get_probs(chainMap).items():
+            self.assertAlmostEqual(prob,
+                {(0, 0): 1 / 3, (2, 0): 2 / 3, (4, 0): 1 / 3}[coord])
+        self.assertEqual(len(chainMap.chains), 0)
+
+    def test_large_board_weights(self):
+        board = SparseBoard(100000, 100000, 10 ** 7, engine='counting')
+        self.assertAlmostEqual(board.chainMap.unused_prob(), 0.001)
+        board.reveal_tiles(test_exact)
+        for prob in board.chainMap.probabilities().values():
+            self.assertTrue(0 <= prob <= 1)
+
+        # relative weights match the ratios of the exact binomials
+        board = Board(100, 100, 2000, engine='counting')
+        board.reveal_tiles(test_exact)
+        unused = len(board.chainMap.unused_tiles)
+        weights = board.chainMap.weights
+        low = min(weights)
+        for k in weights:
+            self.assertAlmostEqual(weights[k] / weights[low],
+                math.comb(unused, 2000 - k) / math.comb(unused, 2000 - low))
+
+    def test_many_components(self):
+        size = 100000
+        counting = SparseBoard(size, size, size * size // 6,
+            engine='counting')
+        components = SparseBoard(size, size, size * size // 6,
+            engine='components')
+        # 70 ways for each of 200 components, more than a float holds
+        for row in [10, 30]:
+            pairs = [((10 * x, row), 4) for x in range(1, 201)]
+            counting.reveal_tiles(pairs)
+            components.reveal_tiles(pairs)
+
+        expected = components.chainMap.probabilities()
+        for tile, prob in counting.chainMap.probabilities().items():
+            self.assertAlmostEqual(prob, expected[tile])
+            self.assertAlmostEqual(prob, 0.5)
+        self.assertAlmostEqual(counting.chainMap.unused_prob(),
+            components.chainMap.unused_prob())
+
+    def test_long_wall(self):
+        # each 6 between the two rows of the wall takes all its neighbours
+        width = 1100
+        reveals = [((x, 1), 6 if 0 < x < width - 1 else 4)
+            for x in range(width)]
+        revealed = gen_tiles(width, 3, 2 * width, reveals)
+        constraints = get_tiles(revealed, reveals)
+        tiles = {neigh for tile in constraints for neigh in tile.neighs
+            if neigh.num is None}
+        counts, _ = count_solutions(tiles, constraints, 2 * width)
+        self.assertEqual(counts, {2 * width: 1})
+
+    def test_exact_probabilities(self):
+        num_mines = 3
+        revealed = gen_tiles(4, 4, num_mines, test_exact)
+        chainMap = CountingChainMap(revealed, num_mines)
+        chainMap.update_tiles(get_tiles(revealed, test_exact))
+        expected = brute_force_probs(4, 4, num_mines, test_exact)
+
+        for coord, prob in get_probs(chainMap).items():
+            self.assertAlmostEqual(prob, expected[coord])
+
+        used_mines = chainMap.tot_mine_cnt / chainMap.num_chains()
+        unused_prob = (num_mines - used_mines) / len(chainMap.unused_tiles)
+        for t in chainMap.unused_tiles:
+            self.assertAlmostEqual(unused_prob, expected[(t.x, t.y)])
+
+    def test_components_cached(self):
+        revealed = gen_tiles(9, 3, 10, test_separate)
+        chainMap = CountingChainMap(revealed, 10)
+        chainMap.update_tiles(get_tiles(revealed, test_separate[:1]))
+        solved = list(chainMap.solved.values())
+
+        # the first component is unchanged by the second reveal
+        chainMap.update_tiles(get_tiles(revealed, test_separate[1:]))
+        self.assertEqual(len(chainMap.solved), 2)
+        self.assertTrue(any(counts is solved[0]
+            for counts in chainMap.solved.values()))
+
+
+class TileBucketTests(unittest.TestCase):
+
+    def test_remove_keeps_positions(self):
+        tiles = [Tile(x, 0) for x in range(4)]
+        bucket = TileBucket(tiles)
+        bucket.remove(tiles[1])
+        bucket.discard(tiles[1])
+        self.assertEqual(set(bucket), {tiles[0], tiles[2], tiles[3]})
+        for tile in bucket:
+            self.assertEqual(bucket.tiles[bucket.positions[tile]], tile)
+        with self.assertRaises(KeyError):
+            bucket.remove(tiles[1])
+
+    def test_choice(self):
+        random.seed(0)
+        tiles = [Tile(x, 0) for x in range(3)]
+        bucket = TileBucket(tiles)
+        self.assertEqual({bucket.choice() for _ in range(100)}, set(tiles))
+        with self.assertRaises(IndexError):
+            TileBucket().choice()
+
+
+class ProbabilityQueryTests(unittest.TestCase):
+
+    def test_exact_overlay(self):
+        board = Board(4, 4, 3, engine='counting')
+        board.reveal_tiles(test_exact)
+        expected = brute_force_probs(4, 4, 3, test_exact)
+        overlay = board.probabilities()
+        for y, row in enumerate(overlay):
+            for x, prob in enumerate(row):
+                if (x, y) in dict(test_exact):
+                    self.assertIsNone(prob)
+                else:
+                    self.assertAlmostEqual(prob, expected[(x, y)])
+                    self.assertAlmostEqual(prob,
+                        board.chainMap.tile_prob(board.tiles[y][x]))
+
+    def test_safest(self):
+        board = Board(4, 4, 3, engine='counting')
+        board.reveal_tiles(test_exact)
+        ranked = board.chainMap.safest(100)
+        self.assertEqual(len(ranked), 13)
+        self.assertEqual(len({tile for tile, _ in ranked}), 13)
+        probs = [prob for _, prob in ranked]
+        self.assertEqual(probs, sorted(probs))
+        self.assertEqual(board.chainMap.safest(3), ranked[:3])
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def test_lazy_boards(self):
+        board = Board(5, 5, 8)
+        board.reveal_tiles(test_reveals)
+        expected = board.probabilities()
+        array_board = ArrayBoard(5, 5, 8)
+        array_board.reveal_tiles(test_reveals)
+        array_overlay = array_board.probabilities()
+        sparse_board = SparseBoard(5, 5, 8)
+        sparse_board.reveal_tiles(test_reveals)
+        frontier, unused_prob = sparse_board.probabilities()
+        for y, row in enumerate(expected):
+            for x, prob in enumerate(row):
+                if prob is None:
+                    self.assertTrue(np.isnan(array_overlay[y, x]))
+                    self.assertNotIn((x, y), frontier)
+                else:
+                    self.assertAlmostEqual(array_overlay[y, x], prob)
+                    self.assertAlmostEqual(frontier.get((x, y),
+                        unused_prob), prob)
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def test_safest_makes_no_tiles(self):
+        for board_class in [ArrayBoard, SparseBoard]:
+            board = board_class(1000, 1000, 1000)
+            board.reveal_tiles(test_reveals)
+            num_tiles = len(board.tiles)
+            ranked = board.chainMap.safest(5000)
+            self.assertEqual(len(ranked), 5000)
+            self.assertEqual(len(board.tiles), num_tiles)
+            self.assertEqual(len(board.chainMap.mine_tiles), num_tiles)
+
+
+# tiles and constraints of a wall of width revealed along the middle row of
+# a 3 row board, with mines placed by seed above and below it
+def gen_wall(width, seed):
+    rng = random.Random(seed)
+    mines = {(x, y) for x in range(width) for y in (0, 2)
+        if rng.random() < 0.35}
+    reveals = [((x, 1), sum((x + dx, 1 + dy) in mines
+        for dx in (-1, 0, 1) for dy in (-1, 0, 1))) for x in range(width)]
+    revealed = gen_tiles(width, 3, len(mines), reveals)
+    constraints = set(get_tiles(revealed, reveals))
+    tiles = {neigh for tile in constraints for neigh in tile.neighs
+        if neigh.num is None}
+    return tiles, constraints, len(mines)
+
+
+class SweepChainMapTests(unittest.TestCase):
+
+    def test_same_as_search(self):
+        for seed in range(5):
+            tiles, constraints, num_mines = gen_wall(12, seed)
+            for max_mines in [num_mines, num_mines + 3]:
+                self.assertEqual(
+                    sweep_solutions(tiles, constraints, max_mines),
+                    count_solutions(tiles, constraints, max_mines))
+
+    def test_exact_probabilities(self):
+        board = Board(4, 4, 3, engine='sweep')
+        board.reveal_tiles(test_exact)
+        expected = brute_force_probs(4, 4, 3, test_exact)
+        for coord, prob in get_probs(board.chainMap).items():
+            self.assertAlmostEqual(prob, expected[coord])
+
+    def test_long_wall(self):
+        # far too many solutions to search one by one
+        tiles, constraints, num_mines = gen_wall(150, 0)
+        counts, tile_counts = sweep_solutions(tiles, constraints, num_mines)
+        self.assertGreater(sum(counts.values()), 10 ** 12)
+        # each solution is counted once for each of its mines
+        self.assertEqual(sum(sum(tile_cnt.values())
+                for tile_cnt in tile_counts.values()),
+            sum(k * cnt for k, cnt in counts.items()))
+
+    def test_wide_wall(self):
+        tiles, constraints, num_mines = gen_wall(2400, 0)
+        reveals = [((tile.x, tile.y), tile.num) for tile in constraints]
+        board = Board(2400, 3, num_mines, engine='sweep')
+        board.reveal_tiles(reveals)
+        # every hidden tile is on the wall, so the mines are all there
+        self.assertAlmostEqual(sum(board.chainMap.probabilities().values()),
+            num_mines, delta=1e-6)
+
+    def test_pattern_cache(self):
+        cache = PatternCache()
+        tiles, constraints, num_mines = gen_wall(12, 1)
+        self.assertEqual(
+            cache.count_solutions(tiles, constraints, num_mines,
+                sweep_solutions),
+            count_solutions(tiles, constraints, num_mines))
+
+
+class PatternCacheTests(unittest.TestCase):
+
+    def test_same_key_rotated(self):
+        revealed = gen_tiles(5, 5, 3, test_wall)
+        chainMap = CountingChainMap(revealed, 3)
+        chainMap.update_tiles(get_tiles(revealed, test_wall))
+        (tiles, constraints), = frontier_groups(chainMap.frontier,
+            chainMap.constraints)
+
+        # the same wall down the side of a board
+        turned = [((y, x), num) for (x, y), num in test_wall]
+        turned_revealed = gen_tiles(5, 5, 3, turned)
+        turnedMap = CountingChainMap(turned_revealed, 3)
+        turnedMap.update_tiles(get_tiles(turned_revealed, turned))
+        (turned_tiles, turned_constraints), = frontier_groups(
+            turnedMap.frontier, turnedMap.constraints)
+
+        key, positions = pattern_key(tiles, constraints, 3)
+        turned_key, turned_positions = pattern_key(turned_tiles,
+            turned_constraints, 3)
+        self.assertEqual(key, turned_key)
+        self.assertEqual(sorted(positions.values()),
+            sorted(turned_positions.values()))
+
+    def test_shared_between_boards(self):
+        cache = PatternCache()
+        board = Board(5, 2, 2, engine='counting', pattern_cache=cache)
+        board.reveal_tiles(test_wall)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+        # the wall mirrored to the top of the board
+        mirrored = [((x, 0), num) for (x, _), num in test_wall]
+        other = Board(5, 2, 2, engine='counting', pattern_cache=cache)
+        other.reveal_tiles(mirrored)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.hit_rate(), 0.5)
+
+        plain = Board(5, 2, 2, engine='counting')
+        plain.reveal_tiles(mirrored)
+        self.assertEqual(get_probs(other.chainMap), get_probs(plain.chainMap))
+
+    def test_exact_probabilities(self):
+        cache = PatternCache()
+        for _ in range(2):
+            revealed = gen_tiles(4, 4, 3, test_exact)
+            chainMap = CountingChainMap(revealed, 3, pattern_cache=cache)
+            chainMap.update_tiles(get_tiles(revealed, test_exact))
+            expected = brute_force_probs(4, 4, 3, test_exact)
+            for coord, prob in get_probs(chainMap).items():
+                self.assertAlmostEqual(prob, expected[coord])
+        self.assertEqual(cache.hits, 1)
+
+    def test_lru(self):
+        cache = PatternCache(max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.entries.move_to_end('a')
+        cache.put('c', 3)
+        self.assertEqual(list(cache.entries), ['a', 'c'])
+
+    def test_save_load(self):
+        cache = PatternCache()
+        Board(5, 5, 10, engine='counting',
+            pattern_cache=cache).reveal_tiles(test_reveals)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'patterns.json')
+            cache.save(path)
+            loaded = PatternCache()
+            loaded.load(path)
+        self.assertEqual(loaded.entries, cache.entries)
+
+        board = Board(5, 5, 10, engine='counting', pattern_cache=loaded)
+        board.reveal_tiles(test_reveals)
+        self.assertEqual(loaded.hits, 1)
+
+
 class BoardTests(unittest.TestCase):
 
     def test_simple(self):
@@ -417,5 +1515,562 @@ class BoardTests(unittest.TestCase):
         self.assertEqual(len(updates), 2)
         self.assertEqual(set(updates), board.chainMap.sorted_counts[0])
 
+    def test_tile_index(self):
+        board = Board(4, 3, 2)
+        indices = [t.idx for row in board.tiles for t in row]
+        self.assertEqual(indices, list(range(12)))
+
+    def test_engines(self):
+        for engine in ['chains', 'components', 'counting']:
+            board = Board(5, 5, 10, engine=engine)
+            updates = board.reveal_tiles(test_reveals)
+            self.assertEqual(set(updates), board.chainMap.sorted_counts[0])
+            self.assertIn(board.tiles[1][0], updates)
+
+        with self.assertRaises(ValueError):
+            Board(5, 5, 10, engine='unknown')
+
+    def test_time_budget(self):
+        board = Board(5, 5, 10)
+        board.reveal_tiles(test_reveals, time_budget=0)
+        self.assertFalse(board.chainMap.exact)
+
+        # every call does some of the work, so calls with no pairs finish
+        for _ in range(len(test_reveals)):
+            board.reveal_tiles([], time_budget=0)
+        self.assertTrue(board.chainMap.exact)
+
+        board = Board(5, 5, 10)
+        board.reveal_tiles(test_reveals, time_budget=0)
+
+        updates = board.reveal_tiles([], time_budget=10)
+        self.assertTrue(board.chainMap.exact)
+        self.assertEqual(set(updates), board.chainMap.sorted_counts[0])
+        self.assertEqual(len(updates), 2)
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class ArrayBoardTests(unittest.TestCase):
+
+    def test_same_as_board(self):
+        for engine in ['chains', 'components', 'counting']:
+            board = Board(5, 5, 8, engine=engine)
+            updates = board.reveal_tiles(test_reveals)
+            array_board = ArrayBoard(5, 5, 8, engine=engine)
+            array_updates = array_board.reveal_tiles(test_reveals)
+
+            self.assertEqual(get_probs(array_board.chainMap),
+                get_probs(board.chainMap))
+            self.assertEqual({(t.x, t.y) for t in array_updates},
+                {(t.x, t.y) for t in updates})
+
+    def test_compact(self):
+        with self.assertRaises(ValueError):
+            ArrayBoard(5, 5, 10, compact=True)
+
+    def test_lazy_tiles(self):
+        board = ArrayBoard(100, 100, 10)
+        self.assertEqual(len(board.tiles), 0)
+        self.assertEqual(len(board.chainMap.unused_tiles), 100 * 100)
+
+        updates = board.reveal_tiles(test_unused)
+        # the revealed tile, its 8 hidden neighbours and the unused tile
+        # picked
+        self.assertEqual(len(board.tiles), 10)
+        self.assertEqual(len(board.chainMap.unused_tiles), 100 * 100 - 9)
+        self.assertEqual(board.get_tile_at(0, 0).neighs,
+            {board.get_tile_at(1, 0), board.get_tile_at(0, 1),
+                board.get_tile_at(1, 1)})
+
+        # the unused tile picked is made on demand
+        self.assertEqual(len(updates), 1)
+        self.assertIn(updates[0], board.chainMap.unused_tiles)
+        self.assertIs(board.tiles[updates[0].idx], updates[0])
+
+    def test_inner_tiles_not_made(self):
+        board = ArrayBoard(5, 5, 1)
+        reveals = [((x, y), 0) for x in range(3) for y in range(3)]
+        board.reveal_tiles(reveals)
+
+        # only the revealed tiles on the x = 2 and y = 2 edges have hidden
+        # neighbours
+        self.assertNotIn(0, board.tiles)
+        self.assertNotIn(6, board.tiles)
+        self.assertEqual(len(board.tiles), 5 + 7)
+        self.assertEqual(len(board.chainMap.unused_tiles), 25 - 9 - 7)
+
+    def test_unused_choice(self):
+        made = []
+        unused = UnusedTiles(4, lambda idx: made.append(idx) or
+            Board(4, 1, 1).tiles[0][idx], 4)
+        unused.use_index(0)
+        unused.use_index(2)
+        self.assertEqual(len(unused), 2)
+        self.assertEqual(list(unused.coords()), [(1, 0), (3, 0)])
+        self.assertEqual(made, [])
+        for _ in range(10):
+            self.assertIn(unused.choice().idx, {1, 3})
+        unused.use_index(1)
+        unused.use_index(3)
+        with self.assertRaises(IndexError):
+            unused.choice()
+
+
+class SparseBoardTests(unittest.TestCase):
+
+    def test_same_as_board(self):
+        for engine in ['chains', 'components', 'counting']:
+            board = Board(5, 5, 8, engine=engine)
+            updates = board.reveal_tiles(test_reveals)
+            sparse_board = SparseBoard(5, 5, 8, engine=engine)
+            sparse_updates = sparse_board.reveal_tiles(test_reveals)
+
+            self.assertEqual(get_probs(sparse_board.chainMap),
+                get_probs(board.chainMap))
+            self.assertEqual({(t.x, t.y) for t in sparse_updates},
+                {(t.x, t.y) for t in updates})
+
+    def test_huge_board(self):
+        size = 100000
+        board = SparseBoard(size, size, 10 ** 9)
+        self.assertEqual(len(board.tiles), 0)
+
+        updates = board.reveal_tiles([((50, 50), 2)])
+        # the revealed tile, its 8 hidden neighbours and the unused tile
+        # picked
+        self.assertEqual(len(board.tiles), 10)
+        self.assertEqual(len(board.chainMap.unused_tiles), size * size - 9)
+        self.assertEqual(len(updates), 1)
+        self.assertIn(updates[0], board.chainMap.unused_tiles)
+
+    def test_revealed_neighbours(self):
+        board = SparseBoard(5, 5, 1)
+        board.reveal_tiles([((x, y), 0) for x in range(3) for y in range(3)])
+        board.reveal_tiles([((3, 3), 1)])
+
+        # (2, 2) is linked to the tiles made around it in both reveals
+        tile = board.get_tile_at(2, 2)
+        self.assertIn(board.get_tile_at(3, 3), tile.neighs)
+        self.assertIn(tile, board.get_tile_at(3, 3).neighs)
+        self.assertNotIn(0, board.tiles)
+
+    def test_compact(self):
+        with self.assertRaises(ValueError):
+            SparseBoard(5, 5, 10, compact=True)
+
+
+class StateTests(unittest.TestCase):
+
+    def assert_same_game(self, board, loaded, reveals):
+        self.assertEqual(get_probs(loaded.chainMap), get_probs(board.chainMap))
+        board.reveal_tiles(reveals)
+        loaded.reveal_tiles(reveals)
+        self.assertEqual(get_probs(loaded.chainMap), get_probs(board.chainMap))
+
+    def test_round_trip(self):
+        for engine, options in [('chains', {}), ('chains', {'compact': True}),
+                ('components', {}), ('counting', {})]:
+            board = Board(4, 4, 3, engine, **options)
+            board.reveal_tiles(test_exact)
+            loaded = Board.load_state(board.save_state())
+            self.assertEqual(loaded.engine, engine)
+            self.assertEqual(loaded.chainMap.unused_tiles,
+                board.chainMap.unused_tiles)
+            self.assertEqual(len(loaded.chainMap.chains),
+                len(board.chainMap.chains))
+            self.assert_same_game(board, loaded, exact_reveal)
+
+    def test_no_branching_on_load(self):
+        board = Board(5, 5, 10)
+        board.reveal_tiles(test_reveals)
+        data = board.save_state()
+        with mock.patch.object(ChainMap, 'branch_tile') as branch_tile:
+            Board.load_state(data)
+        branch_tile.assert_not_called()
+
+    def test_sampling(self):
+        board = Board(16, 9, 20, chain_budget=50)
+        board.reveal_tiles(test_many_chains)
+        loaded = Board.load_state(board.save_state())
+        self.assertTrue(loaded.chainMap.sampling)
+        self.assertEqual(loaded.chainMap.estimate, board.chainMap.estimate)
+        self.assertEqual(get_probs(loaded.chainMap), get_probs(board.chainMap))
+
+    def test_options_not_saved(self):
+        cache = PatternCache()
+        board = Board(5, 5, 8, 'counting', pattern_cache=cache)
+        board.enable_stats()
+        board.reveal_tiles(test_reveals)
+        loaded = Board.load_state(board.save_state())
+        self.assertIsNone(loaded.chainMap.pattern_cache)
+        self.assertIsNone(loaded.chainMap.stats)
+        loaded = Board.load_state(board.save_state(), pattern_cache=cache)
+        self.assertIs(loaded.chainMap.pattern_cache, cache)
+
+    def test_sparse(self):
+        board = SparseBoard(5, 5, 10)
+        board.reveal_tiles(test_reveals)
+        loaded = SparseBoard.load_state(board.save_state())
+        self.assertEqual(set(loaded.tiles), set(board.tiles))
+        self.assertEqual(loaded.unused_tiles.used, board.unused_tiles.used)
+        self.assertIs(loaded.chainMap.unused_tiles, loaded.unused_tiles)
+        self.assert_same_game(board, loaded, next_reveals)
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def test_array(self):
+        board = ArrayBoard(5, 5, 10)
+        board.reveal_tiles(test_reveals)
+        loaded = ArrayBoard.load_state(board.save_state())
+        self.assertTrue((loaded.nums == board.nums).all())
+        self.assert_same_game(board, loaded, next_reveals)
+
+    def test_wrong_board(self):
+        board = Board(5, 5, 10)
+        board.reveal_tiles(test_reveals)
+        with self.assertRaises(ValueError):
+            SparseBoard.load_state(board.save_state())
+
+    def test_unexpected_class(self):
+        data = zlib.compress(pickle.dumps(os.system))
+        with self.assertRaises(pickle.UnpicklingError):
+            Board.load_state(data)
+
+
+class TransactionTests(unittest.TestCase):
+
+    def assert_rolled_back(self, board, reveals):
+        probs = get_probs(board.chainMap)
+        unused = set(board.chainMap.unused_tiles)
+        with board.hypothetical(reveals):
+            self.assertNotEqual(get_probs(board.chainMap), probs)
+        self.assertEqual(get_probs(board.chainMap), probs)
+        self.assertEqual(set(board.chainMap.unused_tiles), unused)
+
+    def test_hypothetical(self):
+        for engine, options in [('chains', {}), ('chains', {'compact': True}),
+                ('components', {}), ('counting', {})]:
+            board = Board(4, 4, 3, engine, **options)
+            board.reveal_tiles(test_exact)
+            self.assert_rolled_back(board, exact_reveal[:2])
+            self.assertIsNone(board.tiles[0][2].num)
+
+            # the board carries on as if nothing was revealed
+            other = Board(4, 4, 3, engine, **options)
+            other.reveal_tiles(test_exact)
+            board.reveal_tiles(exact_reveal)
+            other.reveal_tiles(exact_reveal)
+            self.assertEqual(get_probs(board.chainMap),
+                get_probs(other.chainMap))
+
+    def test_rollback_after_error(self):
+        board = Board(4, 4, 3)
+        board.reveal_tiles(test_exact)
+        probs = get_probs(board.chainMap)
+        with self.assertRaises(KeyError):
+            with board.hypothetical(exact_reveal):
+                raise KeyError
+        self.assertEqual(get_probs(board.chainMap), probs)
+        self.assertIsNone(board.chainMap.undo)
+
+    def test_commit(self):
+        board = Board(4, 4, 3)
+        board.reveal_tiles(test_exact)
+        board.begin()
+        board.reveal_tiles(exact_reveal)
+        probs = get_probs(board.chainMap)
+        board.commit()
+        self.assertIsNone(board.chainMap.undo)
+        self.assertEqual(get_probs(board.chainMap), probs)
+        with self.assertRaises(RuntimeError):
+            board.rollback()
+
+    def test_nested(self):
+        board = Board(4, 4, 3)
+        board.reveal_tiles(test_exact)
+        probs = get_probs(board.chainMap)
+        board.begin()
+        board.reveal_tiles(exact_reveal[:2])
+        outer = get_probs(board.chainMap)
+        self.assert_rolled_back(board, exact_reveal[2:])
+        self.assertEqual(get_probs(board.chainMap), outer)
+
+        board.begin()
+        board.reveal_tiles(exact_reveal[2:])
+        board.commit()
+        board.rollback()
+        self.assertEqual(get_probs(board.chainMap), probs)
+
+    def test_sparse(self):
+        board = SparseBoard(4, 4, 3)
+        board.reveal_tiles(test_exact)
+        nums = dict(board.nums)
+        used = set(board.unused_tiles.used)
+        self.assert_rolled_back(board, exact_reveal)
+        self.assertEqual(board.nums, nums)
+        self.assertEqual(board.unused_tiles.used, used)
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def test_array(self):
+        board = ArrayBoard(4, 4, 3)
+        board.reveal_tiles(test_exact)
+        nums = board.nums.copy()
+        self.assert_rolled_back(board, exact_reveal)
+        self.assertTrue((board.nums == nums).all())
+        self.assertIsNone(board.get_tile_at(2, 0).num)
+
+
+class SimulateTests(unittest.TestCase):
+
+    def test_first_click_safe(self):
+        for seed in range(20):
+            # every tile but the first click is a mine
+            game = Game(3, 3, 8, (1, 1), random.Random(seed))
+            self.assertNotIn((1, 1), game.mines)
+            self.assertEqual(game.reveal(1, 1), [((1, 1), 8)])
+            self.assertTrue(game.won())
+
+    def test_flood_fill(self):
+        game = Game(4, 1, 1, (0, 0), random.Random(0))
+        game.mines = {(3, 0)}
+        pairs = game.reveal(0, 0)
+        self.assertEqual(sorted(pairs), [((0, 0), 0), ((1, 0), 0),
+            ((2, 0), 1)])
+        self.assertTrue(game.won())
+        self.assertIsNone(game.reveal(3, 0))
+
+    def test_seeded_games(self):
+        for seed in range(5):
+            result = play_game(9, 9, 10, seed)
+            self.assertEqual(result, {**play_game(9, 9, 10, seed),
+                'latencies': result['latencies']})
+            self.assertIn(result['won'], [True, False])
+
+    def test_time_budget_finishes_work(self):
+        calls = []
+        original = Board.reveal_tiles
+
+        # the first reveal runs out of time before it suggests anything
+        def reveal_tiles(board, pairs, time_budget=None):
+            calls.append(pairs)
+            reveals = original(board, pairs, time_budget)
+            if len(calls) == 1:
+                board.chainMap.exact = False
+                return []
+            return reveals
+
+        with mock.patch.object(Board, 'reveal_tiles', autospec=True,
+                side_effect=reveal_tiles):
+            play_game(9, 9, 10, 0, time_budget=1)
+
+        # the work left over is finished instead of clicking at random
+        self.assertGreater(len(calls), 1)
+        self.assertEqual(calls[1], [])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([], 50), 0)
+
+    def test_parse_board(self):
+        self.assertEqual(parse_board('expert'), (30, 16, 99))
+        self.assertEqual(parse_board('8x6x5'), (8, 6, 5))
+
+
+class BenchmarkTests(unittest.TestCase):
+
+    def test_regressions(self):
+        baseline = {'scenario': {'seconds': 1.0, 'peak_chains': 10,
+            'peak_bytes': 10 ** 6}}
+        same = {'scenario': {'seconds': 1.2, 'peak_chains': 10,
+            'peak_bytes': 10 ** 6}}
+        self.assertEqual(regressions(same, baseline, 0.5), [])
+
+        slower = {'scenario': {'seconds': 2.0, 'peak_chains': 11,
+            'peak_bytes': 2 * 10 ** 6}, 'new': same['scenario']}
+        self.assertEqual(len(regressions(slower, baseline, 0.5)), 3)
+
+
+# room for one new 4 by 4 board, so that another evicts it
+ONE_BOARD = new_board_size(Board, 4, 4)
+
+
+class ServerTests(unittest.IsolatedAsyncioTestCase):
+
+    async def test_reveal_over_tcp(self):
+        service = SolverService()
+        server = await service.start()
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+        async def request(**fields):
+            writer.write(json.dumps(fields).encode() + b'\n')
+            return json.loads(await reader.readline())
+
+        session = (await request(op='new', width=5, height=5,
+            mines=8))['session']
+        response = await request(op='reveal', session=session,
+            pairs=test_reveals)
+        board = Board(5, 5, 8)
+        reveals = board.reveal_tiles(test_reveals)
+        self.assertEqual({tuple(coord) for coord in response['reveals']},
+            {(tile.x, tile.y) for tile in reveals})
+        self.assertEqual((await request(op='metrics',
+            session=session))['reveals'], 1)
+        self.assertIn('error', await request(op='reveal', session='nope',
+            pairs=[]))
+        self.assertIn('error', await request(op='reveal', session=session))
+
+        writer.close()
+        server.close()
+        await server.wait_closed()
+
+    async def test_spill_and_reload(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            service = SolverService(memory_cap=ONE_BOARD,
+                spill_dir=spill_dir)
+            first = await service.create(4, 4, 3, engine='counting')
+            await service.reveal(first, test_exact)
+            # the second session pushes the first out to disk
+            await service.create(4, 4, 3)
+            self.assertTrue(service.metrics(first)['spilled'])
+            self.assertEqual(service.stats()['spills'], 1)
+
+            board = Board(4, 4, 3, engine='counting')
+            board.reveal_tiles(test_exact)
+            board.reveal_tiles(exact_reveal)
+            response = await service.reveal(first, exact_reveal)
+            self.assertEqual({tuple(coord) for coord in response['reveals']},
+                {(tile.x, tile.y) for tile in board.reveal_tiles([])})
+            self.assertFalse(service.metrics(first)['spilled'])
+
+    async def test_evict_without_spill(self):
+        service = SolverService(memory_cap=ONE_BOARD)
+        first = await service.create(4, 4, 3)
+        second = await service.create(4, 4, 3)
+        with self.assertRaises(ServiceError):
+            await service.reveal(first, test_exact)
+        await service.reveal(second, test_exact)
+        self.assertEqual(service.stats()['sessions'], 1)
+
+    async def test_session_busy(self):
+        service = SolverService(max_pending=1)
+        session = await service.create(4, 4, 3)
+        lock = service.sessions[session].lock
+        await lock.acquire()
+        waiting = asyncio.create_task(service.reveal(session, test_exact))
+        await asyncio.sleep(0)
+        response = await service.handle({'op': 'reveal', 'session': session,
+            'pairs': exact_reveal})
+        self.assertIn('busy', response['error'])
+        lock.release()
+        await waiting
+
+    async def test_close_while_spilling(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            service = SolverService(memory_cap=ONE_BOARD,
+                spill_dir=spill_dir)
+            first = await service.create(4, 4, 3)
+            saving = threading.Event()
+            release = threading.Event()
+            save_state = Board.save_state
+
+            def slow_save_state(board):
+                saving.set()
+                release.wait()
+                return save_state(board)
+
+            with mock.patch.object(Board, 'save_state', autospec=True,
+                    side_effect=slow_save_state):
+                creating = asyncio.create_task(service.create(4, 4, 3))
+                while not saving.is_set():
+                    await asyncio.sleep(0.001)
+                await service.close(first)
+                release.set()
+                second = await creating
+
+            # the first session is neither counted twice nor left on disk
+            self.assertEqual(service.memory,
+                service.sessions[second].size)
+            self.assertEqual(os.listdir(spill_dir), [])
+            with self.assertRaises(ServiceError):
+                await service.reveal(first, test_exact)
+
+    async def test_close_while_waiting(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            service = SolverService(memory_cap=ONE_BOARD,
+                spill_dir=spill_dir)
+            first = await service.create(4, 4, 3)
+            await service.create(4, 4, 3)
+            self.assertTrue(service.metrics(first)['spilled'])
+
+            lock = service.sessions[first].lock
+            await lock.acquire()
+            waiting = asyncio.create_task(service.handle({'op': 'reveal',
+                'session': first, 'pairs': test_exact}))
+            await asyncio.sleep(0)
+            await service.close(first)
+            lock.release()
+            self.assertIn('unknown session', (await waiting)['error'])
+
+    async def test_invalid_pairs(self):
+        for board in ['board', 'array', 'sparse']:
+            service = SolverService()
+            session = await service.create(4, 4, 3, board)
+            await service.reveal(session, test_exact)
+            for pairs in [[[[4, 0], 1]], [[[-1, 0], 1]], [[[0, 1.5], 1]],
+                    [[[True, 3], 1]], [[[3, 3], 9]], [[[3, 3], 1.0]],
+                    [[[3, 3], -1]], [test_exact[0]],
+                    [[[3, 3], 1], [[3, 3], 1]]]:
+                response = await service.handle({'op': 'reveal',
+                    'session': session, 'pairs': pairs})
+                self.assertIn('error', response)
+
+            # none of the bad pairs changed the board
+            expected = Board(4, 4, 3)
+            expected.reveal_tiles(test_exact)
+            response = await service.reveal(session, exact_reveal)
+            self.assertEqual({tuple(coord) for coord in response['reveals']},
+                {(tile.x, tile.y)
+                    for tile in expected.reveal_tiles(exact_reveal)})
+
+    async def test_invalid_new(self):
+        service = SolverService()
+        for fields in [{'width': 'a', 'height': 4, 'mines': 3},
+                {'width': True, 'height': 4, 'mines': 3},
+                {'width': 0, 'height': 4, 'mines': 0},
+                {'width': 4, 'height': 4, 'mines': 17},
+                {'width': 4, 'height': 4, 'mines': -1},
+                # 10 ** 10 tiles made up front
+                {'width': 100000, 'height': 100000, 'mines': 10}]:
+            response = await service.handle({'op': 'new', **fields})
+            self.assertIn('error', response)
+        self.assertEqual(service.stats()['sessions'], 0)
+
+        # sparse boards only make the tiles they need
+        response = await service.handle({'op': 'new', 'width': 100000,
+            'height': 100000, 'mines': 10, 'board': 'sparse'})
+        self.assertIn('session', response)
+
+    async def test_safest_capped(self):
+        service = SolverService()
+        session = await service.create(100, 100, 10, 'sparse')
+        for k in [-1, 'a', 1.5]:
+            response = await service.handle({'op': 'safest',
+                'session': session, 'k': k})
+            self.assertIn('error', response)
+        response = await service.handle({'op': 'safest', 'session': session,
+            'k': 10 ** 9})
+        self.assertEqual(len(response['safest']), MAX_SAFEST)
+
+    async def test_unexpected_error(self):
+        service = SolverService()
+        session = await service.create(4, 4, 3)
+        with mock.patch.object(Board, 'reveal_tiles',
+                side_effect=KeyError('tile')):
+            response = await service.handle({'op': 'reveal',
+                'session': session, 'pairs': test_exact})
+        self.assertIn('KeyError', response['error'])
+
+
 if __name__ == '__main__':
     unittest.main()